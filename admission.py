@@ -0,0 +1,130 @@
+import logging
+import time
+
+from handshake import REP_GENERAL_FAILURE, REP_NOT_ALLOWED, socks_reply
+
+# reasons a client is turned away, each answered with its REP code
+SHED_STREAMS = 'streams'
+SHED_CLIENT = 'client'
+SHED_RATE = 'rate'
+SHED_HANDSHAKES = 'handshakes'
+
+SHED_REPLIES = {
+    SHED_STREAMS: REP_GENERAL_FAILURE,
+    SHED_CLIENT: REP_NOT_ALLOWED,
+    SHED_RATE: REP_GENERAL_FAILURE,
+    SHED_HANDSHAKES: REP_GENERAL_FAILURE,
+}
+
+# seconds a shed client has to read its reply before it is closed
+SHED_LINGER = 1
+
+admission_log = logging.getLogger('admission')
+
+
+# Limits on the clients of one listener; 0 leaves a limit off, and every
+# worker process applies them on its own.  A client is checked once, when
+# its first bytes arrive, and counted until it closes; it counts as
+# handshaking until its request went out.  Streams that are admitted are
+# never touched, so an overload only turns new clients away.
+class Admission:
+
+    def __init__(self, max_streams=0, max_per_client=0, accept_rate=0, max_handshakes=0):
+        self.max_streams = max_streams
+        self.max_per_client = max_per_client
+        self.accept_rate = accept_rate
+        self.max_handshakes = max_handshakes
+        self.streams = 0
+        self.handshakes = 0
+        self.clients = {}
+        # token bucket with a second's worth of burst, and room for at least
+        # one client so rates below one per second admit anyone
+        self.burst = max(accept_rate, 1)
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+        self.shed = dict.fromkeys(SHED_REPLIES, 0)
+
+    def stats(self):
+        return {
+            'streams': self.streams,
+            'handshakes': self.handshakes,
+            'clients': len(self.clients),
+            'shed': dict(self.shed),
+        }
+
+    def take_token(self):
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.refilled) * self.accept_rate, self.burst)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    # Returns None for an admitted client, otherwise why it is shed.
+    def admit(self, client):
+        if self.max_streams and self.streams >= self.max_streams:
+            reason = SHED_STREAMS
+        elif self.max_handshakes and self.handshakes >= self.max_handshakes:
+            reason = SHED_HANDSHAKES
+        elif self.max_per_client and self.clients.get(client, 0) >= self.max_per_client:
+            reason = SHED_CLIENT
+        elif self.accept_rate and not self.take_token():
+            reason = SHED_RATE
+        else:
+            self.streams += 1
+            self.handshakes += 1
+            self.clients[client] = self.clients.get(client, 0) + 1
+            return None
+        self.shed[reason] += 1
+        admission_log.debug('client %s shed: %s', client, reason)
+        return reason
+
+    def handshake_done(self):
+        self.handshakes -= 1
+
+    def release(self, client, handshaking=False):
+        self.streams -= 1
+        if handshaking:
+            self.handshakes -= 1
+        count = self.clients.get(client, 0) - 1
+        if count > 0:
+            self.clients[client] = count
+        else:
+            self.clients.pop(client, None)
+
+
+# The whole answer for a shed client, sent as soon as its first bytes
+# arrived: a SOCKS client gets the greeting answered and the failure for
+# the request it has not sent yet, an HTTP client a status line.
+def shed_reply(data, reason):
+    rep = SHED_REPLIES[reason]
+    if data[0:1] == b'\x05':
+        return b'\x05\x00' + socks_reply(rep)
+    if rep == REP_NOT_ALLOWED:
+        return b'HTTP/1.1 429 Too Many Requests\r\n\r\n'
+    return b'HTTP/1.1 503 Service Unavailable\r\n\r\n'
+
+
+def add_options(parser):
+    parser.add_option("--max-streams", action="store", type="int",
+                      dest="max_streams",
+                      default=0,
+                      help="clients served at once, 0 for no limit")
+    parser.add_option("--max-per-client", action="store", type="int",
+                      dest="max_per_client",
+                      default=0,
+                      help="clients served at once from one IP address, 0 for no limit")
+    parser.add_option("--accept-rate", action="store", type="float",
+                      dest="accept_rate",
+                      default=0,
+                      help="new clients admitted per second, 0 for no limit")
+    parser.add_option("--max-handshakes", action="store", type="int",
+                      dest="max_handshakes",
+                      default=0,
+                      help="clients admitted but not connected yet, 0 for no limit")
+
+
+def from_options(options):
+    return Admission(options.max_streams, options.max_per_client, options.accept_rate,
+                     options.max_handshakes)
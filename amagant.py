@@ -1,8 +1,32 @@
 import asyncio
+import logging
+import math
+import os
+import signal
 import socket
 import struct
 from asyncio import Transport, AbstractEventLoop
 
+import admission
+import compress
+import logs
+import metrics
+from admission import Admission, shed_reply, SHED_LINGER
+from compress import Deflater, Inflater, CompressError
+from dialer import happy_connect, set_keepalive
+from handshake import HandshakeParser, HandshakeError, GREETING, REQUEST, CONNECT_REQUEST, CONNECT_COMPRESS, \
+    REP_SUCCESS, REP_GENERAL_FAILURE, REP_NOT_ALLOWED, REP_COMMAND_NOT_SUPPORTED, REP_NAMES, socks_reply, \
+    split_reply, connect_request, connect_error_code, connect_error_reply
+from mux import MuxProtocol
+from pool import RescuerPool, PoolDemand, WaitQueue, BREAKER_CLOSED
+from registry import RescuerRegistry, POLICIES
+from relay import BufferedRelayProtocol, reset_transport, relay_eof, close_after_reply, buffer_pool
+from resolver import Resolver
+from routes import Router, RouteError, ROUTE_DIRECT, ROUTE_REJECT
+from timers import wheel, IdleWatch, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT
+from tracing import recorder
+from workers import WorkerGroup
+
 ADD_RTYPE_IPV4 = 1
 ADD_RTYPE_DOMAIN = 3
 ADD_RTYPE_IPV6 = 4
@@ -13,215 +37,1276 @@ CMD_UDP_ASSOCIATE = 3
 CMD_REG_SURVIVOR = 250
 
 RSP_RESCUER = b'\xff\x53\x53'
+RSP_RESCUER_MUX = b'\xff\x53\x4d'
+# the same hellos from a rescuer that can deflate its streams
+RSP_RESCUER_COMPRESS = b'\xff\x53\x63'
+RSP_RESCUER_MUX_COMPRESS = b'\xff\x53\x43'
 RSP_SOCKET5_VERSION = b'\x05\x00'
 RSP_SUCCESS = b'\x05\x00\x00\x01'
 RSP_CONNECTION_REFUSED = b'\x05\x05\x00\x01'
 RSP_COMMAND_NOT_SUPPORTED = b'\x05\x07\x00\x01'
 RSP_ADDRESS_TYPE_NOT_SUPPORTED = b'\x05\x08\x00\x01'
+RSP_HTTP_ESTABLISHED = b'HTTP/1.0 200 Connection established\r\n\r\n'
+
+# control messages exchanged on idle rescuer links
+CTL_POOL = b'\xff\x50\x4e'  # + '>H' idle links wanted, survivor -> rescuer
+CTL_RETIRE = b'\xff\x50\x52'  # surplus idle link, rescuer -> survivor
+CTL_PING = b'\xff\x50\x49'  # heartbeat, survivor -> rescuer
+CTL_PONG = b'\xff\x50\x4f'  # heartbeat answer, rescuer -> survivor
+CTL_HEARTBEAT = b'\xff\x50\x48'  # + '>II' ping interval, timeout in ms, survivor -> rescuer
+
+# idle links are pinged after this many quiet seconds and evicted when the
+# answer takes longer than HEARTBEAT_TIMEOUT
+HEARTBEAT_INTERVAL = 15
+HEARTBEAT_TIMEOUT = 5
+
+SHARD_STATS_INTERVAL = 60
+
+# opt-in: reply success before the rescuer connected and send the client's
+# first bytes along with the connect request
+FAST_OPEN = False
+FAST_OPEN_WAIT = 0.05
+# client bytes buffered while no rescuer is assigned, or on the rescuer
+# while it connects to the remote
+PENDING_LIMIT = 64 * 1024
+# opt-in: rescuers offer deflated streams, survivors take them where offered
+COMPRESS = False
+COMPRESS_LEVEL = compress.COMPRESS_LEVEL
+
+METRICS_HOST = '127.0.0.1'
+TRACE_PATH = 'amagant-trace-{pid}.jsonl'
 
-rescuer_protocols = []
+WRITE_BUFFER_HIGH = 256 * 1024
+WRITE_BUFFER_LOW = 64 * 1024
 
+survivor_log = logging.getLogger('survivor')
+rescuer_log = logging.getLogger('rescuer')
+remote_log = logging.getLogger('remote')
+pool_log = logging.getLogger('pool')
 
-class SurvivorServerProtocol(asyncio.Protocol):
+rescuer_registry = RescuerRegistry()
+admission_control = Admission()
+router = Router()
+mux_links = []
+pool_demand = PoolDemand()
+wait_queue = None
+rescuer_pool = None
+resolver = Resolver()
+worker_group = None
+shard = None
+shard_count = 1
+remote_active = 0
+remote_connects = 0
+
+# Counted on the data paths, the gauges are read from the pool, registry
+# and queue when scraped.  Upstream is client -> remote, downstream the way
+# back, both counted where the bytes are read.
+metric_registry = metrics.Registry()
+bytes_relayed = metric_registry.counter('amagant_bytes_total', 'Bytes relayed', ['direction'])
+upstream_bytes = bytes_relayed.labels('upstream')
+downstream_bytes = bytes_relayed.labels('downstream')
+connect_results = metric_registry.counter('amagant_connects_total',
+                                          'CONNECT requests by reply', ['reply'])
+handshake_seconds = metric_registry.histogram('amagant_handshake_seconds',
+                                              'Time from handing a client to a rescuer to its first reply')
+connect_seconds = metric_registry.histogram('amagant_connect_seconds',
+                                            'Time the rescuer takes to resolve and connect to the remote')
+wait_queue_seconds = metric_registry.histogram('amagant_wait_queue_seconds',
+                                               'Time clients waited in the queue for an idle rescuer')
+
+
+class SurvivorServerProtocol(BufferedRelayProtocol):
     is_rescuer = False
+    relayed = False
+    rejected = False
     socket5_flag = False
     transport = None
     other_transport = None
+    pending = None
+    rescuer_host = None
+    assigned_at = None
+    parser = None
+    client_http = False
+    optimistic = False
+    early_handle = None
+    reply_head = b''
+    heartbeat_handle = None
+    handed_off = False
+    handshake_timer = None
+    idle_watch = None
+    # the address the client was admitted for, until it closes
+    client = None
+    handshaking = False
+    # a rescuer link that offered compression, and the framing of a
+    # compressed stream: the client's side deflates, the link's inflates
+    compress_offered = False
+    request_size = 0
+    deflater = None
+    inflater = None
 
     def __init__(self, loop: AbstractEventLoop):
         self.loop = loop
 
     def connection_made(self, transport: Transport):
         peername = transport.get_extra_info('peername')
-        print('connection from client {}'.format(peername))
+        survivor_log.debug('connection from %s', peername)
         self.transport = transport
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        self.byte_count = upstream_bytes
+        self.trace = recorder.start('survivor')
+        if self.trace:
+            self.trace.mark('accept')
+            self.trace.info['client'] = peername[0]
+        # clients have this long for their request, rescuers for their hello
+        if HANDSHAKE_TIMEOUT > 0:
+            self.handshake_timer = wheel.call_later(HANDSHAKE_TIMEOUT, self.handshake_expired)
         # print('Survivor send data: ', RSP_SOCKET5_VERSION)
         # self.transport.write(RSP_SOCKET5_VERSION)
 
+    def relay_peer(self):
+        if self.deflater or self.inflater:
+            return None
+        if self.is_rescuer:
+            # replies are inspected until the rescuer's health is recorded
+            return self.other_transport if self.relayed and self.assigned_at is None else None
+        return self.other_transport
+
     def data_received(self, data):
         if self.is_rescuer:
-            print('recv from rescuer: ', data)
-            if self.other_transport:
-                self.other_transport.write(data)
-                print('send to local: ', data)
+            if logs.dump_payloads:
+                logs.dump('recv from rescuer', data)
+            if not self.relayed:
+                # control messages can only precede the first reply
+                data = self.control_received(data)
+            if self.other_transport and data:
+                self.relayed = True
+                if self.inflater:
+                    try:
+                        data = self.inflater.feed(data)
+                    except CompressError as e:
+                        survivor_log.warning('bad compressed stream from rescuer: %s', e)
+                        self.transport.abort()
+                        return
+                    if not data:
+                        return
+                if self.assigned_at is not None:
+                    data = self.reply_received(data)
+                if data:
+                    self.other_transport.write(data)
         else:
             if self.other_transport:
-                print('recv from local: ', data)
-                self.other_transport.write(data)
-                print('send to rescuer: ', RSP_SOCKET5_VERSION)
-            elif data[0] == 5 or data[0:7] == b'CONNECT':
-                print('recv from local: ', data)
-                if rescuer_protocols:
-                    other = rescuer_protocols.pop(-1)
-                    self.other_transport = other.transport
-                    other.other_transport = self.transport
-                    self.other_transport.write(data)
-                    print('send to rescuer: ', data)
-                else:
-                    print('rescuer list is null')
-            elif data[0:3] == b'\xff\x53\x53':
-                print('recv from rescuer: ', data)
-                self.is_rescuer = True
-                rescuer_protocols.append(self)
-                print('new rescuer added.')
+                if logs.dump_payloads:
+                    logs.dump('recv from local', data)
+                self.other_transport.write(self.deflater.pack(data) if self.deflater else data)
+            elif self.rejected:
+                # answered already, the rest is dropped
+                pass
+            elif self.pending is not None:
+                # waiting for a rescuer
+                self.pending += data
+                if self.early_handle:
+                    self.early_handle.cancel()
+                    self.request_ready()
+                elif len(self.pending) > PENDING_LIMIT:
+                    self.transport.pause_reading()
+            elif self.parser or data[0] == 5 or data[0:7] == b'CONNECT':
+                if logs.dump_payloads:
+                    logs.dump('recv from local', data)
+                if self.parser is None and not self.admit(data):
+                    return
+                self.handshake_received(data)
+            elif data[0:3] == RSP_RESCUER or data[0:3] == RSP_RESCUER_COMPRESS:
+                if logs.dump_payloads:
+                    logs.dump('recv from rescuer', data)
+                self.compress_offered = data[0:3] == RSP_RESCUER_COMPRESS
+                self.register_rescuer(self.transport.get_extra_info('peername')[0])
+                survivor_log.debug('new rescuer %s', self.rescuer_host.key)
+            elif data[0:3] == RSP_RESCUER_MUX or data[0:3] == RSP_RESCUER_MUX_COMPRESS:
+                if logs.dump_payloads:
+                    logs.dump('recv from rescuer', data)
+                self.stop_handshake_timer()
+                link = SurvivorMuxProtocol(self.loop)
+                link.compress_offered = data[0:3] == RSP_RESCUER_MUX_COMPRESS
+                self.transport.set_protocol(link)
+                link.connection_made(self.transport)
+                set_keepalive(self.transport.get_extra_info('socket'))
+                link.start_heartbeat(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+                mux_links.append(link)
+                survivor_log.info('new mux rescuer %s', self.transport.get_extra_info('peername'))
+                if len(data) > 3:
+                    link.data_received(data[3:])
+                while wait_queue:
+                    wait_queue.take().assign_rescuer()
             else:
-                print('recv from client: ', data)
-                print('unknown data.')
+                if logs.dump_payloads:
+                    logs.dump('recv from client', data)
+                survivor_log.warning('unknown data from %s', self.transport.get_extra_info('peername'))
+
+    # Clients are admitted with their first bytes, rescuer links never count.
+    def admit(self, data):
+        client = self.transport.get_extra_info('peername')[0]
+        reason = admission_control.admit(client)
+        if reason:
+            self.shed(data, reason)
+            return False
+        self.client = client
+        self.handshaking = True
+        return True
+
+    # Turns a client away without parsing its handshake or taking a rescuer;
+    # the reply covers everything it is going to ask.
+    def shed(self, data, reason):
+        self.rejected = True
+        self.stop_handshake_timer()
+        if self.trace:
+            self.trace.mark('rejected')
+            self.trace.info['shed'] = reason
+        reply = shed_reply(data, reason)
+        self.transport.write(reply)
+        if logs.dump_payloads:
+            logs.dump('send to local', reply)
+        close_after_reply(self.transport, SHED_LINGER)
+
+    def handshake_finished(self):
+        if self.handshaking:
+            self.handshaking = False
+            admission_control.handshake_done()
+
+    # Answers the greeting here and sends the rescuer a compact connect
+    # request instead, so the greeting never crosses the tunnel.
+    def handshake_received(self, data):
+        if self.parser is None:
+            self.parser = HandshakeParser()
+            if self.trace:
+                self.trace.mark('greeting')
+        try:
+            events = self.parser.feed(data)
+        except HandshakeError as e:
+            survivor_log.warning('bad handshake from %s: %s', self.transport.get_extra_info('peername'), e)
+            self.transport.close()
+            return
+        if GREETING in events:
+            self.transport.write(RSP_SOCKET5_VERSION)
+        if REQUEST not in events:
+            return
+        self.stop_handshake_timer()
+        if self.trace:
+            self.trace.mark('request')
+            self.trace.info['target'] = '{}:{}'.format(self.parser.addr, self.parser.port)
+        if self.parser.cmd != CMD_CONNECT:
+            survivor_log.info('command %d not supported', self.parser.cmd)
+            self.transport.write(socks_reply(REP_COMMAND_NOT_SUPPORTED))
+            self.transport.close()
+            return
+        if router.path:
+            route = router.route(self.parser.addr)
+            if self.trace:
+                self.trace.info['route'] = route
+            if route == ROUTE_REJECT:
+                survivor_log.info('%s:%s rejected by the routes', self.parser.addr, self.parser.port)
+                connect_results.inc(1, 'not_allowed')
+                self.reject(REP_NOT_ALLOWED)
+                return
+            if route == ROUTE_DIRECT:
+                self.pending = bytearray(self.parser.rest)
+                self.loop.create_task(self.connect_direct())
+                return
+        try:
+            request = connect_request(self.parser, FAST_OPEN)
+        except HandshakeError as e:
+            survivor_log.warning('bad request from %s: %s', self.transport.get_extra_info('peername'), e)
+            self.transport.close()
+            return
+        self.request_size = len(request)
+        self.pending = bytearray(request + self.parser.rest)
+        if FAST_OPEN:
+            # tell the client it is connected right away and give it a moment
+            # to send its first bytes, so they travel with the request
+            self.optimistic = True
+            self.transport.write(RSP_HTTP_ESTABLISHED if self.parser.http else socks_reply(REP_SUCCESS))
+            if self.trace:
+                self.trace.mark('replied')
+            if not self.parser.rest:
+                self.early_handle = self.loop.call_later(FAST_OPEN_WAIT, self.request_ready)
+                return
+        self.request_ready()
+
+    # Connects from here like a rescuer would, then relays to the remote;
+    # what the client sends meanwhile waits in `pending`.
+    async def connect_direct(self):
+        parser = self.parser
+        try:
+            addresses = await resolver.resolve(parser.addr)
+            sock = await happy_connect(self.loop, addresses, parser.port)
+            transport, protocol = await self.loop.create_connection(
+                lambda: RemoteClientProtocol(self.transport), sock=sock)
+        except OSError as e:
+            connect_results.inc(1, REP_NAMES[connect_error_code(e)])
+            survivor_log.info('direct connect to %s:%s failed: %s', parser.addr, parser.port, e)
+            if not self.transport.is_closing():
+                self.reject(connect_error_code(e))
+            return
+        if self.transport.is_closing():
+            transport.close()
+            return
+        connect_results.inc(1, 'success')
+        if self.trace:
+            self.trace.mark('connected')
+        reply = RSP_HTTP_ESTABLISHED if parser.http else socks_reply(REP_SUCCESS, sock.getsockname())
+        self.transport.write(reply)
+        self.other_transport = transport
+        transport.write(self.pending)
+        self.pending = None
+        self.handshake_finished()
+        if self.eof:
+            transport.write_eof()
+        if IDLE_TIMEOUT > 0:
+            self.idle_watch = IdleWatch(IDLE_TIMEOUT, self.idle_expired, self, protocol)
+        self.transport.resume_reading()
+
+    def request_ready(self):
+        self.early_handle = None
+        if self.assign_rescuer():
+            pass
+        elif wait_queue.put(self):
+            if self.trace:
+                self.trace.mark('queued')
+            survivor_log.debug('no idle rescuer, client queued')
+            if worker_group:
+                worker_group.request_link()
+        else:
+            survivor_log.warning('no idle rescuer and the wait queue is full')
+            connect_results.inc(1, 'no_rescuer')
+            self.reject()
+
+    def register_rescuer(self, key):
+        self.is_rescuer = True
+        self.stop_handshake_timer()
+        self.byte_count = downstream_bytes
+        if self.trace:
+            recorder.discard(self.trace)
+            self.trace = None
+        set_keepalive(self.transport.get_extra_info('socket'))
+        # the rescuer times the link out by our pings, not by its own settings
+        self.transport.write(CTL_HEARTBEAT + struct.pack(
+            '>II', int(HEARTBEAT_INTERVAL * 1000), int(HEARTBEAT_TIMEOUT * 1000)))
+        rescuer_registry.add(self, key)
+        self.schedule_heartbeat()
+        waiter = wait_queue.take()
+        if waiter:
+            waiter.assign_rescuer()
+        elif worker_group:
+            worker_group.offer_link()
+
+    # Detaches this idle link from the loop for another worker; the
+    # duplicated descriptor keeps the connection open.  What the rescuer
+    # offered in its hello travels with the key.
+    def hand_off(self):
+        rescuer_registry.remove(self)
+        self.stop_heartbeat()
+        fd = os.dup(self.transport.get_extra_info('socket').fileno())
+        self.handed_off = True
+        self.transport.abort()
+        key = self.rescuer_host.key
+        if self.compress_offered:
+            key += ' compress'
+        return fd, key
+
+    def assign_rescuer(self):
+        if mux_links:
+            link = min(mux_links, key=lambda l: len(l.streams))
+            self.other_transport = link.open_stream(LocalStreamProtocol(self.transport, self.optimistic))
+            compressing = link.compress_offered
+            if logs.dump_payloads:
+                logs.dump('send to mux rescuer', self.pending)
+        elif rescuer_registry:
+            other = rescuer_registry.pop()
+            other.stop_heartbeat()
+            self.other_transport = other.transport
+            other.other_transport = self.transport
+            other.assigned_at = self.loop.time()
+            other.client_http = self.parser.http
+            other.optimistic = self.optimistic
+            compressing = other.compress_offered
+            if self.trace:
+                other.trace = self.trace
+                self.trace.info['rescuer'] = other.rescuer_host.key
+            if logs.dump_payloads:
+                logs.dump('send to rescuer', self.pending)
+            wanted = pool_demand.link_assigned(len(rescuer_registry))
+            if wanted and rescuer_registry:
+                rescuer_registry.peek().transport.write(CTL_POOL + struct.pack('>H', wanted))
+                pool_log.debug('ask rescuers for %d idle links', wanted)
+        else:
+            return False
+        if self.trace:
+            self.trace.mark('assigned')
+        if COMPRESS and compressing:
+            self.start_compression()
+        self.other_transport.write(self.pending)
+        self.pending = None
+        self.handshake_finished()
+        if self.eof:
+            self.other_transport.write_eof()
+        if IDLE_TIMEOUT > 0:
+            self.idle_watch = IdleWatch(IDLE_TIMEOUT, self.idle_expired,
+                                        self, self.other_transport.get_protocol())
+        self.transport.resume_reading()
+        return True
+
+    # Flags the request and frames what follows it; the rescuer frames its
+    # reply and everything after it from then on.
+    def start_compression(self):
+        self.deflater = Deflater(COMPRESS_LEVEL)
+        self.other_transport.get_protocol().inflater = Inflater()
+        request = self.pending[:self.request_size]
+        request[2] |= CONNECT_COMPRESS
+        rest = self.pending[self.request_size:]
+        self.pending = request + self.deflater.pack(rest) if rest else request
+
+    def stop_handshake_timer(self):
+        if self.handshake_timer:
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+
+    def handshake_expired(self):
+        self.handshake_timer = None
+        survivor_log.info('no handshake from %s in time', self.transport.get_extra_info('peername'))
+        self.transport.abort()
+
+    def idle_expired(self):
+        self.idle_watch = None
+        survivor_log.info('stream of %s idle, closed', self.transport.get_extra_info('peername'))
+        self.transport.abort()
+        self.other_transport.abort()
+
+    def wait_timeout(self):
+        survivor_log.warning('no rescuer became idle in time')
+        connect_results.inc(1, 'no_rescuer')
+        self.reject()
+
+    # Answers a client that will not get a rescuer, then half-closes so the
+    # reply is not lost to a reset if the client is still sending.
+    def reject(self, rep=REP_GENERAL_FAILURE):
+        self.rejected = True
+        if self.trace:
+            self.trace.mark('rejected')
+        if self.optimistic:
+            # told success already, all the client can get now is a reset
+            reset_transport(self.transport)
+            return
+        if self.parser.http:
+            if rep == REP_NOT_ALLOWED:
+                reply = b'HTTP/1.1 403 Forbidden\r\n\r\n'
+            else:
+                reply = b'HTTP/1.1 503 Service Unavailable\r\n\r\n'
+        else:
+            reply = socks_reply(rep)
+        self.transport.write(reply)
+        if logs.dump_payloads:
+            logs.dump('send to local', reply)
+        close_after_reply(self.transport, 5)
+
+    def control_received(self, data):
+        while data[0:1] == b'\xff':
+            if data[0:3] == CTL_RETIRE:
+                if rescuer_registry.remove(self):
+                    self.stop_heartbeat()
+                    self.transport.close()
+                    pool_log.debug('idle rescuer retired')
+            elif data[0:3] == CTL_PONG:
+                # a pong may still arrive after the link was handed out
+                if self in rescuer_registry:
+                    rescuer_registry.confirm(self)
+                    self.schedule_heartbeat()
+            else:
+                break
+            data = data[3:]
+        return data
+
+    def schedule_heartbeat(self):
+        self.stop_heartbeat()
+        if HEARTBEAT_INTERVAL > 0:
+            self.heartbeat_handle = self.loop.call_later(HEARTBEAT_INTERVAL, self.send_ping)
+
+    def stop_heartbeat(self):
+        if self.heartbeat_handle:
+            self.heartbeat_handle.cancel()
+            self.heartbeat_handle = None
+
+    def send_ping(self):
+        self.transport.write(CTL_PING)
+        rescuer_registry.suspect(self)
+        self.heartbeat_handle = self.loop.call_later(HEARTBEAT_TIMEOUT, self.heartbeat_missed)
+
+    def heartbeat_missed(self):
+        self.heartbeat_handle = None
+        if rescuer_registry.remove(self):
+            survivor_log.info('idle rescuer %s missed its heartbeat, evicted', self.rescuer_host.key)
+            self.transport.abort()
+
+    # Feeds the rescuer's health: the first reply byte gives the round trip
+    # through the tunnel, the reply code whether the rescuer could connect.
+    # Returns the data to pass on to the client; an optimistic client got
+    # its reply already, so the rescuer's is taken off, and if the connect
+    # failed after all the client is reset.
+    def reply_received(self, data):
+        if not self.reply_head:
+            rtt = self.loop.time() - self.assigned_at
+            rescuer_registry.record_rtt(self.rescuer_host, rtt)
+            handshake_seconds.observe(rtt)
+            if self.trace:
+                self.trace.mark('reply')
+        if self.optimistic:
+            self.reply_head += data
+            reply = split_reply(self.reply_head)
+            if reply is None:
+                return b''
+            rep, data = reply
+            success = rep == REP_SUCCESS
+            reply = REP_NAMES.get(rep, str(rep))
+        elif self.client_http:
+            self.reply_head += data[:16]
+            if len(self.reply_head) < 12:
+                return data
+            success = self.reply_head[9:12] == b'200'
+            reply = 'success' if success else 'http_' + self.reply_head[9:12].decode('latin-1')
+        else:
+            # 05 REP, the greeting was answered locally
+            self.reply_head += data[:16]
+            if len(self.reply_head) < 2:
+                return data
+            success = self.reply_head[1] == 0
+            reply = REP_NAMES.get(self.reply_head[1], str(self.reply_head[1]))
+        connect_results.inc(1, reply)
+        rescuer_registry.record_connect(self.rescuer_host, success)
+        if self.trace:
+            self.trace.info['reply'] = reply
+            # the reply is through, what follows is payload
+            self.first_byte_event = 'first_downstream'
+            self.other_transport.get_protocol().first_byte_event = 'first_upstream'
+        self.assigned_at = None
+        if self.optimistic and not success:
+            reset_transport(self.other_transport)
+            self.transport.close()
+            return b''
+        return data
+
+    def pause_writing(self):
+        if self.other_transport:
+            self.other_transport.pause_reading()
+
+    def resume_writing(self):
+        if self.other_transport:
+            self.other_transport.resume_reading()
+
+    # A client's FIN travels to the remote and the remote's back; a client
+    # still waiting for a rescuer has it passed on with its request.
+    def eof_received(self):
+        if self.other_transport:
+            return relay_eof(self, self.other_transport)
+        if self.pending is not None and not self.rejected:
+            self.eof = True
+            return True
+        return False
 
     def connection_lost(self, exc):
+        self.stop_handshake_timer()
+        if self.idle_watch:
+            self.idle_watch.cancel()
+        if self.client is not None:
+            admission_control.release(self.client, self.handshaking)
         if self.other_transport:
             self.other_transport.close()
         if self.is_rescuer:
-            if self in rescuer_protocols:
-                rescuer_protocols.remove(self)
-            print('rescuer client closed the connection')
+            self.stop_heartbeat()
+            if not rescuer_registry.remove(self) and self.other_transport:
+                rescuer_registry.stream_closed(self.rescuer_host)
+            if self.handed_off:
+                survivor_log.debug('idle rescuer handed to another worker')
+            else:
+                survivor_log.debug('rescuer closed the connection')
         else:
-            print('local client closed the connection')
+            wait_queue.remove(self)
+            if self.early_handle:
+                self.early_handle.cancel()
+            if self.trace:
+                recorder.finish(self.trace)
+            survivor_log.debug('local client closed the connection')
+
+
+class SurvivorMuxProtocol(MuxProtocol):
+    compress_offered = False
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self in mux_links:
+            mux_links.remove(self)
+        survivor_log.info('mux rescuer closed the connection')
+
+
+class LocalStreamProtocol(asyncio.Protocol):
+    local_transport = None
+    reply_head = None
+    inflater = None
+    idle = False
+    eof = False
+
+    def __init__(self, transport: Transport, optimistic=False):
+        self.local_transport = transport
+        if optimistic:
+            # the client has its reply, the rescuer's is only checked
+            self.reply_head = b''
+
+    def connection_made(self, transport):
+        transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+
+    def data_received(self, data):
+        downstream_bytes.value += len(data)
+        self.idle = False
+        if logs.dump_payloads:
+            logs.dump('recv from mux rescuer', data)
+        if self.inflater:
+            try:
+                data = self.inflater.feed(data)
+            except CompressError as e:
+                survivor_log.warning('bad compressed stream from mux rescuer: %s', e)
+                self.local_transport.abort()
+                return
+            if not data:
+                return
+        if self.reply_head is not None:
+            self.reply_head += data
+            reply = split_reply(self.reply_head)
+            if reply is None:
+                return
+            self.reply_head = None
+            rep, data = reply
+            if rep != REP_SUCCESS:
+                reset_transport(self.local_transport)
+                return
+            if not data:
+                return
+        self.local_transport.write(data)
 
+    def pause_writing(self):
+        self.local_transport.pause_reading()
 
-class RemoteClientProtocol(asyncio.Protocol):
+    def resume_writing(self):
+        self.local_transport.resume_reading()
+
+    def eof_received(self):
+        return relay_eof(self, self.local_transport)
+
+    def connection_lost(self, exc):
+        self.local_transport.close()
+
+
+class RemoteClientProtocol(BufferedRelayProtocol):
+    byte_count = downstream_bytes
     transport = None
     survivor_transport = None
 
-    def __init__(self, transport: Transport):
+    # a compressed stream shares the deflater its replies went through
+    def __init__(self, transport: Transport, deflater=None):
         self.survivor_transport = transport
+        self.deflater = deflater
+
+    def relay_peer(self):
+        return None if self.deflater else self.survivor_transport
 
     def connection_made(self, transport: Transport):
+        global remote_active, remote_connects
+        remote_active += 1
+        remote_connects += 1
         self.transport = transport
-        print('connect to remote server successful.')
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        remote_log.debug('connected to %s', transport.get_extra_info('peername'))
 
     def data_received(self, data):
-        print('recv from remote: ', data)
-        self.survivor_transport.write(data)
-        print('send to survivor: ', data)
+        if logs.dump_payloads:
+            logs.dump('recv from remote', data)
+        self.survivor_transport.write(self.deflater.pack(data) if self.deflater else data)
+
+    def pause_writing(self):
+        self.survivor_transport.pause_reading()
+
+    def resume_writing(self):
+        self.survivor_transport.resume_reading()
+
+    def eof_received(self):
+        return relay_eof(self, self.survivor_transport)
 
     def connection_lost(self, exc):
+        global remote_active
+        remote_active -= 1
         self.survivor_transport.close()
-        print('remote server connection closed.')
+        remote_log.debug('remote connection closed')
 
 
-class RescuerClientProtocol(asyncio.Protocol):
-    socket5_flag = False
-    http_flag = False
+class RescuerClientProtocol(BufferedRelayProtocol):
+    byte_count = upstream_bytes
+    busy = False
     transport = None
     remote_transport = None
+    heartbeat_handle = None
+    handshake_timer = None
+    idle_watch = None
+    deflater = None
+    inflater = None
 
     def __init__(self, loop, addr, port):
         self.loop = loop
         self.addr = addr
         self.port = port
+        self.parser = HandshakeParser()
+        self.early_data = bytearray()
+        self.control = b''
+        # until the survivor tells its own
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+        self.heartbeat_timeout = HEARTBEAT_TIMEOUT
 
     def connection_made(self, transport: Transport):
         self.transport = transport
-        self.transport.write(RSP_RESCUER)
-        print('connect to survivor server successful.')
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        set_keepalive(self.transport.get_extra_info('socket'))
+        self.transport.write(RSP_RESCUER_COMPRESS if COMPRESS else RSP_RESCUER)
+        rescuer_pool.link_made(self)
+        self.expect_heartbeat()
+        rescuer_log.debug('connected to survivor')
 
     def data_received(self, data):
-        print('recv from survivor: ', data)
-        data = bytearray(data)
+        if logs.dump_payloads:
+            logs.dump('recv from survivor', data)
+
+        if not self.busy:
+            data = self.control_received(self.control + data)
+            if not data:
+                self.expect_heartbeat()
+                return
+            self.busy = True
+            self.stop_heartbeat()
+            rescuer_pool.link_busy(self)
+            self.trace = recorder.start('rescuer')
+            if self.trace:
+                self.trace.mark('assigned')
+            self.start_handshake_timer()
 
+        if self.inflater:
+            data = self.inflate(data)
+            if not data:
+                return
         if self.remote_transport:
             self.remote_transport.write(data)
-            print('send to remote: ', data)
             return
-        elif data[0] == 5:
-            self.socket5_flag = True
-        elif len(data) > 8 and data[0:7] == b'CONNECT':
-            self.http_flag = True
-
-        if self.socket5_flag:
-            self.socket5_flag = False
+        elif self.parser.done:
+            # still connecting, keep what the client pipelined up to the
+            # limit, then stop reading until the remote takes it
+            self.early_data += data
+            if len(self.early_data) > PENDING_LIMIT:
+                self.transport.pause_reading()
+            return
 
-            if len(data) >= 2 and (data[1] + 2 == len(data) or (len(data) > data[1] + 2 and data[data[1] + 2] == 5)):
-                del data[0:data[1] + 2]
+        try:
+            events = self.parser.feed(data)
+        except HandshakeError as e:
+            rescuer_log.warning('bad handshake: %s', e)
+            self.transport.close()
+            return
+        for event in events:
+            if event == GREETING:
+                if self.trace:
+                    self.trace.mark('greeting')
                 self.transport.write(RSP_SOCKET5_VERSION)
-                print('send to survivor: ', RSP_SOCKET5_VERSION)
-
-            if len(data) < 4:
-                return
-            tpm_data = data[0:4]
-            del data[0:4]
-            mode = tpm_data[1]
-            if mode == CMD_CONNECT:  # 1. Tcp connect
-                atyp = tpm_data[3]
-                if atyp == ADD_RTYPE_IPV4:  # IPv4
-                    addr = socket.inet_ntoa(data[0:4])
-                    del data[0:4]
-                elif atyp == ADD_RTYPE_DOMAIN:  # Domain name
-                    addr = data[1:1 + data[0]]  # self.rfile.read(sock.recv(1)[0])
-                    del data[0:1 + data[4]]
+            elif event == REQUEST:
+                self.stop_handshake_timer()
+                if self.trace:
+                    self.trace.mark('request')
+                    self.trace.info['target'] = '{}:{}'.format(self.parser.addr, self.parser.port)
+                if self.parser.compress:
+                    self.deflater = Deflater(COMPRESS_LEVEL)
+                    self.inflater = Inflater()
+                    self.early_data += self.inflate(self.parser.rest)
                 else:
-                    self.transport.write(RSP_ADDRESS_TYPE_NOT_SUPPORTED)
-                    print('send to survivor : ', RSP_ADDRESS_TYPE_NOT_SUPPORTED)
-                    print('RSP_ADDRESS_TYPE_NOT_SUPPORTED')
-                    return
-                port = struct.unpack('>H', data[0:2])
-                del data[0:2]
-
-                def callback(transport, protocol):
-                    remote = transport.get_extra_info('sockname')
-                    reply = RSP_SUCCESS + socket.inet_aton(remote[0]) + struct.pack('>H', remote[1])
-                    self.remote_transport = transport
-                    self.transport.write(reply)
-                    print('send to survivor: ', reply)
-
-                return self.loop.create_task(connect_remote(self, addr, port[0], callback))
-            elif mode == CMD_BIND:
-                print('unsupported CMD_BIND')
-            elif mode == CMD_UDP_ASSOCIATE:
-                print('unsupported CMD_UDP_ASSOCIATE')
+                    self.early_data += self.parser.rest
+                self.request_received()
+
+    def inflate(self, data):
+        try:
+            return self.inflater.feed(data)
+        except CompressError as e:
+            rescuer_log.warning('bad compressed stream: %s', e)
+            self.transport.abort()
+            return b''
+
+    # what goes back to the survivor once the request asked for compression
+    def pack(self, data):
+        return self.deflater.pack(data) if self.deflater else data
+
+    # Handles the control messages a survivor sends on an idle link and
+    # returns the client data following them.
+    def control_received(self, data):
+        self.control = b''
+        while data[0:1] == b'\xff':
+            if data[0:2] == CONNECT_REQUEST:
+                # the stream starts
+                break
+            if len(data) < 3 or data[0:3] == CTL_POOL and len(data) < 5 \
+                    or data[0:3] == CTL_HEARTBEAT and len(data) < 11:
+                self.control = data
+                return b''
+            if data[0:3] == CTL_PING:
+                self.transport.write(CTL_PONG)
+                data = data[3:]
+            elif data[0:3] == CTL_POOL:
+                wanted = struct.unpack('>H', data[3:5])[0]
+                pool_log.debug('survivor wants %d idle links', wanted)
+                # every shard keeps its share of the idle links
+                rescuer_pool.hint(math.ceil(wanted / shard_count))
+                data = data[5:]
+            elif data[0:3] == CTL_HEARTBEAT:
+                interval, timeout = struct.unpack('>II', data[3:11])
+                self.heartbeat_interval = interval / 1000
+                self.heartbeat_timeout = timeout / 1000
+                data = data[11:]
             else:
-                self.transport.write(RSP_COMMAND_NOT_SUPPORTED)
-                print('send to survivor: ', RSP_COMMAND_NOT_SUPPORTED)
-                print('RSP_COMMAND_NOT_SUPPORTED')
-                return
-        elif self.http_flag:
-            data_str = data.decode()
-            _, remote, _ = data_str.split(' ')
-            addr, port = remote.split(':')
+                rescuer_log.warning('unknown control message %s', logs.hexdump(data))
+                self.transport.close()
+                return b''
+        return data
+
+    def relay_peer(self):
+        return self.remote_transport if self.busy and not self.inflater else None
+
+    def retire(self):
+        self.transport.write(CTL_RETIRE)
+        pool_log.debug('retire idle link')
+
+    # The survivor pings idle links every interval it announced with
+    # CTL_HEARTBEAT; an idle link that heard nothing for two intervals is
+    # presumed dead and redialed.  A survivor that does not ping is not
+    # waited for.
+    def expect_heartbeat(self):
+        self.stop_heartbeat()
+        if self.heartbeat_interval > 0:
+            self.heartbeat_handle = self.loop.call_later(
+                2 * self.heartbeat_interval + self.heartbeat_timeout, self.heartbeat_lost)
+
+    def stop_heartbeat(self):
+        if self.heartbeat_handle:
+            self.heartbeat_handle.cancel()
+            self.heartbeat_handle = None
+
+    def heartbeat_lost(self):
+        self.heartbeat_handle = None
+        rescuer_log.info('survivor heartbeat lost')
+        self.transport.abort()
+
+    # a stream that started must bring its request along
+    def start_handshake_timer(self):
+        if HANDSHAKE_TIMEOUT > 0:
+            self.handshake_timer = wheel.call_later(HANDSHAKE_TIMEOUT, self.handshake_expired)
 
+    def stop_handshake_timer(self):
+        if self.handshake_timer:
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+
+    def handshake_expired(self):
+        self.handshake_timer = None
+        rescuer_log.info('no request in time')
+        self.transport.abort()
+
+    def idle_expired(self):
+        self.idle_watch = None
+        rescuer_log.info('stream to %s:%s idle, closed', self.parser.addr, self.parser.port)
+        self.transport.abort()
+        self.remote_transport.abort()
+
+    def request_received(self):
+        parser = self.parser
+        if parser.http:
             def callback(transport, protocol):
-                remote = transport.get_extra_info('sockname')
-                reply = b'HTTP/1.0 200 Connection established\r\n\r\n'
-                self.remote_transport = transport
-                self.transport.write(reply)
-                print('send to survivor: ', reply)
+                reply = RSP_HTTP_ESTABLISHED
+                self.remote_connected(transport, reply)
 
-            return self.loop.create_task(connect_remote(self, addr, port, callback))
-            pass
+            return self.loop.create_task(connect_remote(self, parser.addr, parser.port, callback))
+
+        mode = parser.cmd
+        if mode == CMD_CONNECT:  # 1. Tcp connect
+            def callback(transport, protocol):
+                reply = socks_reply(0, transport.get_extra_info('sockname'))
+                self.remote_connected(transport, reply)
+
+            return self.loop.create_task(connect_remote(self, parser.addr, parser.port, callback))
+        elif mode == CMD_BIND:
+            rescuer_log.info('unsupported CMD_BIND')
+        elif mode == CMD_UDP_ASSOCIATE:
+            rescuer_log.info('unsupported CMD_UDP_ASSOCIATE')
         else:
-            print('unknown data.')
+            self.transport.write(self.pack(RSP_COMMAND_NOT_SUPPORTED))
+            rescuer_log.info('command %d not supported', mode)
+
+    def remote_connected(self, transport, reply):
+        self.remote_transport = transport
+        # before the early data goes out, which may pause reading again
+        self.transport.resume_reading()
+        if self.trace:
+            self.first_byte_event = 'first_upstream'
+            protocol = transport.get_protocol()
+            protocol.trace = self.trace
+            protocol.first_byte_event = 'first_downstream'
+        self.transport.write(self.pack(reply))
+        if logs.dump_payloads:
+            logs.dump('send to survivor', reply)
+        if self.early_data:
+            transport.write(self.early_data)
+            if logs.dump_payloads:
+                logs.dump('send to remote', self.early_data)
+            self.early_data = bytearray()
+        if self.eof:
+            transport.write_eof()
+        if IDLE_TIMEOUT > 0:
+            self.idle_watch = IdleWatch(IDLE_TIMEOUT, self.idle_expired, self, transport.get_protocol())
+
+    def remote_failed(self, exc):
+        if self.parser.http:
+            reply = b'HTTP/1.0 502 Bad Gateway\r\n\r\n'
+        else:
+            reply = connect_error_reply(exc)
+        self.transport.write(self.pack(reply))
+        if logs.dump_payloads:
+            logs.dump('send to survivor', reply)
+        self.transport.close()
+
+    def pause_writing(self):
+        if self.remote_transport:
+            self.remote_transport.pause_reading()
+
+    def resume_writing(self):
+        if self.remote_transport:
+            self.remote_transport.resume_reading()
+
+    # an idle link that ends is just lost, a stream's FIN goes to the remote,
+    # after the connect if that is still under way
+    def eof_received(self):
+        if self.remote_transport:
+            return relay_eof(self, self.remote_transport)
+        if self.busy and self.parser.done:
+            self.eof = True
+            return True
+        return False
+
+    def stop_timers(self):
+        self.stop_handshake_timer()
+        if self.idle_watch:
+            self.idle_watch.cancel()
 
     def connection_lost(self, exc):
+        self.stop_heartbeat()
+        self.stop_timers()
         if self.remote_transport:
             self.remote_transport.close()
-        self.loop.create_task(connect_survivor(self.loop, self.addr, self.port))
-        print('survivor server connection closed.')
+        if self.trace:
+            recorder.finish(self.trace)
+        rescuer_pool.link_lost(self)
+        rescuer_log.debug('survivor connection closed')
+
+
+class RescuerStreamProtocol(RescuerClientProtocol):
+    busy = True
+
+    def connection_made(self, transport: Transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        self.trace = recorder.start('rescuer')
+        if self.trace:
+            self.trace.mark('assigned')
+        self.start_handshake_timer()
+
+    def data_received(self, data):
+        # fed by the mux link, not by a transport of its own
+        upstream_bytes.value += len(data)
+        self.idle = False
+        if self.first_byte_event is not None:
+            self.trace.mark(self.first_byte_event)
+            self.first_byte_event = None
+        super().data_received(data)
+
+    def connection_lost(self, exc):
+        self.stop_timers()
+        if self.remote_transport:
+            self.remote_transport.close()
+        if self.trace:
+            recorder.finish(self.trace)
+
+
+class RescuerMuxProtocol(MuxProtocol):
+
+    def __init__(self, loop, addr, port):
+        super().__init__(loop, lambda stream: RescuerStreamProtocol(loop, addr, port))
+        self.addr = addr
+        self.port = port
 
+    def connection_made(self, transport: Transport):
+        super().connection_made(transport)
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        set_keepalive(self.transport.get_extra_info('socket'))
+        self.transport.write(RSP_RESCUER_MUX_COMPRESS if COMPRESS else RSP_RESCUER_MUX)
+        self.start_heartbeat(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT)
+        rescuer_pool.link_made(self)
+        rescuer_log.info('connected to survivor (mux)')
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        rescuer_pool.link_lost(self)
+        rescuer_log.info('mux survivor connection closed')
 
-async def connect_survivor(loop, addr, port):
+
+async def connect_survivor(loop, addr, port, mux=False):
+    if mux:
+        await loop.create_connection(
+            lambda: RescuerMuxProtocol(loop, addr, port),
+            addr, port)
+        return
     await loop.create_connection(
         lambda: RescuerClientProtocol(loop, addr, port),
         addr, port)
 
 
 async def connect_remote(local: RescuerClientProtocol, addr, port, callback):
-    transport, protocol = await local.loop.create_connection(
-        lambda: RemoteClientProtocol(local.transport),
-        addr, port)
+    started = local.loop.time()
+    try:
+        addresses = await resolver.resolve(addr)
+        if local.trace:
+            local.trace.mark('resolved')
+        # the client's first bytes can ride in the SYN (TCP Fast Open)
+        early_data = local.early_data if local.parser.fast_open else None
+        sock = await happy_connect(local.loop, addresses, port, early_data=early_data)
+        transport, protocol = await local.loop.create_connection(
+            lambda: RemoteClientProtocol(local.transport, local.deflater),
+            sock=sock)
+    except OSError as e:
+        connect_seconds.observe(local.loop.time() - started)
+        connect_results.inc(1, REP_NAMES[connect_error_code(e)])
+        if local.trace:
+            local.trace.mark('failed')
+            local.trace.info['reply'] = REP_NAMES[connect_error_code(e)]
+        remote_log.info('connect to %s:%s failed: %s', addr, port, e)
+        return local.remote_failed(e)
+    connect_seconds.observe(local.loop.time() - started)
+    connect_results.inc(1, 'success')
+    if local.trace:
+        local.trace.mark('connected')
     callback(transport, protocol)
 
 
-def survivor(port):
+def lend_rescuer():
+    link = rescuer_registry.peek()
+    return link.hand_off() if link else None
+
+
+def adopt_rescuer(fd, key):
+    loop = asyncio.get_event_loop()
+
+    async def adopt():
+        sock = socket.socket(fileno=fd)
+        try:
+            transport, protocol = await loop.connect_accepted_socket(
+                lambda: SurvivorServerProtocol(loop), sock)
+        except OSError as e:
+            survivor_log.warning('adopt rescuer failed: %s', e)
+            sock.close()
+            return
+        host_key, _, offers = key.partition(' ')
+        protocol.compress_offered = offers == 'compress'
+        protocol.register_rescuer(host_key)
+        survivor_log.debug('idle rescuer taken over from another worker')
+
+    loop.create_task(adopt())
+
+
+# Every worker or shard process serves its own metrics, worker n on
+# metrics_port + n.
+def serve_metrics(loop, port):
+    index = worker_group.index if worker_group else shard
+    return metrics.serve(loop, metric_registry, port + (index or 0), METRICS_HOST,
+                         {b'/traces': recorder.dumps})
+
+
+def survivor_metrics():
+    metric_registry.gauge('amagant_streams_active', 'Clients relayed through a rescuer',
+                          function=lambda: sum(host.active for host in rescuer_registry.hosts.values())
+                          + sum(len(link.streams) for link in mux_links))
+    metric_registry.gauge('amagant_idle_links', 'Idle rescuer links',
+                          function=lambda: len(rescuer_registry))
+    metric_registry.gauge('amagant_host_idle_links', 'Idle rescuer links by rescuer host', ['host'],
+                          function=lambda: {key: len(host.idle)
+                                            for key, host in rescuer_registry.hosts.items()})
+    metric_registry.gauge('amagant_host_active_streams', 'Clients relayed by rescuer host', ['host'],
+                          function=lambda: {key: host.active for key, host in rescuer_registry.hosts.items()})
+    metric_registry.counter('amagant_host_streams_total', 'Clients handed to each rescuer host', ['host'],
+                            function=lambda: {key: host.streams for key, host in rescuer_registry.hosts.items()})
+    metric_registry.gauge('amagant_host_rtt_seconds', 'Moving average of the handshake RTT by rescuer host',
+                          ['host'],
+                          function=lambda: {key: host.rtt for key, host in rescuer_registry.hosts.items()
+                                            if host.rtt is not None})
+    metric_registry.gauge('amagant_host_success_rate', 'Moving average of the connect success rate by rescuer host',
+                          ['host'],
+                          function=lambda: {key: host.success_rate
+                                            for key, host in rescuer_registry.hosts.items()})
+    metric_registry.counter('amagant_host_connects_total', 'CONNECT replies by rescuer host', ['host'],
+                            function=lambda: {key: host.connects for key, host in rescuer_registry.hosts.items()})
+    metric_registry.counter('amagant_host_connect_failures_total', 'Failed CONNECT replies by rescuer host',
+                            ['host'],
+                            function=lambda: {key: host.failures for key, host in rescuer_registry.hosts.items()})
+    metric_registry.gauge('amagant_mux_links', 'Multiplexed rescuer links',
+                          function=lambda: len(mux_links))
+    metric_registry.gauge('amagant_wait_queue_depth', 'Clients waiting for an idle rescuer',
+                          function=lambda: len(wait_queue))
+    metric_registry.gauge('amagant_wait_queue_max_depth', 'Most clients ever waiting at once',
+                          function=lambda: wait_queue.max_depth)
+    metric_registry.counter('amagant_wait_queue_queued_total', 'Clients that had to wait for a rescuer',
+                            function=lambda: wait_queue.queued)
+    metric_registry.gauge('amagant_wait_queue_max_wait_seconds', 'Longest wait of a client handed a rescuer',
+                          function=lambda: wait_queue.max_wait)
+    metric_registry.counter('amagant_wait_queue_timeouts_total', 'Clients that waited in vain',
+                            function=lambda: wait_queue.timeouts)
+    metric_registry.counter('amagant_wait_queue_rejected_total', 'Clients turned away by a full queue',
+                            function=lambda: wait_queue.rejected)
+    metric_registry.gauge('amagant_admitted_clients', 'Clients admitted and not closed yet',
+                          function=lambda: admission_control.streams)
+    metric_registry.gauge('amagant_admitted_handshakes', 'Admitted clients whose request did not go out yet',
+                          function=lambda: admission_control.handshakes)
+    metric_registry.counter('amagant_shed_total', 'Clients turned away by admission control', ['reason'],
+                            function=lambda: dict(admission_control.shed))
+    if router.path:
+        metric_registry.counter('amagant_route_hits_total', 'Requests matched by each route', ['route', 'target'],
+                                function=lambda: router.table.hits())
+        resolver_metrics()
+    if worker_group:
+        worker_metrics()
+    buffer_metrics()
+    if COMPRESS:
+        compression_metrics()
+
+
+# Idle links and waiting clients are what every worker published in its
+# shared slot; the link counts are this worker's side of the lending.
+def worker_metrics():
+    metric_registry.gauge('amagant_worker_idle_links', 'Idle rescuer links by worker', ['worker'],
+                          function=lambda: {i: worker_group.slot(i)[0] for i in range(worker_group.count)})
+    metric_registry.gauge('amagant_worker_waiting', 'Clients waiting for a rescuer by worker', ['worker'],
+                          function=lambda: {i: worker_group.slot(i)[1] for i in range(worker_group.count)})
+    metric_registry.counter('amagant_worker_links_total', 'Rescuer links asked for, offered, lent and borrowed',
+                            ['event'],
+                            function=lambda: {'requested': worker_group.requested, 'offered': worker_group.offered,
+                                              'lent': worker_group.lent, 'borrowed': worker_group.borrowed})
+
+
+# Read buffers are allocated or reused from the pool; a dropped one was
+# left to a transport that had not flushed it.
+def buffer_metrics():
+    metric_registry.gauge('amagant_read_buffers_free', 'Read buffers waiting in the pool',
+                          function=lambda: len(buffer_pool.free))
+    metric_registry.counter('amagant_read_buffers_total', 'Read buffers handed out', ['source'],
+                            function=lambda: {'allocated': buffer_pool.allocated, 'reused': buffer_pool.reused})
+    metric_registry.counter('amagant_read_buffers_dropped_total', 'Read buffers not returned to the pool',
+                            function=lambda: buffer_pool.dropped)
+
+
+# Deflated bytes shrink from input to output; raw bytes are the ones small
+# writes and bypassed streams send as they are.
+def compression_metrics():
+    metric_registry.counter('amagant_compress_input_bytes_total', 'Bytes deflated for the rescuer links',
+                            function=lambda: compress.stats.input)
+    metric_registry.counter('amagant_compress_output_bytes_total', 'Bytes the deflated ones came to',
+                            function=lambda: compress.stats.output)
+    metric_registry.counter('amagant_compress_raw_bytes_total', 'Bytes of compressed streams sent undeflated',
+                            function=lambda: compress.stats.raw)
+    metric_registry.counter('amagant_compress_seconds_total', 'CPU seconds spent deflating and inflating',
+                            function=lambda: compress.stats.seconds)
+    metric_registry.counter('amagant_compress_bypasses_total', 'Times a stream stopped deflating for a while',
+                            function=lambda: compress.stats.bypasses)
+
+
+# Rescuers resolve every request, a survivor only those routed direct.
+def resolver_metrics():
+    metric_registry.gauge('amagant_dns_cache_entries', 'Names held in the DNS cache',
+                          function=lambda: len(resolver.cache))
+    metric_registry.counter('amagant_dns_cache_hits_total', 'Lookups answered from the cache',
+                            function=lambda: resolver.hits)
+    metric_registry.counter('amagant_dns_cache_misses_total', 'Lookups that went to a nameserver',
+                            function=lambda: resolver.misses)
+    metric_registry.counter('amagant_dns_negative_hits_total', 'Lookups answered by a cached failure',
+                            function=lambda: resolver.negative_hits)
+    metric_registry.counter('amagant_dns_coalesced_total', 'Lookups that joined one already in flight',
+                            function=lambda: resolver.coalesced)
+    metric_registry.counter('amagant_dns_prefetches_total', 'Entries refreshed before they expired',
+                            function=lambda: resolver.prefetches)
+    metric_registry.counter('amagant_dns_fallbacks_total', 'Lookups handed to getaddrinfo',
+                            function=lambda: resolver.fallbacks)
+
+
+def rescuer_metrics():
+    metric_registry.gauge('amagant_streams_active', 'Open remote connections',
+                          function=lambda: remote_active)
+    metric_registry.gauge('amagant_idle_links', 'Idle links to the survivor',
+                          function=lambda: len(rescuer_pool.idle))
+    metric_registry.gauge('amagant_pool_links', 'Links to the survivor',
+                          function=lambda: len(rescuer_pool.links))
+    metric_registry.gauge('amagant_pool_dialing', 'Dials to the survivor in flight',
+                          function=lambda: rescuer_pool.dialing)
+    metric_registry.counter('amagant_pool_dial_failures_total', 'Failed dials to the survivor',
+                            function=lambda: rescuer_pool.failed)
+    metric_registry.gauge('amagant_pool_breaker_open', '1 while the dial circuit is not closed',
+                          function=lambda: int(rescuer_pool.breaker.state != BREAKER_CLOSED))
+    resolver_metrics()
+    buffer_metrics()
+    if COMPRESS:
+        compression_metrics()
+
+
+def survivor(port, queue_size=1024, queue_timeout=10, policy='least-loaded', workers=1,
+             metrics_port=0):
+    global worker_group
+    if workers > 1:
+        worker_group = WorkerGroup(workers)
+        # trace dumps and route reloads reach every worker
+        worker_group.forward_signals(signal.SIGUSR2, *([signal.SIGHUP] if router.path else []))
+        rescuer_registry.listener = worker_group.publish_idle
+        worker_group.run(lambda: serve_survivor(port, queue_size, queue_timeout, policy,
+                                                metrics_port))
+        return
+    serve_survivor(port, queue_size, queue_timeout, policy, metrics_port)
+
+
+def serve_survivor(port, queue_size, queue_timeout, policy, metrics_port=0):
+    global wait_queue
     loop = asyncio.get_event_loop()
+    rescuer_registry.policy = POLICIES[policy]
+    wait_queue = WaitQueue(loop, queue_size, queue_timeout)
+    wait_queue.observer = wait_queue_seconds.observe
+    if worker_group:
+        worker_group.attach(loop, lend_rescuer, adopt_rescuer, lambda: len(wait_queue) > 0)
+        wait_queue.listener = worker_group.publish_waiting
+    recorder.dump_on_signal(loop, TRACE_PATH)
+    if router.path:
+        router.reload_on_signal(loop)
+    if metrics_port:
+        survivor_metrics()
+        serve_metrics(loop, metrics_port)
     # Each client connection will create a new protocol instance
     coro = loop.create_server(
         lambda: SurvivorServerProtocol(loop),
-        '0.0.0.0', port)
+        '0.0.0.0', port, reuse_port=worker_group is not None)
     server = loop.run_until_complete(coro)
 
     # Serve requests until Ctrl+C is pressed
-    print('serving on {}'.format(server.sockets[0].getsockname()))
+    if worker_group:
+        survivor_log.info('worker %d serving on %s', worker_group.index, server.sockets[0].getsockname())
+    else:
+        survivor_log.info('serving on %s', server.sockets[0].getsockname())
     try:
         loop.run_forever()
     except KeyboardInterrupt:
@@ -233,15 +1318,68 @@ def survivor(port):
     loop.close()
 
 
-def rescuer(addr, port):
+def rescuer_stats():
+    return {
+        'shard': shard,
+        'pool': rescuer_pool.stats(),
+        'resolver': resolver.stats(),
+        'remote_active': remote_active,
+        'remote_connects': remote_connects,
+        'compress': compress.stats.stats(),
+    }
+
+
+def report_shard_stats(loop):
+    rescuer_log.info('shard stats: %s', rescuer_stats())
+    loop.call_later(SHARD_STATS_INTERVAL, report_shard_stats, loop)
+
+
+def rescuer(addr, port, mux=False, links=4, min_links=2, max_links=64, idle_links=4,
+            dial_budget=8, shards=1, metrics_port=0):
+    global shard_count
+    if shards > 1:
+        # every shard is a process with its own loop, its own survivor links
+        # and the remote connections behind them
+        shard_count = shards
+        group = WorkerGroup(shards, mesh=False)
+
+        def run_shard():
+            global shard
+            shard = group.index
+
+            def part(n):
+                return math.ceil(n / shards)
+
+            serve_rescuer(addr, port, mux, part(links), part(min_links), part(max_links),
+                          part(idle_links), part(dial_budget), metrics_port)
+
+        group.run(run_shard)
+        return
+    serve_rescuer(addr, port, mux, links, min_links, max_links, idle_links, dial_budget,
+                  metrics_port)
+
+
+def serve_rescuer(addr, port, mux, links, min_links, max_links, idle_links, dial_budget,
+                  metrics_port=0):
+    global rescuer_pool
     loop = asyncio.get_event_loop()
-    coro = loop.create_connection(
-        lambda: RescuerClientProtocol(loop, addr, port),
-        addr, port)
-    print('connect to {}:{}'.format(addr, port))
-    for i in range(10):
-        loop.create_task(connect_survivor(loop, addr, port))
-    loop.run_until_complete(coro)
+    if shard is not None:
+        rescuer_log.info('shard %d connect to %s:%s', shard, addr, port)
+        loop.call_later(SHARD_STATS_INTERVAL, report_shard_stats, loop)
+    else:
+        rescuer_log.info('connect to %s:%s', addr, port)
+    if mux:
+        # a fixed number of multiplexed links, never idle in the pool's sense
+        rescuer_pool = RescuerPool(loop, lambda: connect_survivor(loop, addr, port, mux=True),
+                                   links, links, 0, dial_budget=dial_budget)
+    else:
+        rescuer_pool = RescuerPool(loop, lambda: connect_survivor(loop, addr, port),
+                                   min_links, max_links, idle_links, dial_budget=dial_budget)
+    recorder.dump_on_signal(loop, TRACE_PATH)
+    if metrics_port:
+        rescuer_metrics()
+        serve_metrics(loop, metrics_port)
+    rescuer_pool.start()
     loop.run_forever()
     loop.close()
 
@@ -266,11 +1404,146 @@ if __name__ == '__main__':
                       dest="port",
                       default='1080',
                       help="target/listen port")
+    parser.add_option("-m", "--mux", action="store_true",
+                      dest="mux",
+                      default=False,
+                      help="Carry all streams over a few multiplexed rescuer links")
+    parser.add_option("-n", "--links", action="store", type="int",
+                      dest="links",
+                      default=4,
+                      help="number of multiplexed rescuer links")
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      dest="workers",
+                      default=1,
+                      help="survivor processes sharing the port (SO_REUSEPORT)")
+    parser.add_option("--queue-size", action="store", type="int",
+                      dest="queue_size",
+                      default=1024,
+                      help="clients that may wait for an idle rescuer")
+    parser.add_option("--queue-timeout", action="store", type="float",
+                      dest="queue_timeout",
+                      default=10,
+                      help="seconds a client waits for an idle rescuer")
+    parser.add_option("--policy", action="store", type="choice",
+                      dest="policy",
+                      choices=list(POLICIES),
+                      default='least-loaded',
+                      help="how the survivor picks a rescuer host: " + ", ".join(POLICIES))
+    parser.add_option("--min-links", action="store", type="int",
+                      dest="min_links",
+                      default=2,
+                      help="rescuer links kept open even when idle")
+    parser.add_option("--max-links", action="store", type="int",
+                      dest="max_links",
+                      default=64,
+                      help="upper bound of rescuer links")
+    parser.add_option("--idle-links", action="store", type="int",
+                      dest="idle_links",
+                      default=4,
+                      help="idle rescuer links kept ready ahead of demand")
+    parser.add_option("--shards", action="store", type="int",
+                      dest="shards",
+                      default=1,
+                      help="rescuer processes, each with its own event loop and share of the links")
+    parser.add_option("--dial-budget", action="store", type="int",
+                      dest="dial_budget",
+                      default=8,
+                      help="dials to the survivor that may be in flight at once")
+    parser.add_option("--heartbeat", action="store", type="float",
+                      dest="heartbeat",
+                      default=HEARTBEAT_INTERVAL,
+                      help="seconds between heartbeats on idle rescuer links, 0 to disable")
+    parser.add_option("--heartbeat-timeout", action="store", type="float",
+                      dest="heartbeat_timeout",
+                      default=HEARTBEAT_TIMEOUT,
+                      help="seconds to wait for a heartbeat answer before dropping the link")
+    parser.add_option("--idle-timeout", action="store", type="float",
+                      dest="idle_timeout",
+                      default=IDLE_TIMEOUT,
+                      help="close streams that moved no data for this many seconds, 0 to disable")
+    parser.add_option("--handshake-timeout", action="store", type="float",
+                      dest="handshake_timeout",
+                      default=HANDSHAKE_TIMEOUT,
+                      help="drop connections that did not complete their handshake in this many seconds, "
+                           "0 to disable")
+    parser.add_option("--high-water", action="store", type="int",
+                      dest="high_water",
+                      default=WRITE_BUFFER_HIGH,
+                      help="pause the peer once this many bytes are buffered for writing")
+    parser.add_option("--low-water", action="store", type="int",
+                      dest="low_water",
+                      default=WRITE_BUFFER_LOW,
+                      help="resume the peer once the write buffer drained to this size")
+    parser.add_option("--dns-cache", action="store", type="int",
+                      dest="dns_cache",
+                      default=resolver.maxsize,
+                      help="number of names kept in the rescuer's DNS cache")
+    parser.add_option("--dns-prefetch", action="store_true",
+                      dest="dns_prefetch",
+                      default=False,
+                      help="refresh cached names in the background shortly before they expire")
+
+    parser.add_option("--fast-open", action="store_true",
+                      dest="fast_open",
+                      default=False,
+                      help="survivor: answer CONNECT at once and send the client's first bytes with the "
+                           "request; the rescuer puts them into the SYN where TCP Fast Open works")
+    parser.add_option("--routes", action="store", type="string",
+                      dest="routes",
+                      help="survivor: file of 'tunnel|direct|reject TARGET' lines, TARGET a CIDR or a "
+                           "domain with its subdomains; reloaded on SIGHUP")
+    parser.add_option("--metrics-port", action="store", type="int",
+                      dest="metrics_port",
+                      default=0,
+                      help="serve Prometheus metrics on this port, 0 disables (workers and shards use port + n)")
+    parser.add_option("--metrics-host", action="store", type="string",
+                      dest="metrics_host",
+                      default=METRICS_HOST,
+                      help="address of the metrics endpoint")
+    parser.add_option("--trace-size", action="store", type="int",
+                      dest="trace_size",
+                      default=recorder.size,
+                      help="stream traces kept in memory, 0 disables tracing")
+    parser.add_option("--trace-file", action="store", type="string",
+                      dest="trace_file",
+                      default=TRACE_PATH,
+                      help="where SIGUSR2 writes the traces as JSON lines ({pid} is the process id); "
+                           "they are also served on /traces of the metrics endpoint")
+    compress.add_options(parser)
+    admission.add_options(parser)
+    logs.add_options(parser)
 
     (options, args) = parser.parse_args()
+    logs.configure_options(options)
+    admission_control = admission.from_options(options)
+    if options.routes:
+        router.path = options.routes
+        try:
+            router.load()
+        except (OSError, RouteError) as e:
+            parser.error('routes: {}'.format(e))
+    if not 1 <= options.compress_level <= 9:
+        parser.error('--compress-level must be 1 to 9')
+    WRITE_BUFFER_HIGH = options.high_water
+    WRITE_BUFFER_LOW = options.low_water
+    HEARTBEAT_INTERVAL = options.heartbeat
+    HEARTBEAT_TIMEOUT = options.heartbeat_timeout
+    IDLE_TIMEOUT = options.idle_timeout
+    HANDSHAKE_TIMEOUT = options.handshake_timeout
+    resolver.maxsize = options.dns_cache
+    resolver.prefetch = options.dns_prefetch
+    METRICS_HOST = options.metrics_host
+    FAST_OPEN = options.fast_open
+    COMPRESS = options.compress
+    COMPRESS_LEVEL = options.compress_level
+    TRACE_PATH = options.trace_file
+    recorder.resize(options.trace_size)
 
     if options.survivor:
-        survivor(options.port)
+        survivor(options.port, options.queue_size, options.queue_timeout, options.policy,
+                 options.workers, options.metrics_port)
 
     if options.rescuers:
-        rescuer(options.target, options.port)
+        rescuer(options.target, options.port, options.mux, options.links,
+                options.min_links, options.max_links, options.idle_links, options.dial_budget,
+                options.shards, options.metrics_port)
@@ -1,8 +1,13 @@
 import asyncio
-import socket
-import struct
+import logging
 from asyncio import Transport
 
+import logs
+from dialer import happy_connect
+from handshake import HandshakeParser, HandshakeError, REQUEST, socks_reply, connect_error_reply
+from pool import RescuerPool
+from resolver import Resolver
+
 ADD_RTYPE_IPV4 = 1
 ADD_RTYPE_DOMAIN = 3
 ADD_RTYPE_IPV6 = 4
@@ -20,6 +25,11 @@ RSP_COMMAND_NOT_SUPPORTED = b'\x05\x07\x00\x01'
 RSP_ADDRESS_TYPE_NOT_SUPPORTED = b'\x05\x08\x00\x01'
 
 rescuer_protocols = []
+rescuer_pool = None
+resolver = Resolver()
+
+rescuer_log = logging.getLogger('rescuer')
+remote_log = logging.getLogger('remote')
 
 
 class RemoteClientProtocol(asyncio.Protocol):
@@ -31,19 +41,19 @@ class RemoteClientProtocol(asyncio.Protocol):
 
     def connection_made(self, transport: Transport):
         self.transport = transport
-        print('Remote server connect successful.')
+        remote_log.debug('connected to %s', transport.get_extra_info('peername'))
 
     def data_received(self, data):
         self.survivor_transport.write(data)
-        print('Remote data: ', data)
+        if logs.dump_payloads:
+            logs.dump('recv from remote', data)
 
     def connection_lost(self, exc):
         self.survivor_transport.close()
-        print('Remote server closed the connection')
+        remote_log.debug('remote connection closed')
 
 
 class SurvivorClientProtocol(asyncio.Protocol):
-    socket5_flag = False
     transport = None
     remote_transport = None
 
@@ -51,57 +61,52 @@ class SurvivorClientProtocol(asyncio.Protocol):
         self.loop = loop
         self.addr = addr
         self.port = port
+        self.parser = HandshakeParser()
+        self.early_data = bytearray()
 
     def connection_made(self, transport: Transport):
         self.transport = transport
         self.transport.write(RSP_RESCUER)
-        print('Survivor connect successful.')
+        rescuer_pool.link_made(self)
+        rescuer_log.debug('connected to survivor')
 
     def data_received(self, data):
-        print('Survivor data: ', data)
-        data = bytearray(data)
+        if logs.dump_payloads:
+            logs.dump('recv from survivor', data)
+        rescuer_pool.link_busy(self)
 
         if self.remote_transport:
             return self.remote_transport.write(data)
-        elif data[0:3] == b'\x05\x01\x00':
-            del data[0:3]
-            self.socket5_flag = True
-
-        if self.socket5_flag:
-            if len(data) < 4:
-                print('No socket5 bytes')
-                return self.transport.write(RSP_SOCKET5_VERSION)
-            self.socket5_flag = False
-            tpm_data = data[0:4]
-            del data[0:4]
-            mode = tpm_data[1]
-            if mode == CMD_CONNECT:  # 1. Tcp connect
-                atyp = tpm_data[3]
-                if atyp == ADD_RTYPE_IPV4:  # IPv4
-                    addr = socket.inet_ntoa(data[0:4])
-                    del data[0:4]
-                elif atyp == ADD_RTYPE_DOMAIN:  # Domain name
-                    addr = data[1:1 + data[0]]  # self.rfile.read(sock.recv(1)[0])
-                    del data[0:1 + data[4]]
-                else:
-                    print('RSP_ADDRESS_TYPE_NOT_SUPPORTED')
-                    return self.transport.write(RSP_ADDRESS_TYPE_NOT_SUPPORTED)
-                port = struct.unpack('>H', data[0:2])
-                del data[0:2]
-                return self.loop.create_task(connect_remote(self, addr, port[0]))
-            elif mode == CMD_UDP_ASSOCIATE:
-                print('No supported CMD_UDP_ASSOCIATE')
-            else:
-                print('RSP_COMMAND_NOT_SUPPORTED')
-                return self.transport.write(RSP_COMMAND_NOT_SUPPORTED)
+        elif self.parser.done:
+            # still connecting, keep what the client pipelined
+            self.early_data += data
+            return
+
+        try:
+            events = self.parser.feed(data)
+        except HandshakeError as e:
+            rescuer_log.warning('bad handshake: %s', e)
+            return self.transport.close()
+        if REQUEST not in events:
+            return
+        self.early_data += self.parser.rest
+        mode = self.parser.cmd
+        if mode == CMD_CONNECT:  # 1. Tcp connect
+            return self.loop.create_task(connect_remote(self, self.parser.addr, self.parser.port))
+        elif mode == CMD_UDP_ASSOCIATE:
+            rescuer_log.info('unsupported CMD_UDP_ASSOCIATE')
         else:
-            print('Unknown')
+            rescuer_log.info('command %d not supported', mode)
+            return self.transport.write(RSP_COMMAND_NOT_SUPPORTED)
 
     def connection_lost(self, exc):
         if self.remote_transport:
             self.remote_transport.close()
-        self.loop.create_task(connect_survivor(self.loop, self.addr, self.port))
-        print('Survivor closed the connection')
+        rescuer_pool.link_lost(self)
+        rescuer_log.debug('survivor connection closed')
+
+    def retire(self):
+        self.transport.close()
 
 
 async def connect_survivor(loop, addr, port):
@@ -111,14 +116,28 @@ async def connect_survivor(loop, addr, port):
 
 
 async def connect_remote(local: SurvivorClientProtocol, addr, port):
-    transport, protocol = await local.loop.create_connection(
-        lambda: RemoteClientProtocol(local.transport),
-        addr, port)
+    try:
+        addresses = await resolver.resolve(addr)
+        sock = await happy_connect(local.loop, addresses, port)
+        transport, protocol = await local.loop.create_connection(
+            lambda: RemoteClientProtocol(local.transport),
+            sock=sock)
+    except OSError as e:
+        remote_log.info('connect to %s:%s failed: %s', addr, port, e)
+        local.transport.write(connect_error_reply(e))
+        return local.transport.close()
     remote = transport.get_extra_info('sockname')
-    reply = RSP_SUCCESS + socket.inet_aton(remote[0]) + struct.pack('>H', remote[1])
+    if local.parser.http:
+        reply = b'HTTP/1.0 200 Connection established\r\n\r\n'
+    else:
+        reply = socks_reply(0, remote)
     local.remote_transport = transport
     local.transport.write(reply)
-    print('Local send: ', reply)
+    if logs.dump_payloads:
+        logs.dump('send to survivor', reply)
+    if local.early_data:
+        transport.write(local.early_data)
+        local.early_data = bytearray()
 
 
 async def main():
@@ -126,17 +145,16 @@ async def main():
     # low-level APIs.
     loop = asyncio.get_running_loop()
 
+    global rescuer_pool
     on_con_lost = loop.create_future()
     addr, port = '127.0.0.1', 1080
-    transport, protocol = await loop.create_connection(
-        lambda: SurvivorClientProtocol(loop, addr, port),
-        addr, port)
-    for i in range(9):
-        loop.create_task(connect_survivor(loop, addr, port))
+    rescuer_pool = RescuerPool(loop, lambda: connect_survivor(loop, addr, port))
+    rescuer_pool.start()
     try:
         await on_con_lost
     finally:
-        transport.close()
+        rescuer_pool.stop()
 
 
+logs.configure()
 asyncio.run(main())
@@ -1,6 +1,9 @@
 import asyncio
+import logging
 from asyncio import Transport, AbstractEventLoop
 
+import logs
+
 ADD_RTYPE_IPV4 = 1
 ADD_RTYPE_DOMAIN = 3
 ADD_RTYPE_IPV6 = 4
@@ -18,6 +21,8 @@ RSP_ADDRESS_TYPE_NOT_SUPPORTED = b'\x05\x08\x00\x01'
 
 rescuer_protocols = []
 
+survivor_log = logging.getLogger('survivor')
+
 
 class SurvivorServerProtocol(asyncio.Protocol):
     is_rescuer = False
@@ -30,17 +35,19 @@ class SurvivorServerProtocol(asyncio.Protocol):
 
     def connection_made(self, transport: Transport):
         peername = transport.get_extra_info('peername')
-        print('Connection from local {}'.format(peername))
+        survivor_log.debug('connection from %s', peername)
         self.transport = transport
         self.transport.write(RSP_SOCKET5_VERSION)
 
     def data_received(self, data):
         if self.is_rescuer:
-            print('Rescuer data: ', data)
+            if logs.dump_payloads:
+                logs.dump('recv from rescuer', data)
             if self.other_transport:
                 return self.other_transport.write(data)
         else:
-            print('Local data: ', data)
+            if logs.dump_payloads:
+                logs.dump('recv from local', data)
             if self.other_transport:
                 return self.other_transport.write(data)
             elif data[0:3] == b'\x05\x01\x00':
@@ -48,13 +55,12 @@ class SurvivorServerProtocol(asyncio.Protocol):
                     other = rescuer_protocols.pop(-1)
                     self.other_transport = other.transport
                     other.other_transport = self.transport
-                    print('Local send data: ', data)
                     self.other_transport.write(data)
                 else:
-                    print('rescuer list is null')
+                    survivor_log.warning('no idle rescuer')
             elif data[0:3] == b'\xff\x53\x53':
                 self.is_rescuer = True
-                print('new rescuer added. ')
+                survivor_log.debug('new rescuer %s', self.transport.get_extra_info('peername'))
                 rescuer_protocols.append(self)
                 pass
 
@@ -64,9 +70,9 @@ class SurvivorServerProtocol(asyncio.Protocol):
         if self.is_rescuer:
             if self in rescuer_protocols:
                 rescuer_protocols.remove(self)
-            print('Rescuer closed the connection')
+            survivor_log.debug('rescuer closed the connection')
         else:
-            print('Local client closed the connection')
+            survivor_log.debug('local client closed the connection')
 
 
 async def main():
@@ -82,4 +88,5 @@ async def main():
         await server.serve_forever()
 
 
+logs.configure()
 asyncio.run(main())
@@ -1,8 +1,17 @@
 import asyncio
+import logging
 import socket
 import struct
 from asyncio import Transport, AbstractEventLoop
 
+import admission
+import logs
+from admission import Admission, shed_reply, SHED_LINGER
+from handshake import HandshakeParser, HandshakeError, GREETING, REQUEST, connect_error_reply
+from relay import relay_eof, close_after_reply, EARLY_DATA_LIMIT
+from timers import wheel, IdleWatch, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT
+from workers import WorkerGroup
+
 ADD_RTYPE_IPV4 = 1
 ADD_RTYPE_DOMAIN = 3
 ADD_RTYPE_IPV6 = 4
@@ -18,107 +27,216 @@ RSP_CONNECTION_REFUSED = b'\x05\x05\x00\x01'
 RSP_COMMAND_NOT_SUPPORTED = b'\x05\x07\x00\x01'
 RSP_ADDRESS_TYPE_NOT_SUPPORTED = b'\x05\x08\x00\x01'
 
+local_log = logging.getLogger('local')
+remote_log = logging.getLogger('remote')
+
+admission_control = Admission()
+
 
 class EchoClientProtocol(asyncio.Protocol):
     transport = None
     local_transport = None
+    idle = False
+    eof = False
 
     def __init__(self, transport: Transport):
         self.local_transport = transport
 
     def connection_made(self, transport: Transport):
         self.transport = transport
-        print('Remote server connect successful.')
+        remote_log.debug('connected to %s', transport.get_extra_info('peername'))
 
     def data_received(self, data):
+        self.idle = False
         self.local_transport.write(data)
-        print('Remote data: ', data)
+        if logs.dump_payloads:
+            logs.dump('recv from remote', data)
+
+    def eof_received(self):
+        return relay_eof(self, self.local_transport)
 
     def connection_lost(self, exc):
         self.local_transport.close()
-        print('Remote server closed the connection')
+        remote_log.debug('remote connection closed')
 
 
 class EchoServerProtocol(asyncio.Protocol):
-    socket5_flag = False
     transport = None
     remote_transport = None
+    handshake_timer = None
+    idle_watch = None
+    idle = False
+    eof = False
+    # the address the client was admitted for, until it closes
+    client = None
+    handshaking = False
+    rejected = False
 
     def __init__(self, loop: AbstractEventLoop):
         self.loop = loop
+        self.parser = HandshakeParser()
+        self.early_data = bytearray()
 
     def connection_made(self, transport: Transport):
         peername = transport.get_extra_info('peername')
-        print('Connection from local {}'.format(peername))
+        local_log.debug('connection from %s', peername)
         self.transport = transport
-        self.transport.write(RSP_SOCKET5_VERSION)
+        self.handshake_timer = wheel.call_later(HANDSHAKE_TIMEOUT, self.handshake_expired)
+
+    def handshake_expired(self):
+        local_log.info('no handshake from %s in time', self.transport.get_extra_info('peername'))
+        self.transport.abort()
+
+    def idle_expired(self):
+        self.idle_watch = None
+        local_log.info('stream of %s idle, closed', self.transport.get_extra_info('peername'))
+        self.transport.abort()
+        self.remote_transport.abort()
 
     def data_received(self, data):
-        print('Local data: ', data)
-        data = bytearray(data)
+        self.idle = False
+        if logs.dump_payloads:
+            logs.dump('recv from local', data)
 
         if self.remote_transport:
             return self.remote_transport.write(data)
-        elif data[0:3] == b'\x05\x01\x00':
-            del data[0:3]
-            self.socket5_flag = True
-
-        if self.socket5_flag:
-            if len(data) < 4:
-                print('No socket5 bytes')
-                return self.transport.write(RSP_SOCKET5_VERSION)
-            self.socket5_flag = False
-            tpm_data = data[0:4]
-            del data[0:4]
-            mode = tpm_data[1]
-            if mode == CMD_CONNECT:  # 1. Tcp connect
-                atyp = tpm_data[3]
-                if atyp == ADD_RTYPE_IPV4:  # IPv4
-                    addr = socket.inet_ntoa(data[0:4])
-                    del data[0:4]
-                elif atyp == ADD_RTYPE_DOMAIN:  # Domain name
-                    addr = data[1:1 + data[0]]  # self.rfile.read(sock.recv(1)[0])
-                    del data[0:1 + data[4]]
-                else:
-                    print('RSP_ADDRESS_TYPE_NOT_SUPPORTED')
-                    return self.transport.write(RSP_ADDRESS_TYPE_NOT_SUPPORTED)
-                port = struct.unpack('>H', data[0:2])
-                del data[0:2]
-                return self.loop.create_task(connect_remote(self, addr, port[0]))
-            elif mode == CMD_UDP_ASSOCIATE:
-                print('No supported CMD_UDP_ASSOCIATE')
-            else:
-                print('RSP_COMMAND_NOT_SUPPORTED')
-                return self.transport.write(RSP_COMMAND_NOT_SUPPORTED)
+        elif self.rejected:
+            return
+        elif self.client is None and not self.admit(data):
+            return
+        elif self.parser.done:
+            # still connecting, keep what the client pipelined
+            self.early_data += data
+            if len(self.early_data) > EARLY_DATA_LIMIT:
+                self.transport.pause_reading()
+            return
+
+        try:
+            events = self.parser.feed(data)
+        except HandshakeError as e:
+            local_log.warning('bad handshake: %s', e)
+            return self.transport.close()
+        if GREETING in events:
+            self.transport.write(RSP_SOCKET5_VERSION)
+        if REQUEST not in events:
+            return
+        self.early_data += self.parser.rest
+        mode = self.parser.cmd
+        if mode == CMD_CONNECT:  # 1. Tcp connect
+            if self.parser.atyp == ADD_RTYPE_IPV6:
+                local_log.info('IPv6 address not supported')
+                self.transport.write(RSP_ADDRESS_TYPE_NOT_SUPPORTED)
+                return self.transport.close()
+            return self.loop.create_task(connect_remote(self, self.parser.addr, self.parser.port))
+        elif mode == CMD_UDP_ASSOCIATE:
+            local_log.info('unsupported CMD_UDP_ASSOCIATE')
         else:
-            print('Unknown')
+            local_log.info('command %d not supported', mode)
+        self.transport.write(RSP_COMMAND_NOT_SUPPORTED)
+        self.transport.close()
+
+    def admit(self, data):
+        client = self.transport.get_extra_info('peername')[0]
+        reason = admission_control.admit(client)
+        if reason:
+            # answered at once, the rest is dropped
+            self.rejected = True
+            self.handshake_timer.cancel()
+            self.transport.write(shed_reply(data, reason))
+            close_after_reply(self.transport, SHED_LINGER)
+            return False
+        self.client = client
+        self.handshaking = True
+        return True
+
+    # passed on to the remote, once connected if the client half-closed
+    # right after its request
+    def eof_received(self):
+        if self.remote_transport:
+            return relay_eof(self, self.remote_transport)
+        if self.parser.done:
+            self.eof = True
+            return True
+        return False
 
     def connection_lost(self, exc):
-        self.remote_transport.close()
-        print('Local client closed the connection')
+        self.handshake_timer.cancel()
+        if self.idle_watch:
+            self.idle_watch.cancel()
+        if self.client is not None:
+            admission_control.release(self.client, self.handshaking)
+        if self.remote_transport:
+            self.remote_transport.close()
+        local_log.debug('local client closed the connection')
 
 
 async def connect_remote(server: EchoServerProtocol, addr, port):
-    transport, protocol = await server.loop.create_connection(
-        lambda: EchoClientProtocol(server.transport),
-        addr, port)
+    try:
+        transport, protocol = await server.loop.create_connection(
+            lambda: EchoClientProtocol(server.transport),
+            addr, port)
+    except OSError as e:
+        remote_log.info('connect to %s:%s failed: %s', addr, port, e)
+        if not server.transport.is_closing():
+            server.transport.write(connect_error_reply(e))
+            server.transport.close()
+        return
+    if server.transport.is_closing():
+        transport.close()
+        return
+    # anything short of this is caught by the handshake timeout
+    server.handshake_timer.cancel()
+    server.handshaking = False
+    admission_control.handshake_done()
     remote = transport.get_extra_info('sockname')
-    reply = RSP_SUCCESS + socket.inet_aton(remote[0]) + struct.pack('>H', remote[1])
+    if server.parser.http:
+        reply = b'HTTP/1.0 200 Connection established\r\n\r\n'
+    else:
+        reply = RSP_SUCCESS + socket.inet_aton(remote[0]) + struct.pack('>H', remote[1])
     server.remote_transport = transport
+    # before the early data goes out, which may pause reading again
+    server.transport.resume_reading()
     server.transport.write(reply)
+    if server.early_data:
+        transport.write(server.early_data)
+        server.early_data = bytearray()
+    if server.eof:
+        transport.write_eof()
+    server.idle_watch = IdleWatch(IDLE_TIMEOUT, server.idle_expired, server, protocol)
 
 
-async def main():
+async def main(port=1080, reuse_port=False):
     # Get a reference to the event loop as we plan to use
     # low-level APIs.
     loop = asyncio.get_running_loop()
 
     server = await loop.create_server(
         lambda: EchoServerProtocol(loop),
-        '0.0.0.0', 1080)
+        '0.0.0.0', port, reuse_port=reuse_port)
 
     async with server:
         await server.serve_forever()
 
 
-asyncio.run(main())
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser()
+    parser.add_option("-p", "--port", action="store", type="int",
+                      dest="port",
+                      default=1080,
+                      help="listen port")
+    parser.add_option("-w", "--workers", action="store", type="int",
+                      dest="workers",
+                      default=1,
+                      help="processes sharing the port (SO_REUSEPORT)")
+    admission.add_options(parser)
+    logs.add_options(parser)
+    (options, args) = parser.parse_args()
+    logs.configure_options(options)
+    admission_control = admission.from_options(options)
+
+    if options.workers > 1:
+        WorkerGroup(options.workers, mesh=False).run(lambda: asyncio.run(main(options.port, reuse_port=True)))
+    else:
+        asyncio.run(main(options.port))
@@ -0,0 +1,460 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import struct
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+from relay import raise_nofile_limit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Every agent is a list of processes started in order; {port} is the port
+# clients connect to, {python} this interpreter.  The split amagant scripts
+# have no command line and always use port 1080.  magant is missing: its
+# survivor waits for links registered with CMD_REG_SURVIVOR and nothing in
+# the tree registers one, so it cannot carry a CONNECT end to end.
+AGENTS = {
+    's5agant': [['{python}', 's5agant.py', '{port}']],
+    's5agant-splice': [['{python}', 's5agant.py', '{port}', 'splice']],
+    's5agant-copy': [['{python}', 's5agant.py', '{port}', 'copy']],
+    'as5agent': [['{python}', 'as5agent.py', '-p', '{port}']],
+    'amagant': [['{python}', 'amagant.py', '-s', '-p', '{port}'],
+                ['{python}', 'amagant.py', '-r', '-t', '127.0.0.1', '-p', '{port}']],
+    'amagant-mux': [['{python}', 'amagant.py', '-s', '-p', '{port}'],
+                    ['{python}', 'amagant.py', '-r', '-t', '127.0.0.1', '-p', '{port}', '--mux']],
+    'amagant-fast-open': [['{python}', 'amagant.py', '-s', '-p', '{port}', '--fast-open'],
+                          ['{python}', 'amagant.py', '-r', '-t', '127.0.0.1', '-p', '{port}']],
+    'amagant-split': [['{python}', 'amagant_survivor.py'],
+                      ['{python}', 'amagant_rescuer.py']],
+}
+FIXED_PORTS = {
+    'amagant-split': 1080,
+}
+
+SCENARIOS = ['connect', 'bulk', 'latency']
+PROTOCOLS = ['socks5', 'http']
+
+# higher is better for these, lower for everything else that is compared
+RATE_METRICS = ['conns_per_sec', 'mbytes_per_sec', 'msgs_per_sec']
+COMPARED_METRICS = RATE_METRICS + ['p50_ms', 'p99_ms']
+
+DURATION = 5
+CONCURRENCY = 8
+BULK_SIZE = 64 * 1024 * 1024
+MESSAGE_SIZE = 64
+READ_SIZE = 256 * 1024
+STEP_TIMEOUT = 10
+START_TIMEOUT = 15
+
+# upstream commands, the first byte a client sends through the tunnel
+UP_ECHO = b'E'
+UP_DOWNLOAD = b'D'  # + '>Q' bytes to send back
+
+
+# Local upstream: echoes, or streams a requested number of bytes.
+class UpstreamProtocol(asyncio.Protocol):
+    transport = None
+    chunk = bytes(READ_SIZE)
+
+    def __init__(self):
+        self.mode = None
+        self.buffer = b''
+        self.remaining = 0
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.mode == UP_ECHO:
+            self.transport.write(data)
+            return
+        self.buffer += data
+        if self.buffer[:1] == UP_ECHO:
+            self.mode = UP_ECHO
+            if len(self.buffer) > 1:
+                self.transport.write(self.buffer[1:])
+            self.buffer = b''
+        elif self.buffer[:1] == UP_DOWNLOAD and len(self.buffer) >= 9:
+            self.mode = UP_DOWNLOAD
+            self.remaining = struct.unpack('>Q', self.buffer[1:9])[0]
+            self.buffer = b''
+            self.send()
+        elif self.buffer[:1] not in (UP_ECHO, UP_DOWNLOAD, b''):
+            self.transport.close()
+
+    def send(self):
+        while self.remaining > 0 and not self.paused and not self.transport.is_closing():
+            n = min(self.remaining, len(self.chunk))
+            self.transport.write(self.chunk[:n] if n < len(self.chunk) else self.chunk)
+            self.remaining -= n
+        if self.remaining <= 0 and self.mode == UP_DOWNLOAD and not self.transport.is_closing():
+            self.transport.write_eof()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.send()
+
+
+def run_upstream(port, ready):
+    async def serve():
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(UpstreamProtocol, '127.0.0.1', port, backlog=1024)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def latency_summary(samples):
+    return {
+        'samples': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 3) if samples else None,
+        'max_ms': round(max(samples) * 1000, 3) if samples else None,
+    }
+
+
+# Connects to the proxy and asks it for the upstream; returns the streams
+# once the proxy reported success.
+async def open_tunnel(proxy_port, upstream_port, protocol):
+    reader, writer = await asyncio.open_connection('127.0.0.1', proxy_port)
+    try:
+        if protocol == 'socks5':
+            writer.write(b'\x05\x01\x00')
+            if await reader.readexactly(2) != b'\x05\x00':
+                raise ConnectionError('greeting refused')
+            writer.write(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') +
+                         struct.pack('>H', upstream_port))
+            head = await reader.readexactly(4)
+            if head[1] != 0:
+                raise ConnectionError('connect failed with REP {}'.format(head[1]))
+            await reader.readexactly({1: 6, 4: 18}.get(head[3], 6))
+        else:
+            target = '127.0.0.1:{}'.format(upstream_port)
+            writer.write('CONNECT {0} HTTP/1.1\r\nHost: {0}\r\n\r\n'.format(target).encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            if head.split(b' ', 2)[1:2] != [b'200']:
+                raise ConnectionError('connect failed: {!r}'.format(head.split(b'\r\n')[0]))
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+class Run:
+
+    def __init__(self, proxy_port, upstream_port, protocol, concurrency, duration,
+                 bulk_size=BULK_SIZE, message_size=MESSAGE_SIZE):
+        self.proxy_port = proxy_port
+        self.upstream_port = upstream_port
+        self.protocol = protocol
+        self.concurrency = concurrency
+        self.duration = duration
+        self.bulk_size = bulk_size
+        self.message_size = message_size
+        self.deadline = 0
+        self.errors = 0
+        self.last_error = None
+        self.samples = []
+        self.count = 0
+        self.bytes = 0
+
+    def failed(self, exc):
+        self.errors += 1
+        self.last_error = '{}: {}'.format(type(exc).__name__, exc)
+
+    async def tunnel(self):
+        return await asyncio.wait_for(
+            open_tunnel(self.proxy_port, self.upstream_port, self.protocol), STEP_TIMEOUT)
+
+    async def run(self, scenario):
+        worker = getattr(self, scenario + '_worker')
+        started = time.monotonic()
+        self.deadline = started + self.duration
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        elapsed = time.monotonic() - started
+        result = getattr(self, scenario + '_result')(elapsed)
+        result['errors'] = self.errors
+        if self.last_error:
+            result['last_error'] = self.last_error
+        return result
+
+    # new tunnel, one echoed byte, close
+    async def connect_worker(self):
+        while time.monotonic() < self.deadline:
+            started = time.monotonic()
+            writer = None
+            try:
+                reader, writer = await self.tunnel()
+                writer.write(UP_ECHO + b'x')
+                await asyncio.wait_for(reader.readexactly(1), STEP_TIMEOUT)
+                self.samples.append(time.monotonic() - started)
+                self.count += 1
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                self.failed(e)
+                await asyncio.sleep(0.01)
+            finally:
+                if writer:
+                    writer.close()
+
+    def connect_result(self, elapsed):
+        return dict(latency_summary(self.samples), conns_per_sec=round(self.count / elapsed, 1))
+
+    # downloads bulk_size bytes per tunnel until the deadline
+    async def bulk_worker(self):
+        while time.monotonic() < self.deadline:
+            writer = None
+            try:
+                reader, writer = await self.tunnel()
+                writer.write(UP_DOWNLOAD + struct.pack('>Q', self.bulk_size))
+                received = 0
+                while received < self.bulk_size and time.monotonic() < self.deadline:
+                    data = await asyncio.wait_for(reader.read(READ_SIZE), STEP_TIMEOUT)
+                    if not data:
+                        raise EOFError('upstream closed after {} bytes'.format(received))
+                    received += len(data)
+                    self.bytes += len(data)
+                self.count += 1
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                self.failed(e)
+                await asyncio.sleep(0.01)
+            finally:
+                if writer:
+                    writer.close()
+
+    def bulk_result(self, elapsed):
+        return {
+            'mbytes_per_sec': round(self.bytes / elapsed / 1e6, 2),
+            'bytes': self.bytes,
+            'transfers': self.count,
+        }
+
+    # one tunnel, small messages echoed back one at a time
+    async def latency_worker(self):
+        message = bytes(self.message_size)
+        writer = None
+        try:
+            reader, writer = await self.tunnel()
+            writer.write(UP_ECHO)
+            while time.monotonic() < self.deadline:
+                started = time.monotonic()
+                writer.write(message)
+                await asyncio.wait_for(reader.readexactly(len(message)), STEP_TIMEOUT)
+                self.samples.append(time.monotonic() - started)
+                self.count += 1
+        except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self.failed(e)
+        finally:
+            if writer:
+                writer.close()
+
+    def latency_result(self, elapsed):
+        return dict(latency_summary(self.samples), msgs_per_sec=round(self.count / elapsed, 1))
+
+
+class Agent:
+
+    def __init__(self, name):
+        self.name = name
+        self.port = FIXED_PORTS.get(name) or free_port()
+        self.processes = []
+
+    def start(self, upstream_port, protocol):
+        for command in AGENTS[self.name]:
+            args = [arg.format(python=sys.executable, port=self.port) for arg in command]
+            self.processes.append(subprocess.Popen(args, cwd=HERE, stdin=subprocess.DEVNULL,
+                                                   stdout=subprocess.DEVNULL,
+                                                   stderr=subprocess.DEVNULL))
+            time.sleep(0.2)
+        # ready once a whole tunnel works, rescuer links included
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            try:
+                asyncio.run(self.probe(upstream_port, protocol))
+                return
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                if time.monotonic() > deadline or any(p.poll() is not None for p in self.processes):
+                    raise
+                time.sleep(0.2)
+
+    async def probe(self, upstream_port, protocol):
+        reader, writer = await asyncio.wait_for(open_tunnel(self.port, upstream_port, protocol), 2)
+        try:
+            writer.write(UP_ECHO + b'x')
+            await asyncio.wait_for(reader.readexactly(1), 2)
+        finally:
+            writer.close()
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.processes = []
+
+
+def run_benchmarks(options, upstream_port):
+    results = []
+    for name in options.agents:
+        for protocol in options.protocols:
+            agent = Agent(name)
+            try:
+                agent.start(upstream_port, protocol)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                agent.stop()
+                print('{:<18} {:<6} did not start: {}'.format(name, protocol, e))
+                results.append({'agent': name, 'protocol': protocol, 'error': str(e) or type(e).__name__})
+                continue
+            try:
+                for scenario in options.scenarios:
+                    for concurrency in options.concurrency:
+                        run = Run(agent.port, upstream_port, protocol, concurrency, options.duration,
+                                  options.bulk_size, options.message_size)
+                        metrics = asyncio.run(run.run(scenario))
+                        results.append({'agent': name, 'protocol': protocol, 'scenario': scenario,
+                                        'concurrency': concurrency, 'metrics': metrics})
+                        print('{:<18} {:<6} {:<8} c={:<4} {}'.format(
+                            name, protocol, scenario, concurrency, format_metrics(metrics)))
+            finally:
+                agent.stop()
+    return results
+
+
+def format_metrics(metrics):
+    return ' '.join('{}={}'.format(key, value) for key, value in metrics.items()
+                    if key in COMPARED_METRICS or key == 'errors')
+
+
+def result_key(result):
+    return result['agent'], result['protocol'], result.get('scenario'), result.get('concurrency')
+
+
+# Compares every metric both runs have; a rate that dropped or a latency that
+# grew by more than `tolerance` is a regression.  Returns the regressions.
+def compare(results, baseline, tolerance):
+    old = {result_key(r): r for r in baseline['results'] if 'metrics' in r}
+    regressions = []
+    for result in results:
+        previous = old.get(result_key(result))
+        if not previous or 'metrics' not in result:
+            continue
+        for metric in COMPARED_METRICS:
+            now, before = result['metrics'].get(metric), previous['metrics'].get(metric)
+            if not now or not before:
+                continue
+            change = (now - before) / before
+            worse = -change if metric in RATE_METRICS else change
+            flag = 'REGRESSION' if worse > tolerance else ''
+            print('{:<18} {:<6} {:<8} c={:<4} {:<15} {:>10} -> {:>10} {:+7.1%} {}'.format(
+                *result_key(result), metric, before, now, change, flag))
+            if flag:
+                regressions.append((result_key(result), metric, before, now))
+    return regressions
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option("-a", "--agent", action="append", dest="agents",
+                      choices=list(AGENTS),
+                      help="agent to measure (repeatable): " + ", ".join(AGENTS) + "; default all")
+    parser.add_option("-s", "--scenario", action="append", dest="scenarios",
+                      choices=SCENARIOS,
+                      help="scenario to run (repeatable): " + ", ".join(SCENARIOS) + "; default all")
+    parser.add_option("--protocol", action="append", dest="protocols",
+                      choices=PROTOCOLS,
+                      help="client protocol (repeatable): socks5, http; default socks5")
+    parser.add_option("-c", "--concurrency", action="append", type="int", dest="concurrency",
+                      help="concurrent clients (repeatable), default %d" % CONCURRENCY)
+    parser.add_option("-d", "--duration", action="store", type="float", dest="duration",
+                      default=DURATION,
+                      help="seconds per scenario")
+    parser.add_option("--bulk-size", action="store", type="int", dest="bulk_size",
+                      default=BULK_SIZE,
+                      help="bytes per bulk transfer")
+    parser.add_option("--message-size", action="store", type="int", dest="message_size",
+                      default=MESSAGE_SIZE,
+                      help="bytes per latency message")
+    parser.add_option("-o", "--output", action="store", dest="output",
+                      help="write the results as JSON to this file")
+    parser.add_option("-b", "--baseline", action="store", dest="baseline",
+                      help="compare with the results in this JSON file, exit 1 on a regression")
+    parser.add_option("--tolerance", action="store", type="float", dest="tolerance",
+                      default=0.1,
+                      help="relative change tolerated before a metric counts as regressed")
+    (options, args) = parser.parse_args()
+    options.agents = options.agents or list(AGENTS)
+    options.scenarios = options.scenarios or SCENARIOS
+    options.protocols = options.protocols or ['socks5']
+    options.concurrency = options.concurrency or [CONCURRENCY]
+
+    raise_nofile_limit()
+    upstream_port = free_port()
+    ready = multiprocessing.Event()
+    upstream = multiprocessing.Process(target=run_upstream, args=(upstream_port, ready), daemon=True)
+    upstream.start()
+    ready.wait(START_TIMEOUT)
+    try:
+        results = run_benchmarks(options, upstream_port)
+    finally:
+        upstream.terminate()
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': {
+            'duration': options.duration,
+            'bulk_size': options.bulk_size,
+            'message_size': options.message_size,
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('environment') != report['environment']:
+            print('note: baseline was recorded on {}'.format(baseline.get('environment')))
+        if compare(results, baseline, options.tolerance):
+            sys.exit(1)
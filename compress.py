@@ -0,0 +1,127 @@
+import struct
+import time
+import zlib
+
+COMPRESS_LEVEL = 6
+# writes shorter than this go out as they are, deflate saves little on them
+# and interactive traffic stays as fast as without compression
+COMPRESS_MIN_SIZE = 256
+# a stream whose writes keep compressing to more than this fraction of
+# their size stops trying, and tries again after some raw bytes
+BYPASS_RATIO = 0.9
+BYPASS_AFTER = 4
+RESAMPLE_BYTES = 256 * 1024
+
+# payload length, the high bit set when the payload is deflated
+FRAME = struct.Struct('>I')
+FRAME_COMPRESSED = 0x80000000
+FRAME_MAX = 0x7fffffff
+
+
+class CompressError(ValueError):
+    pass
+
+
+# Totals of one process, for the metrics.  `input` bytes were deflated into
+# `output` bytes, `raw` bytes went out undeflated, `seconds` is the CPU
+# time spent in zlib both ways.
+class CompressStats:
+
+    def __init__(self):
+        self.input = 0
+        self.output = 0
+        self.raw = 0
+        self.seconds = 0.0
+        self.bypasses = 0
+
+    def stats(self):
+        return {
+            'input': self.input,
+            'output': self.output,
+            'raw': self.raw,
+            'seconds': self.seconds,
+            'bypasses': self.bypasses,
+        }
+
+
+stats = CompressStats()
+
+
+# One direction of a stream.  Every write becomes one frame; a deflated
+# frame ends with a sync flush, so nothing is held back for the next write.
+# Whether a write is deflated is decided before it reaches zlib, so a raw
+# frame never touches the compressor and both ends keep the same history.
+class Deflater:
+
+    def __init__(self, level=COMPRESS_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        self.misses = 0
+        self.bypassed = 0
+
+    def pack(self, data):
+        size = len(data)
+        if size < COMPRESS_MIN_SIZE or self.bypassed:
+            if self.bypassed:
+                self.bypassed = max(self.bypassed - size, 0)
+            stats.raw += size
+            return FRAME.pack(size) + data
+        started = time.process_time()
+        payload = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        stats.seconds += time.process_time() - started
+        stats.input += size
+        stats.output += len(payload)
+        if len(payload) > size * BYPASS_RATIO:
+            self.misses += 1
+            if self.misses >= BYPASS_AFTER:
+                self.misses = 0
+                self.bypassed = RESAMPLE_BYTES
+                stats.bypasses += 1
+        else:
+            self.misses = 0
+        return FRAME.pack(FRAME_COMPRESSED | len(payload)) + payload
+
+
+# The other end of a Deflater.  feed() takes whatever arrived and returns
+# the bytes of the complete frames in it.
+class Inflater:
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        out = []
+        offset = 0
+        size = len(buffer)
+        while size - offset >= FRAME.size:
+            header = FRAME.unpack_from(buffer, offset)[0]
+            end = offset + FRAME.size + (header & FRAME_MAX)
+            if end > size:
+                break
+            payload = bytes(buffer[offset + FRAME.size:end])
+            offset = end
+            if header & FRAME_COMPRESSED:
+                started = time.process_time()
+                try:
+                    payload = self.decompressor.decompress(payload)
+                except zlib.error as e:
+                    raise CompressError(str(e))
+                stats.seconds += time.process_time() - started
+            out.append(payload)
+        if offset:
+            del buffer[:offset]
+        return b''.join(out)
+
+
+def add_options(parser):
+    parser.add_option("--compress", action="store_true",
+                      dest="compress",
+                      default=False,
+                      help="deflate streams on the rescuer links; rescuers offer it, survivors use it "
+                           "where offered")
+    parser.add_option("--compress-level", action="store", type="int",
+                      dest="compress_level",
+                      default=COMPRESS_LEVEL,
+                      help="zlib level of --compress, 1 (fast) to 9 (small)")
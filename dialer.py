@@ -0,0 +1,178 @@
+import asyncio
+import errno
+import os
+import selectors
+import socket
+import time
+
+# RFC 8305 "Connection Attempt Delay"
+HAPPY_EYEBALLS_DELAY = 0.25
+
+TCP_KEEPALIVE_IDLE = 60
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 3
+
+
+def address_family(address):
+    return socket.AF_INET6 if ':' in address else socket.AF_INET
+
+
+# RFC 8305 section 4: start with the preferred family (IPv6) and alternate
+# families from there, keeping the resolver's order within each family.
+def interleave(addresses):
+    ipv6 = [a for a in addresses if address_family(a) == socket.AF_INET6]
+    ipv4 = [a for a in addresses if address_family(a) == socket.AF_INET]
+    ordered = []
+    for i in range(max(len(ipv6), len(ipv4))):
+        ordered.extend(ipv6[i:i + 1])
+        ordered.extend(ipv4[i:i + 1])
+    return ordered
+
+
+def create_socket(address):
+    sock = socket.socket(address_family(address), socket.SOCK_STREAM)
+    sock.setblocking(False)
+    return sock
+
+
+# Let the kernel probe a quiet connection after `idle` seconds and drop it
+# after `count` unanswered probes, instead of the system default of hours.
+def set_keepalive(sock, idle=TCP_KEEPALIVE_IDLE, interval=TCP_KEEPALIVE_INTERVAL,
+                  count=TCP_KEEPALIVE_COUNT):
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):
+        # macOS spells TCP_KEEPIDLE this way
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+# TCP Fast Open (Linux): put the start of `data` into the SYN.  Returns how
+# many bytes went out; 0 when the kernel has no cookie for the host yet and
+# only asked for one, None when fast open is not available at all.
+def fast_open_send(sock, address, data):
+    if not hasattr(socket, 'MSG_FASTOPEN'):
+        return None
+    try:
+        return sock.sendto(data, socket.MSG_FASTOPEN, address)
+    except BlockingIOError:
+        return 0
+    except OSError:
+        return None
+
+
+# Connects a new socket; with early_data it tries fast open and returns how
+# many of those bytes were sent along with the connect, otherwise 0.
+async def connect_socket(loop, address, port, early_data=None):
+    sock = create_socket(address)
+    sent = None
+    try:
+        if early_data:
+            sent = fast_open_send(sock, (address, port), early_data)
+            if sent is None:
+                sock.close()
+                sock = create_socket(address)
+        try:
+            await loop.sock_connect(sock, (address, port))
+        except OSError as e:
+            # a fast open SYN may have completed already
+            if sent is None or e.errno != errno.EISCONN:
+                raise
+    except BaseException:
+        sock.close()
+        raise
+    return sock, sent or 0
+
+
+# Race connection attempts to every address, starting the next one after
+# `delay` seconds or as soon as the previous attempt failed.  Returns the
+# first connected socket; the other attempts are cancelled and closed.
+# Bytes of the early_data bytearray that went out with the connect are
+# removed from it.  Only the first attempt uses fast open, so the data
+# never reaches a connection that loses the race.
+async def happy_connect(loop, addresses, port, delay=HAPPY_EYEBALLS_DELAY, early_data=None):
+    addresses = interleave(addresses)
+    if not addresses:
+        raise OSError('no address to connect to')
+    pending = set()
+    last_exc = None
+    index = 0
+    try:
+        while index < len(addresses) or pending:
+            if index < len(addresses):
+                data = bytes(early_data) if early_data and index == 0 else None
+                pending.add(loop.create_task(connect_socket(loop, addresses[index], port, data)))
+                index += 1
+            timeout = delay if index < len(addresses) else None
+            done, pending = await asyncio.wait(pending, timeout=timeout,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    last_exc = task.exception()
+                elif winner is None:
+                    winner, sent = task.result()
+                    if sent:
+                        del early_data[:sent]
+                else:
+                    task.result()[0].close()
+            if winner is not None:
+                return winner
+        raise last_exc
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+# Blocking variant of happy_connect for the threaded servers.
+def happy_connect_sync(addresses, port, delay=HAPPY_EYEBALLS_DELAY, timeout=30):
+    addresses = interleave(addresses)
+    if not addresses:
+        raise OSError('no address to connect to')
+    selector = selectors.DefaultSelector()
+    deadline = time.monotonic() + timeout
+    next_attempt = 0
+    last_exc = None
+    index = 0
+    try:
+        while index < len(addresses) or selector.get_map():
+            now = time.monotonic()
+            if now >= deadline:
+                raise socket.timeout('connect timed out')
+            if index < len(addresses) and now >= next_attempt:
+                address = addresses[index]
+                index += 1
+                next_attempt = now + delay
+                sock = create_socket(address)
+                err = sock.connect_ex((address, port))
+                if err in (0, errno.EINPROGRESS):
+                    selector.register(sock, selectors.EVENT_WRITE)
+                else:
+                    last_exc = OSError(err, os.strerror(err))
+                    sock.close()
+                    next_attempt = now
+                continue
+            wait = deadline - now
+            if index < len(addresses):
+                wait = min(wait, next_attempt - now)
+            for key, _ in selector.select(max(wait, 0)):
+                sock = key.fileobj
+                selector.unregister(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.setblocking(True)
+                    return sock
+                last_exc = OSError(err, os.strerror(err))
+                sock.close()
+                next_attempt = time.monotonic()
+        raise last_exc
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
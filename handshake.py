@@ -0,0 +1,279 @@
+import errno
+import socket
+
+ADD_RTYPE_IPV4 = 1
+ADD_RTYPE_DOMAIN = 3
+ADD_RTYPE_IPV6 = 4
+
+CMD_CONNECT = 1
+
+REP_SUCCESS = 0
+REP_GENERAL_FAILURE = 1
+REP_NOT_ALLOWED = 2
+REP_NETWORK_UNREACHABLE = 3
+REP_HOST_UNREACHABLE = 4
+REP_CONNECTION_REFUSED = 5
+REP_TTL_TIMEOUT = 6
+REP_COMMAND_NOT_SUPPORTED = 7
+
+REP_NAMES = {
+    0: 'success',
+    1: 'general_failure',
+    2: 'not_allowed',
+    3: 'network_unreachable',
+    4: 'host_unreachable',
+    5: 'connection_refused',
+    6: 'ttl_timeout',
+    7: 'command_not_supported',
+    8: 'address_type_not_supported',
+}
+
+GREETING = 1
+REQUEST = 2
+
+# Connect request a survivor sends to a rescuer after answering the client's
+# greeting itself: ff 43 FLAGS ATYP ADDR PORT, laid out like a SOCKS5
+# request.  CONNECT_HTTP in FLAGS makes the rescuer answer with an HTTP
+# status line instead of a SOCKS reply.  CONNECT_FAST_OPEN marks a client
+# that was told success already; the data following the request is its
+# first payload.  CONNECT_COMPRESS switches the stream to compress.py
+# frames in both directions, starting right after the request.
+CONNECT_REQUEST = b'\xff\x43'
+CONNECT_HTTP = 1
+CONNECT_FAST_OPEN = 2
+CONNECT_COMPRESS = 4
+
+STATE_START = 0
+STATE_GREETING = 1
+STATE_REQUEST = 2
+STATE_HTTP = 3
+STATE_DONE = 4
+STATE_CONNECT = 5
+
+HTTP_HEADER_LIMIT = 8192
+
+
+class HandshakeError(Exception):
+    pass
+
+
+# Resumable SOCKS5 / HTTP CONNECT handshake parser.
+#
+# feed() may be called with any fragmentation of the handshake and returns
+# the events completed by that call (GREETING, REQUEST).  Bytes are only
+# copied into the internal buffer while a message is incomplete; complete
+# messages are parsed in place.  Once REQUEST was returned, `rest` holds
+# whatever the client pipelined after the request.
+class HandshakeParser:
+    methods = None
+    cmd = None
+    atyp = None
+    addr = None
+    port = None
+    http = False
+    fast_open = False
+    compress = False
+    rest = b''
+
+    def __init__(self):
+        self.state = STATE_START
+        self.buffer = bytearray()
+        self.http_scanned = 0
+
+    @property
+    def done(self):
+        return self.state == STATE_DONE
+
+    def feed(self, data):
+        if self.state == STATE_DONE:
+            raise HandshakeError('handshake already complete')
+        if self.buffer:
+            self.buffer += data
+            data = self.buffer
+        events = []
+        pos = 0
+        size = len(data)
+        while pos < size and self.state != STATE_DONE:
+            if self.state == STATE_START:
+                if data[pos] == 5:
+                    self.state = STATE_GREETING
+                elif data[pos] == ord('C'):
+                    self.state = STATE_HTTP
+                elif data[pos] == CONNECT_REQUEST[0]:
+                    self.state = STATE_CONNECT
+                else:
+                    raise HandshakeError('unknown protocol 0x{:02x}'.format(data[pos]))
+                continue
+            if self.state == STATE_GREETING:
+                end = self.parse_greeting(data, pos, size)
+                event = GREETING
+            elif self.state in (STATE_REQUEST, STATE_CONNECT):
+                end = self.parse_request(data, pos, size)
+                event = REQUEST
+            else:
+                end = self.parse_http(data, pos, size)
+                event = REQUEST
+            if end < 0:
+                break
+            pos = end
+            events.append(event)
+        if self.state == STATE_DONE:
+            self.rest = bytes(data[pos:size])
+            self.buffer = bytearray()
+        elif data is self.buffer:
+            del self.buffer[:pos]
+        else:
+            self.buffer += data[pos:]
+        return events
+
+    def parse_greeting(self, data, pos, size):
+        if size - pos < 2:
+            return -1
+        end = pos + 2 + data[pos + 1]
+        if size < end:
+            return -1
+        self.methods = bytes(data[pos + 2:end])
+        self.state = STATE_REQUEST
+        return end
+
+    def parse_request(self, data, pos, size):
+        if size - pos < 5:
+            return -1
+        if self.state == STATE_CONNECT:
+            if data[pos:pos + 2] != CONNECT_REQUEST:
+                raise HandshakeError('bad connect request 0x{:02x}'.format(data[pos + 1]))
+        elif data[pos] != 5:
+            raise HandshakeError('bad request version 0x{:02x}'.format(data[pos]))
+        atyp = data[pos + 3]
+        if atyp == ADD_RTYPE_IPV4:
+            addr_end = pos + 8
+        elif atyp == ADD_RTYPE_DOMAIN:
+            addr_end = pos + 5 + data[pos + 4]
+        elif atyp == ADD_RTYPE_IPV6:
+            addr_end = pos + 20
+        else:
+            raise HandshakeError('unknown address type {}'.format(atyp))
+        end = addr_end + 2
+        if size < end:
+            return -1
+        if self.state == STATE_CONNECT:
+            self.cmd = CMD_CONNECT
+            self.http = bool(data[pos + 2] & CONNECT_HTTP)
+            self.fast_open = bool(data[pos + 2] & CONNECT_FAST_OPEN)
+            self.compress = bool(data[pos + 2] & CONNECT_COMPRESS)
+        else:
+            self.cmd = data[pos + 1]
+        self.atyp = atyp
+        if atyp == ADD_RTYPE_IPV4:
+            self.addr = socket.inet_ntoa(bytes(data[pos + 4:addr_end]))
+        elif atyp == ADD_RTYPE_DOMAIN:
+            self.addr = bytes(data[pos + 5:addr_end]).decode('ascii', 'replace')
+        else:
+            self.addr = socket.inet_ntop(socket.AF_INET6, bytes(data[pos + 4:addr_end]))
+        self.port = data[addr_end] << 8 | data[addr_end + 1]
+        self.state = STATE_DONE
+        return end
+
+    def parse_http(self, data, pos, size):
+        # only rescan the tail that might complete the header terminator
+        start = max(pos, pos + self.http_scanned - 3)
+        end = data.find(b'\r\n\r\n', start, size)
+        if end < 0:
+            self.http_scanned = size - pos
+            if self.http_scanned > HTTP_HEADER_LIMIT:
+                raise HandshakeError('HTTP CONNECT header too long')
+            return -1
+        end += 4
+        request_line = bytes(data[pos:data.find(b'\r\n', pos, end)]).decode('latin-1')
+        parts = request_line.split(' ')
+        if len(parts) != 3 or parts[0] != 'CONNECT':
+            raise HandshakeError('bad HTTP CONNECT request {!r}'.format(request_line))
+        host, _, port = parts[1].rpartition(':')
+        if not host or not port.isdigit():
+            raise HandshakeError('bad HTTP CONNECT target {!r}'.format(parts[1]))
+        host = host.strip('[]')
+        self.cmd = CMD_CONNECT
+        self.atyp = address_type(host)
+        self.addr = host
+        self.port = int(port)
+        self.http = True
+        self.state = STATE_DONE
+        return end
+
+
+# ATYP, address and port of a SOCKS reply for a socket name
+def socks_address(sockname):
+    if ':' in sockname[0]:
+        return bytes((ADD_RTYPE_IPV6,)) + socket.inet_pton(socket.AF_INET6, sockname[0]) + \
+            sockname[1].to_bytes(2, 'big')
+    return bytes((ADD_RTYPE_IPV4,)) + socket.inet_aton(sockname[0]) + sockname[1].to_bytes(2, 'big')
+
+
+def connect_request(parser, fast_open=False):
+    if parser.atyp == ADD_RTYPE_DOMAIN:
+        try:
+            host = parser.addr.encode('idna')
+        except UnicodeError:
+            raise HandshakeError('bad host name {!r}'.format(parser.addr))
+        if len(host) > 255:
+            raise HandshakeError('host name too long')
+        address = bytes((ADD_RTYPE_DOMAIN, len(host))) + host
+    elif parser.atyp == ADD_RTYPE_IPV6:
+        address = bytes((ADD_RTYPE_IPV6,)) + socket.inet_pton(socket.AF_INET6, parser.addr)
+    else:
+        address = bytes((ADD_RTYPE_IPV4,)) + socket.inet_aton(parser.addr)
+    if fast_open:
+        # the survivor answered the client, the rescuer's reply is always SOCKS
+        flags = CONNECT_FAST_OPEN
+    else:
+        flags = CONNECT_HTTP if parser.http else 0
+    return CONNECT_REQUEST + bytes((flags,)) + address + parser.port.to_bytes(2, 'big')
+
+
+def socks_reply(rep, sockname=('0.0.0.0', 0)):
+    return bytes((5, rep, 0)) + socks_address(sockname)
+
+
+# Splits the SOCKS reply off the start of `head`.  Returns None while it is
+# incomplete, otherwise its REP code and the bytes following it.
+def split_reply(head):
+    if len(head) < 5:
+        return None
+    if head[3] == ADD_RTYPE_IPV6:
+        size = 22
+    elif head[3] == ADD_RTYPE_DOMAIN:
+        size = 7 + head[4]
+    else:
+        size = 10
+    if len(head) < size:
+        return None
+    return head[1], head[size:]
+
+
+def connect_error_code(exc):
+    if isinstance(exc, ConnectionRefusedError):
+        return REP_CONNECTION_REFUSED
+    if isinstance(exc, socket.gaierror) or exc.errno == errno.EHOSTUNREACH:
+        return REP_HOST_UNREACHABLE
+    if exc.errno == errno.ENETUNREACH:
+        return REP_NETWORK_UNREACHABLE
+    if isinstance(exc, TimeoutError):
+        return REP_TTL_TIMEOUT
+    return REP_GENERAL_FAILURE
+
+
+def connect_error_reply(exc):
+    return socks_reply(connect_error_code(exc))
+
+
+def address_type(host):
+    try:
+        socket.inet_pton(socket.AF_INET, host)
+        return ADD_RTYPE_IPV4
+    except OSError:
+        pass
+    try:
+        socket.inet_pton(socket.AF_INET6, host)
+        return ADD_RTYPE_IPV6
+    except OSError:
+        return ADD_RTYPE_DOMAIN
@@ -0,0 +1,91 @@
+import itertools
+import logging
+
+# below DEBUG, only used for payload dumps
+TRACE = 5
+logging.addLevelName(TRACE, 'TRACE')
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+LEVELS = ['trace', 'debug', 'info', 'warning', 'error']
+DUMP_LIMIT = 64
+
+# Data paths test this flag before doing anything for a dump, so a disabled
+# dump costs one attribute lookup per chunk.
+dump_payloads = False
+dump_limit = DUMP_LIMIT
+dump_sample = 1
+dump_counter = itertools.count()
+
+payload_log = logging.getLogger('payload')
+
+
+def hexdump(data, limit=DUMP_LIMIT):
+    text = bytes(data[:limit]).hex(' ')
+    if len(data) > limit:
+        text += ' ...'
+    return text
+
+
+# Logs every dump_sample-th chunk as hex, at most dump_limit bytes of it.
+def dump(where, data):
+    if next(dump_counter) % dump_sample:
+        return
+    payload_log.log(TRACE, '%s %d bytes: %s', where, len(data), hexdump(data, dump_limit))
+
+
+def level_number(level):
+    return TRACE if level.lower() == 'trace' else getattr(logging, level.upper())
+
+
+# level is the default for every component, components holds
+# 'component=level' overrides such as 'pool=debug'.
+def configure(level='info', components=(), dump=False, limit=DUMP_LIMIT, sample=1):
+    global dump_payloads, dump_limit, dump_sample
+    logging.basicConfig(level=level_number(level), format=LOG_FORMAT)
+    for item in components:
+        name, _, component_level = item.partition('=')
+        logging.getLogger(name).setLevel(level_number(component_level or 'debug'))
+    dump_payloads = dump
+    dump_limit = limit
+    dump_sample = max(sample, 1)
+    if dump:
+        payload_log.setLevel(TRACE)
+
+
+def add_component(option, opt, value, parser):
+    name, _, level = value.partition('=')
+    if not name or level and level.lower() not in LEVELS:
+        parser.error('{} {}: expected COMPONENT=LEVEL, LEVEL one of {}'.format(opt, value, ', '.join(LEVELS)))
+    # a new list, the default one is shared
+    parser.values.log_components = parser.values.log_components + [value]
+
+
+def add_options(parser):
+    parser.add_option("--log-level", action="store", type="choice",
+                      dest="log_level",
+                      choices=LEVELS,
+                      default='info',
+                      help="default log level: " + ", ".join(LEVELS))
+    parser.add_option("--log", action="callback", type="string",
+                      callback=add_component,
+                      dest="log_components",
+                      default=[],
+                      metavar="COMPONENT=LEVEL",
+                      help="log level of one component, e.g. pool=debug (repeatable)")
+    parser.add_option("--dump-payload", action="store_true",
+                      dest="dump_payload",
+                      default=False,
+                      help="log relayed payloads as hex")
+    parser.add_option("--dump-limit", action="store", type="int",
+                      dest="dump_limit",
+                      default=DUMP_LIMIT,
+                      help="bytes of each payload shown in a dump")
+    parser.add_option("--dump-sample", action="store", type="int",
+                      dest="dump_sample",
+                      default=1,
+                      help="dump only every Nth payload")
+
+
+def configure_options(options):
+    configure(options.log_level, options.log_components, options.dump_payload,
+              options.dump_limit, options.dump_sample)
@@ -5,13 +5,16 @@
 # Background Run: nohup python s5.py 1080 &
 import asyncio
 import logging
-import select
 import socket
 import socketserver
 import struct
 import sys
 from optparse import OptionParser
 
+from relay import relay, relay_eof, default_backend, BACKENDS, raise_nofile_limit, \
+    WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW
+from timers import wheel, IdleWatch, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT
+
 VER = 5
 
 
@@ -56,18 +59,13 @@ class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
 class SurvivorServer(socketserver.StreamRequestHandler):
     survivor = []
-    close = False
+    relay_backend = default_backend()
 
     def handle_tcp(self, sock, remote):
-        f_d_set = [sock, remote]
-        while not self.close:
-            r, w, e = select.select(f_d_set, [], [])
-            if sock in r:
-                if remote.send(sock.recv(4096)) <= 0:
-                    break
-            if remote in r:
-                if sock.send(remote.recv(4096)) <= 0:
-                    break
+        try:
+            relay(sock, remote, self.relay_backend, idle_timeout=IDLE_TIMEOUT)
+        finally:
+            remote.close()
 
     def handle(self):
         try:
@@ -81,7 +79,7 @@ class SurvivorServer(socketserver.StreamRequestHandler):
             cmd = data[1]
             if cmd == CMD_CONNECT:  # 1. Tcp connect
                 survivor_sock = self.survivor.pop()
-                survivor_sock.send(data)
+                survivor_sock.sendall(data)
                 self.handle_tcp(sock, survivor_sock)
             elif cmd == CMD_REG_SURVIVOR:
                 self.survivor.append(sock)
@@ -99,9 +97,107 @@ class SurvivorServer(socketserver.StreamRequestHandler):
             pass
 
 
+# Event engine version of SurvivorServer: every connection is a protocol on
+# one asyncio loop.  A CONNECT is paired with a registered survivor link and
+# the two transports relay to each other from then on.
+class SurvivorProtocol(asyncio.Protocol):
+    survivor = []
+    transport = None
+    peer = None
+    greeted = False
+    handshake_timer = None
+    idle_watch = None
+    idle = False
+    eof = False
+
+    def __init__(self):
+        self.buffer = b''
+
+    # clients have this long for their request, rescuers to register
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        self.handshake_timer = wheel.call_later(HANDSHAKE_TIMEOUT, self.transport.abort)
+
+    def idle_expired(self):
+        self.idle_watch = None
+        self.transport.abort()
+        self.peer.abort()
+
+    def data_received(self, data):
+        self.idle = False
+        if self.peer:
+            self.peer.write(data)
+            return
+        if self in self.survivor:
+            return
+        self.buffer += data
+        if not self.greeted:
+            # 1. Version
+            if len(self.buffer) < 2 or len(self.buffer) < 2 + self.buffer[1]:
+                return
+            self.buffer = self.buffer[2 + self.buffer[1]:]
+            self.greeted = True
+            self.transport.write(RSP_SOCKET5_VERSION)
+        # 2. Request
+        if len(self.buffer) < 4:
+            return
+        cmd = self.buffer[1]
+        if cmd == CMD_CONNECT:  # 1. Tcp connect
+            if not self.survivor:
+                self.transport.close()
+                return
+            self.handshake_timer.cancel()
+            other = self.survivor.pop()
+            self.peer = other.transport
+            other.peer = self.transport
+            self.peer.write(self.buffer)
+            self.idle_watch = IdleWatch(IDLE_TIMEOUT, self.idle_expired, self, other)
+        elif cmd == CMD_REG_SURVIVOR:
+            # an idle rescuer waits for clients as long as it likes
+            self.handshake_timer.cancel()
+            self.survivor.append(self)
+        else:
+            logging.error('unknown command %d', cmd)
+            # Command not supported
+            self.transport.write(RSP_COMMAND_NOT_SUPPORTED)
+            self.transport.close()
+        self.buffer = b''
+
+    def pause_writing(self):
+        if self.peer:
+            self.peer.pause_reading()
+
+    def resume_writing(self):
+        if self.peer:
+            self.peer.resume_reading()
+
+    def eof_received(self):
+        if self.peer:
+            return relay_eof(self, self.peer)
+        return False
+
+    def connection_lost(self, exc):
+        self.handshake_timer.cancel()
+        if self.idle_watch:
+            self.idle_watch.cancel()
+        if self in self.survivor:
+            self.survivor.remove(self)
+        if self.peer:
+            self.peer.close()
+
+
+async def serve(port):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(SurvivorProtocol, '', port, backlog=1024)
+    print('survivor bind port: %d' % port + ' ok! relay: event')
+    async with server:
+        await server.serve_forever()
+
+
 class RescuersClient:
     survivor = []
-    close = False
+    relay_backend = default_backend()
 
     survivor_host = None
     survivor_port = None
@@ -119,15 +215,10 @@ class RescuersClient:
         # local = remote.getsockname()
 
     def handle_tcp(self, sock, remote):
-        f_d_set = [sock, remote]
-        while not self.close:
-            r, w, e = select.select(f_d_set, [], [])
-            if sock in r:
-                if remote.send(sock.recv(4096)) <= 0:
-                    break
-            if remote in r:
-                if sock.send(remote.recv(4096)) <= 0:
-                    break
+        try:
+            relay(sock, remote, self.relay_backend, idle_timeout=IDLE_TIMEOUT)
+        finally:
+            remote.close()
 
     def handle(self):
         try:
@@ -174,7 +265,11 @@ class RescuersClient:
             pass
 
 
-def survivor(port):
+def survivor(port, backend='event'):
+    raise_nofile_limit()
+    if backend == 'event':
+        return asyncio.run(serve(port))
+    SurvivorServer.relay_backend = backend
     server = ThreadingTCPServer(('', port), SurvivorServer)
     print('survivor bind port: %d' % port + ' ok!')
     server.serve_forever()
@@ -210,10 +305,19 @@ if __name__ == '__main__':
                       dest="port",
                       default='1080',
                       help="target/listen port")
+    parser.add_option("--relay", action="store", type="choice",
+                      dest="relay",
+                      choices=['event'] + list(BACKENDS),
+                      default='event',
+                      help="how connections are relayed: event (one thread for all), "
+                           "or a thread per connection with " + ", ".join(BACKENDS))
 
     (options, args) = parser.parse_args()
+    if options.relay != 'event':
+        SurvivorServer.relay_backend = options.relay
+        RescuersClient.relay_backend = options.relay
     if options.survivor:
-        survivor(options.port)
+        survivor(options.port, options.relay)
     if options.rescuers:
         rescuers(options.target, options.port)
 
@@ -0,0 +1,208 @@
+import asyncio
+import bisect
+import logging
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+REQUEST_LIMIT = 8 * 1024
+
+metrics_log = logging.getLogger('metrics')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# One labelled series of a counter or gauge.  The data paths keep a
+# reference and add to `value` directly.
+class Sample:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+# A counter or gauge is either maintained by the code or, with `function`,
+# read when scraped.  The function returns a number, or a dict of label
+# values to numbers for a labelled metric.
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self.series = {}
+
+    def labels(self, *values):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = self.new_series()
+        return series
+
+    def new_series(self):
+        return Sample()
+
+    def samples(self):
+        if self.function is None:
+            for values, series in self.series.items():
+                yield self.name, values, series.value
+            return
+        value = self.function()
+        if isinstance(value, dict):
+            for values, v in value.items():
+                yield self.name, values if isinstance(values, tuple) else (values,), v
+        else:
+            yield self.name, (), value
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, values, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(self.labelnames, values),
+                                          format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, *values):
+        self.labels(*values).value += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *values):
+        self.labels(*values).value = value
+
+
+class HistogramSeries:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_series(self):
+        return HistogramSeries(self.buckets)
+
+    def observe(self, value, *values):
+        self.labels(*values).observe(value)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        names = self.labelnames + ('le',)
+        for values, series in self.series.items():
+            total = 0
+            for bound, count in zip(self.buckets, series.counts):
+                total += count
+                lines.append('{}_bucket{} {}'.format(self.name, format_labels(names, values + (bound,)),
+                                                     total))
+            lines.append('{}_bucket{} {}'.format(self.name, format_labels(names, values + ('+Inf',)),
+                                                 series.count))
+            labels = format_labels(self.labelnames, values)
+            lines.append('{}_sum{} {}'.format(self.name, labels, format_value(series.sum)))
+            lines.append('{}_count{} {}'.format(self.name, labels, series.count))
+        return lines
+
+
+# The metrics of one process, rendered in the Prometheus text format.
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=(), function=None):
+        return self.register(Counter(name, help, labelnames, function))
+
+    def gauge(self, name, help, labelnames=(), function=None):
+        return self.register(Gauge(name, help, labelnames, function))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                metrics_log.exception('rendering %s failed', metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+# Just enough HTTP/1.0 for a scraper: one GET per connection.  `routes`
+# maps paths to functions returning the text to serve.
+class MetricsProtocol(asyncio.Protocol):
+    transport = None
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.request = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.request += data
+        if b'\r\n\r\n' not in self.request and b'\n\n' not in self.request:
+            if len(self.request) > REQUEST_LIMIT:
+                self.transport.close()
+            return
+        parts = self.request.split(b' ', 2)
+        if len(parts) < 3 or parts[0] != b'GET':
+            return self.respond(b'405 Method Not Allowed', b'')
+        route = self.routes.get(parts[1].split(b'?')[0])
+        if route is None:
+            return self.respond(b'404 Not Found', b'')
+        self.respond(b'200 OK', route().encode())
+
+    def respond(self, status, body):
+        self.transport.write(b'HTTP/1.0 ' + status + b'\r\n'
+                             b'Content-Type: text/plain; version=0.0.4\r\n'
+                             b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        self.transport.close()
+
+
+def serve(loop, registry, port, host='127.0.0.1', routes=None):
+    routes = {b'/': registry.render, b'/metrics': registry.render, **(routes or {})}
+    server = loop.run_until_complete(loop.create_server(
+        lambda: MetricsProtocol(routes), host, port, reuse_address=True))
+    metrics_log.info('metrics on http://%s:%d/metrics', host, port)
+    return server
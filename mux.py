@@ -0,0 +1,268 @@
+import asyncio
+import struct
+from asyncio import Transport
+
+MUX_OPEN = 1
+MUX_DATA = 2
+MUX_CLOSE = 3
+MUX_WINDOW = 4
+MUX_PING = 5
+MUX_PONG = 6
+MUX_FIN = 7
+
+# type, stream id, payload length
+MUX_HEADER = struct.Struct('>BIH')
+MUX_MAX_PAYLOAD = 0xffff
+MUX_INITIAL_WINDOW = 256 * 1024
+
+
+# A stream looks like a transport to its protocol, so the relay protocols
+# can be paired with it exactly like with a TCP transport.
+class MuxStream(asyncio.Transport):
+    def __init__(self, link, stream_id, protocol=None):
+        super().__init__()
+        self.link = link
+        self.stream_id = stream_id
+        self.protocol = protocol
+        self.send_window = MUX_INITIAL_WINDOW
+        self.recv_consumed = 0
+        self.pending = bytearray()
+        self.high_water = 64 * 1024
+        self.low_water = 16 * 1024
+        self.reading_paused = False
+        self.writing_paused = False
+        self.closing = False
+        self.closed = False
+        self.eof_written = False
+        self.eof_sent = False
+
+    def get_extra_info(self, name, default=None):
+        return self.link.transport.get_extra_info(name, default)
+
+    def set_protocol(self, protocol):
+        self.protocol = protocol
+
+    def get_protocol(self):
+        return self.protocol
+
+    def is_closing(self):
+        return self.closing or self.closed
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        self.high_water = high
+        self.low_water = low
+        self.link.check_writing(self)
+
+    def get_write_buffer_size(self):
+        return len(self.pending)
+
+    # While reading is paused the received bytes are not acknowledged, so the
+    # peer runs out of window and stops sending.
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            self.link.send_window_update(self, 1)
+
+    def is_reading(self):
+        return not self.reading_paused and not self.is_closing()
+
+    def write(self, data):
+        if self.closing or self.closed or self.eof_written or not data:
+            return
+        if self.pending:
+            self.pending += data
+        else:
+            self.pending = bytearray(data)
+        self.link.flush_stream(self)
+
+    def can_write_eof(self):
+        return True
+
+    # MUX_FIN follows the pending bytes; the stream stays open for the
+    # other direction until either side closes it.
+    def write_eof(self):
+        if self.closing or self.closed or self.eof_written:
+            return
+        self.eof_written = True
+        self.link.flush_stream(self)
+
+    def close(self):
+        if self.closing or self.closed:
+            return
+        self.closing = True
+        self.link.flush_stream(self)
+
+    def abort(self):
+        self.pending.clear()
+        self.close()
+
+
+# Every frame is MUX_HEADER followed by its payload. MUX_WINDOW returns send
+# credit once the peer consumed the bytes, so one slow stream can not fill
+# the link for the others. MUX_FIN half-closes a stream and is handed to
+# its protocol's eof_received(). With a heartbeat started, a link that
+# received nothing for a whole interval sends MUX_PING (stream 0) and is
+# aborted if the peer stays silent for the timeout after it.
+class MuxProtocol(asyncio.Protocol):
+    transport = None
+    heartbeat_handle = None
+
+    def __init__(self, loop, stream_factory=None):
+        self.loop = loop
+        self.stream_factory = stream_factory
+        self.streams = {}
+        self.next_stream_id = 1
+        self.buffer = bytearray()
+        self.writing_paused = False
+        self.last_received = loop.time()
+        self.ping_sent = None
+
+    def connection_made(self, transport: Transport):
+        self.transport = transport
+
+    def start_heartbeat(self, interval, timeout):
+        if interval <= 0:
+            return
+        self.heartbeat_interval = interval
+        self.heartbeat_timeout = timeout
+        self.heartbeat_handle = self.loop.call_later(interval, self.heartbeat)
+
+    def heartbeat(self):
+        now = self.loop.time()
+        if self.ping_sent is not None and self.last_received < self.ping_sent:
+            self.heartbeat_handle = None
+            self.transport.abort()
+            return
+        self.ping_sent = None
+        if now - self.last_received >= self.heartbeat_interval:
+            self.ping_sent = now
+            self.send_frame(MUX_PING, 0)
+            delay = self.heartbeat_timeout
+        else:
+            delay = self.last_received + self.heartbeat_interval - now
+        self.heartbeat_handle = self.loop.call_later(delay, self.heartbeat)
+
+    def open_stream(self, protocol):
+        stream_id = self.next_stream_id
+        self.next_stream_id += 1
+        stream = MuxStream(self, stream_id, protocol)
+        self.streams[stream_id] = stream
+        self.send_frame(MUX_OPEN, stream_id)
+        protocol.connection_made(stream)
+        return stream
+
+    def send_frame(self, frame_type, stream_id, payload=b''):
+        self.transport.write(MUX_HEADER.pack(frame_type, stream_id, len(payload)) + payload)
+
+    def flush_stream(self, stream):
+        if stream.closed:
+            return
+        pending = stream.pending
+        while pending and stream.send_window > 0:
+            n = min(len(pending), stream.send_window, MUX_MAX_PAYLOAD)
+            self.send_frame(MUX_DATA, stream.stream_id, bytes(pending[:n]))
+            del pending[:n]
+            stream.send_window -= n
+        if stream.closing and not pending:
+            self.send_frame(MUX_CLOSE, stream.stream_id)
+            self.drop_stream(stream, None)
+            return
+        if stream.eof_written and not pending and not stream.eof_sent:
+            stream.eof_sent = True
+            self.send_frame(MUX_FIN, stream.stream_id)
+        self.check_writing(stream)
+
+    def check_writing(self, stream):
+        if stream.closed or not stream.protocol:
+            return
+        size = len(stream.pending)
+        if not stream.writing_paused:
+            if self.writing_paused or size > stream.high_water:
+                stream.writing_paused = True
+                stream.protocol.pause_writing()
+        elif not self.writing_paused and size <= stream.low_water:
+            stream.writing_paused = False
+            stream.protocol.resume_writing()
+
+    def send_window_update(self, stream, threshold=MUX_INITIAL_WINDOW // 2):
+        if stream.recv_consumed >= threshold and not stream.closed:
+            self.send_frame(MUX_WINDOW, stream.stream_id, struct.pack('>I', stream.recv_consumed))
+            stream.recv_consumed = 0
+
+    def pause_writing(self):
+        self.writing_paused = True
+        for stream in list(self.streams.values()):
+            self.check_writing(stream)
+
+    def resume_writing(self):
+        self.writing_paused = False
+        for stream in list(self.streams.values()):
+            self.check_writing(stream)
+
+    def drop_stream(self, stream, exc):
+        if stream.closed:
+            return
+        stream.closed = True
+        self.streams.pop(stream.stream_id, None)
+        if stream.protocol:
+            stream.protocol.connection_lost(exc)
+
+    def data_received(self, data):
+        self.last_received = self.loop.time()
+        buffer = self.buffer
+        buffer += data
+        offset = 0
+        size = len(buffer)
+        while size - offset >= MUX_HEADER.size:
+            frame_type, stream_id, length = MUX_HEADER.unpack_from(buffer, offset)
+            end = offset + MUX_HEADER.size + length
+            if end > size:
+                break
+            payload = bytes(buffer[offset + MUX_HEADER.size:end])
+            offset = end
+            self.frame_received(frame_type, stream_id, payload)
+        if offset:
+            del buffer[:offset]
+
+    def frame_received(self, frame_type, stream_id, payload):
+        if frame_type == MUX_OPEN:
+            if stream_id in self.streams or not self.stream_factory:
+                return
+            stream = MuxStream(self, stream_id)
+            self.streams[stream_id] = stream
+            stream.protocol = self.stream_factory(stream)
+            stream.protocol.connection_made(stream)
+            return
+        if frame_type == MUX_PING:
+            self.send_frame(MUX_PONG, 0)
+            return
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            return
+        if frame_type == MUX_DATA:
+            stream.protocol.data_received(payload)
+            stream.recv_consumed += len(payload)
+            if not stream.reading_paused:
+                self.send_window_update(stream)
+        elif frame_type == MUX_WINDOW:
+            stream.send_window += struct.unpack('>I', payload)[0]
+            self.flush_stream(stream)
+        elif frame_type == MUX_FIN:
+            if not stream.protocol.eof_received():
+                stream.close()
+        elif frame_type == MUX_CLOSE:
+            stream.pending.clear()
+            self.drop_stream(stream, None)
+
+    def connection_lost(self, exc):
+        if self.heartbeat_handle:
+            self.heartbeat_handle.cancel()
+        for stream in list(self.streams.values()):
+            self.drop_stream(stream, exc)
@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+
+POOL_MIN_LINKS = 2
+POOL_MAX_LINKS = 64
+POOL_TARGET_IDLE = 4
+POOL_TRIM_INTERVAL = 30
+POOL_HINT_TTL = 60
+POOL_HINT_WINDOW = 2
+POOL_HINT_HEADROOM = 2
+
+DIAL_BUDGET = 8
+DIAL_TIMEOUT = 10
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 10
+BREAKER_THRESHOLD = 5
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half-open'
+
+pool_log = logging.getLogger('pool')
+
+WAIT_QUEUE_SIZE = 1024
+WAIT_QUEUE_TIMEOUT = 10
+
+
+# Guards the dials to the survivor.
+#
+# Every failed dial pushes the next one back by an exponential backoff with
+# jitter, so rescuers that lost the same survivor do not come back in step.
+# After `threshold` failures in a row the circuit opens and nothing is
+# dialed until the backoff elapsed; then it is half-open and lets a single
+# probe through.  A successful dial closes it again and clears the backoff.
+class CircuitBreaker:
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+        self.threshold = threshold
+        self.base = base
+        self.cap = cap
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.retry_at = 0
+        self.opened = 0
+
+    def backoff(self):
+        delay = min(self.cap, self.base * 2 ** min(self.failures - 1, 30))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    # seconds until the next dial may start
+    def delay(self):
+        return max(self.retry_at - time.monotonic(), 0)
+
+    # how many of `wanted` dials may start now
+    def permits(self, wanted, dialing):
+        if self.delay() > 0:
+            return 0
+        if self.state == BREAKER_OPEN:
+            self.state = BREAKER_HALF_OPEN
+        if self.state == BREAKER_HALF_OPEN:
+            return 0 if dialing else min(wanted, 1)
+        return wanted
+
+    def success(self):
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.retry_at = 0
+
+    def failure(self):
+        if self.state == BREAKER_CLOSED and self.delay() > 0:
+            # a dial started before the backoff, the outage is counted already
+            return
+        self.failures += 1
+        if self.state == BREAKER_HALF_OPEN or self.failures >= self.threshold:
+            if self.state != BREAKER_OPEN:
+                self.opened += 1
+            self.state = BREAKER_OPEN
+        self.retry_at = time.monotonic() + self.backoff()
+
+
+# Keeps the number of idle rescuer links near a target.
+#
+# Links report themselves with link_made/link_busy/link_lost.  Whenever the
+# idle links plus the dials in flight drop below the target, more links are
+# dialed ahead of demand (never more than max_links in total, never fewer
+# than min_links).  Every trim_interval the links above the target are
+# retired, oldest idle first.  A survivor can raise the target for a while
+# with hint().  At most dial_budget dials are in flight at once and all of
+# them go through a CircuitBreaker.
+class RescuerPool:
+
+    def __init__(self, loop, dial, min_links=POOL_MIN_LINKS, max_links=POOL_MAX_LINKS,
+                 target_idle=POOL_TARGET_IDLE, trim_interval=POOL_TRIM_INTERVAL,
+                 dial_budget=DIAL_BUDGET):
+        self.loop = loop
+        self.dial = dial
+        self.min_links = min_links
+        self.max_links = max(max_links, min_links)
+        self.target_idle = target_idle
+        self.trim_interval = trim_interval
+        self.dial_budget = dial_budget
+        self.breaker = CircuitBreaker()
+        self.hinted_idle = None
+        self.hint_expires = 0
+        self.links = set()
+        self.idle = {}
+        self.dialing = 0
+        self.dialed = 0
+        self.failed = 0
+        self.trimmed = 0
+        self.trim_handle = None
+        self.retry_handle = None
+
+    def start(self):
+        self.refill()
+        self.trim_handle = self.loop.call_later(self.trim_interval, self.trim)
+
+    def stop(self):
+        if self.trim_handle:
+            self.trim_handle.cancel()
+        if self.retry_handle:
+            self.retry_handle.cancel()
+
+    def stats(self):
+        return {
+            'links': len(self.links),
+            'idle': len(self.idle),
+            'dialing': self.dialing,
+            'target_idle': self.wanted_idle(),
+            'dialed': self.dialed,
+            'failed': self.failed,
+            'breaker': self.breaker.state,
+            'retry_in': self.breaker.delay(),
+            'trimmed': self.trimmed,
+        }
+
+    def wanted_idle(self):
+        if self.hinted_idle is not None and time.monotonic() < self.hint_expires:
+            return max(self.target_idle, self.hinted_idle)
+        return self.target_idle
+
+    def hint(self, wanted):
+        self.hinted_idle = min(wanted, self.max_links)
+        self.hint_expires = time.monotonic() + POOL_HINT_TTL
+        self.refill()
+
+    def refill(self):
+        missing = max(self.wanted_idle() - len(self.idle),
+                      self.min_links - len(self.links)) - self.dialing
+        missing = min(missing, self.max_links - len(self.links) - self.dialing,
+                      self.dial_budget - self.dialing)
+        if missing <= 0:
+            return
+        delay = self.breaker.delay()
+        if delay > 0:
+            if self.retry_handle is None:
+                self.retry_handle = self.loop.call_later(delay, self.retry)
+            return
+        for i in range(self.breaker.permits(missing, self.dialing)):
+            self.dialing += 1
+            self.dialed += 1
+            self.loop.create_task(self.run_dial())
+
+    def retry(self):
+        self.retry_handle = None
+        self.refill()
+
+    async def run_dial(self):
+        try:
+            await asyncio.wait_for(self.dial(), DIAL_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.failed += 1
+            self.breaker.failure()
+            pool_log.warning('dial survivor failed (%s), circuit %s, retry in %.1fs',
+                             e or 'timeout', self.breaker.state, self.breaker.delay())
+        else:
+            self.breaker.success()
+        finally:
+            self.dialing -= 1
+        self.refill()
+
+    def link_made(self, link):
+        self.links.add(link)
+        self.idle[link] = None
+
+    def link_busy(self, link):
+        if self.idle.pop(link, False) is None:
+            self.refill()
+
+    def link_lost(self, link):
+        self.links.discard(link)
+        self.idle.pop(link, None)
+        self.refill()
+
+    def trim(self):
+        surplus = min(len(self.idle) - self.wanted_idle(), len(self.links) - self.min_links)
+        for link in list(self.idle)[:max(surplus, 0)]:
+            del self.idle[link]
+            self.trimmed += 1
+            link.retire()
+        self.trim_handle = self.loop.call_later(self.trim_interval, self.trim)
+
+
+# Survivor side of the pool: estimates how many idle links the rescuers
+# should keep from the links handed out during the last `window` seconds.
+class PoolDemand:
+
+    def __init__(self, window=POOL_HINT_WINDOW, headroom=POOL_HINT_HEADROOM):
+        self.window = window
+        self.headroom = headroom
+        self.assigned = deque()
+        self.last_hint = 0
+        self.last_hint_time = 0
+
+    # Returns the idle link count to ask the rescuers for, or None when the
+    # last hint still covers the demand.
+    def link_assigned(self, idle_links):
+        now = time.monotonic()
+        assigned = self.assigned
+        assigned.append(now)
+        while assigned[0] < now - self.window:
+            assigned.popleft()
+        wanted = len(assigned) + self.headroom
+        if wanted <= idle_links:
+            return None
+        if wanted <= self.last_hint and now - self.last_hint_time < 1:
+            return None
+        self.last_hint = wanted
+        self.last_hint_time = now
+        return wanted
+
+
+# Survivor side FIFO of clients waiting for an idle rescuer link.
+#
+# Every waiter gets a deadline; if no link turned up by then the waiter's
+# wait_timeout() is called.  take() hands out the oldest waiter first.
+class WaitQueue:
+    # called with the new depth whenever it changes
+    listener = None
+    # called with how long each waiter handed out by take() waited
+    observer = None
+
+    def __init__(self, loop, maxsize=WAIT_QUEUE_SIZE, timeout=WAIT_QUEUE_TIMEOUT):
+        self.loop = loop
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.waiters = OrderedDict()
+        self.max_depth = 0
+        self.queued = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def put(self, waiter):
+        if len(self.waiters) >= self.maxsize:
+            self.rejected += 1
+            return False
+        handle = self.loop.call_later(self.timeout, self.expire, waiter)
+        self.waiters[waiter] = (self.loop.time(), handle)
+        self.queued += 1
+        self.max_depth = max(self.max_depth, len(self.waiters))
+        if self.listener:
+            self.listener(len(self.waiters))
+        return True
+
+    def take(self):
+        if not self.waiters:
+            return None
+        waiter, (queued_at, handle) = self.waiters.popitem(last=False)
+        handle.cancel()
+        if self.listener:
+            self.listener(len(self.waiters))
+        waited = self.loop.time() - queued_at
+        self.max_wait = max(self.max_wait, waited)
+        if self.observer:
+            self.observer(waited)
+        return waiter
+
+    def remove(self, waiter):
+        entry = self.waiters.pop(waiter, None)
+        if entry:
+            entry[1].cancel()
+            if self.listener:
+                self.listener(len(self.waiters))
+
+    def expire(self, waiter):
+        if self.waiters.pop(waiter, None):
+            self.timeouts += 1
+            if self.listener:
+                self.listener(len(self.waiters))
+            waiter.wait_timeout()
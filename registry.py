@@ -0,0 +1,130 @@
+from collections import OrderedDict
+
+RTT_ALPHA = 0.2
+SUCCESS_ALPHA = 0.1
+# hosts below this connect success rate are only used when nothing else is idle
+DEGRADED_SUCCESS_RATE = 0.5
+
+
+class RescuerHost:
+
+    def __init__(self, key):
+        self.key = key
+        self.idle = OrderedDict()
+        self.active = 0
+        self.streams = 0
+        self.rtt = None
+        self.success_rate = 1.0
+        self.connects = 0
+        self.failures = 0
+
+
+def round_robin(registry, hosts):
+    registry.rotation = (registry.rotation + 1) % len(hosts)
+    return hosts[registry.rotation]
+
+
+def least_loaded(registry, hosts):
+    return min(hosts, key=lambda host: host.active / max(host.success_rate, 0.01))
+
+
+def lowest_latency(registry, hosts):
+    # hosts without a sample yet go first so that every host gets measured
+    return min(hosts, key=lambda host: (host.rtt or 0.0) / max(host.success_rate, 0.01))
+
+
+POLICIES = {
+    'round-robin': round_robin,
+    'least-loaded': least_loaded,
+    'lowest-latency': lowest_latency,
+}
+
+
+# Idle rescuer links grouped by the host they come from.
+#
+# Links are added and removed in O(1); pop() first picks a host with the
+# selection policy and then takes that host's most recently added link.
+# Per host it keeps the handshake RTT and connect success rate as moving
+# averages plus the number of active streams, so a slow or failing host
+# gets fewer new streams.
+class RescuerRegistry:
+    # called with the new idle count whenever it changes
+    listener = None
+
+    def __init__(self, policy='least-loaded'):
+        self.policy = POLICIES[policy]
+        self.hosts = {}
+        self.idle_count = 0
+        self.rotation = 0
+
+    def __len__(self):
+        return self.idle_count
+
+    def __contains__(self, link):
+        host = getattr(link, 'rescuer_host', None)
+        return host is not None and link in host.idle
+
+    def host(self, key):
+        host = self.hosts.get(key)
+        if host is None:
+            host = self.hosts[key] = RescuerHost(key)
+        return host
+
+    def add(self, link, key):
+        host = self.host(key)
+        link.rescuer_host = host
+        host.idle[link] = None
+        self.idle_count += 1
+        if self.listener:
+            self.listener(self.idle_count)
+
+    def remove(self, link):
+        if link in self:
+            del link.rescuer_host.idle[link]
+            self.idle_count -= 1
+            if self.listener:
+                self.listener(self.idle_count)
+            return True
+        return False
+
+    def pop(self):
+        hosts = [host for host in self.hosts.values() if host.idle]
+        if not hosts:
+            raise IndexError('no idle rescuer')
+        healthy = [host for host in hosts if host.success_rate >= DEGRADED_SUCCESS_RATE]
+        host = self.policy(self, healthy or hosts)
+        link, _ = host.idle.popitem()
+        self.idle_count -= 1
+        if self.listener:
+            self.listener(self.idle_count)
+        host.active += 1
+        host.streams += 1
+        return link
+
+    # A link with an unanswered heartbeat is handed out last, a link that just
+    # answered one first.
+    def suspect(self, link):
+        if link in self:
+            link.rescuer_host.idle.move_to_end(link, last=False)
+
+    def confirm(self, link):
+        if link in self:
+            link.rescuer_host.idle.move_to_end(link)
+
+    def peek(self):
+        for host in self.hosts.values():
+            if host.idle:
+                return next(reversed(host.idle))
+        return None
+
+    def stream_closed(self, host):
+        host.active -= 1
+
+    def record_rtt(self, host, rtt):
+        host.rtt = rtt if host.rtt is None else host.rtt + RTT_ALPHA * (rtt - host.rtt)
+
+    def record_connect(self, host, success):
+        host.connects += 1
+        if not success:
+            host.failures += 1
+        host.success_rate += SUCCESS_ALPHA * ((1.0 if success else 0.0) - host.success_rate)
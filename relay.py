@@ -0,0 +1,350 @@
+import asyncio
+import errno
+import os
+import selectors
+import socket
+import struct
+
+import logs
+from timers import wheel
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+RELAY_BUFFER_SIZE = 64 * 1024
+
+WRITE_BUFFER_HIGH = 256 * 1024
+WRITE_BUFFER_LOW = 64 * 1024
+# client bytes kept while the remote connection opens, reading pauses above
+EARLY_DATA_LIMIT = 64 * 1024
+
+READ_BUFFER_SIZE = 256 * 1024
+BUFFER_POOL_SIZE = 64
+
+
+# Moves bytes from one socket to another through an intermediate buffer.
+# `pending` counts the bytes read from src that did not reach dst yet.
+class Pump:
+
+    def __init__(self, src, dst, size=RELAY_BUFFER_SIZE):
+        self.src = src
+        self.dst = dst
+        self.size = size
+        self.pending = 0
+        self.eof = False
+        self.done = False
+
+    def wants_read(self):
+        return not self.eof and self.pending < self.size
+
+    def wants_write(self):
+        return self.pending > 0
+
+    def close(self):
+        pass
+
+
+# Linux only: the bytes go socket -> pipe -> socket inside the kernel and
+# are never copied into Python objects.
+class SplicePump(Pump):
+
+    def __init__(self, src, dst, size=RELAY_BUFFER_SIZE):
+        super().__init__(src, dst, size)
+        self.pipe_r, self.pipe_w = os.pipe()
+        os.set_blocking(self.pipe_r, False)
+        os.set_blocking(self.pipe_w, False)
+        if fcntl and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                self.size = fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, size)
+            except OSError:
+                # above /proc/sys/fs/pipe-max-size, keep the default
+                self.size = min(size, 64 * 1024)
+        else:
+            self.size = min(size, 64 * 1024)
+
+    def fill(self):
+        n = os.splice(self.src.fileno(), self.pipe_w, self.size - self.pending,
+                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.pending += n
+        return n
+
+    def drain(self):
+        n = os.splice(self.pipe_r, self.dst.fileno(), self.pending,
+                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        self.pending -= n
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+# Portable fallback: recv_into one preallocated buffer and send from a
+# memoryview of it, so a chunk is only copied once in each direction.
+class CopyPump(Pump):
+
+    def __init__(self, src, dst, size=RELAY_BUFFER_SIZE):
+        super().__init__(src, dst, size)
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+
+    def wants_read(self):
+        return not self.eof and self.pending == 0
+
+    def fill(self):
+        n = self.src.recv_into(self.buffer)
+        self.start = 0
+        self.pending = n
+        return n
+
+    def drain(self):
+        n = self.dst.send(self.view[self.start:self.start + self.pending])
+        self.start += n
+        self.pending -= n
+
+
+BACKENDS = {
+    'splice': SplicePump,
+    'copy': CopyPump,
+}
+
+
+def default_backend():
+    return 'splice' if hasattr(os, 'splice') else 'copy'
+
+
+# Relays between two connected sockets until both directions reached EOF or
+# one of them failed, or nothing moved for `idle_timeout` seconds.  An EOF
+# is passed on as a half-close once everything read before it was written.
+# The sockets are left open for the caller.
+def relay(sock, remote, backend=None, size=RELAY_BUFFER_SIZE, idle_timeout=None):
+    pump_class = BACKENDS[backend or default_backend()]
+    pumps = []
+    selector = selectors.DefaultSelector()
+    try:
+        pumps.append(pump_class(sock, remote, size))
+        pumps.append(pump_class(remote, sock, size))
+        sock.setblocking(False)
+        remote.setblocking(False)
+        registered = {}
+        while not all(pump.done for pump in pumps):
+            for s in (sock, remote):
+                mask = 0
+                for pump in pumps:
+                    if pump.src is s and pump.wants_read():
+                        mask |= selectors.EVENT_READ
+                    if pump.dst is s and pump.wants_write():
+                        mask |= selectors.EVENT_WRITE
+                if registered.get(s, 0) == mask:
+                    continue
+                if not mask:
+                    selector.unregister(s)
+                elif s in registered:
+                    selector.modify(s, mask)
+                else:
+                    selector.register(s, mask)
+                registered[s] = mask
+            if not registered or not any(registered.values()):
+                break
+            ready = {key.fileobj: events for key, events in selector.select(idle_timeout)}
+            if not ready:
+                break
+            for pump in pumps:
+                try:
+                    if pump.wants_write() and ready.get(pump.dst, 0) & selectors.EVENT_WRITE:
+                        pump.drain()
+                    if pump.wants_read() and ready.get(pump.src, 0) & selectors.EVENT_READ:
+                        if pump.fill() == 0:
+                            pump.eof = True
+                except BlockingIOError:
+                    pass
+                if pump.eof and not pump.pending and not pump.done:
+                    pump.done = True
+                    try:
+                        pump.dst.shutdown(socket.SHUT_WR)
+                    except OSError:
+                        pass
+            registered = {s: mask for s, mask in registered.items() if mask}
+    except OSError as e:
+        if e.errno not in (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN, errno.EBADF):
+            raise
+    finally:
+        selector.close()
+        for pump in pumps:
+            pump.close()
+
+
+# Read buffers shared by all connections of a loop.  A connection only
+# holds one between get_buffer() and buffer_updated().
+class BufferPool:
+
+    def __init__(self, size=READ_BUFFER_SIZE, maxsize=BUFFER_POOL_SIZE):
+        self.size = size
+        self.maxsize = maxsize
+        self.free = []
+        self.allocated = 0
+        self.reused = 0
+        self.dropped = 0
+
+    def get(self):
+        if self.free:
+            self.reused += 1
+            return self.free.pop()
+        self.allocated += 1
+        return bytearray(self.size)
+
+    def put(self, buffer):
+        if len(self.free) < self.maxsize:
+            self.free.append(buffer)
+
+
+buffer_pool = BufferPool()
+
+
+# Reads into pooled buffers.  While relay_peer() returns a transport the
+# bytes are written to it as a memoryview slice without any copy; otherwise
+# they go through data_received() as usual, and so do all of them while
+# payload dumps are on.  A transport may keep a
+# reference to unsent data instead of copying it, so a buffer whose write
+# was not flushed at once is left to the transport and not reused.
+class BufferedRelayProtocol(asyncio.BufferedProtocol):
+    read_buffer = None
+    # a metrics Sample that counts the bytes read, if any
+    byte_count = None
+    # marked on `trace` at the next read
+    trace = None
+    first_byte_event = None
+    # cleared on every read, see timers.IdleWatch
+    idle = False
+    # set once the connection read EOF
+    eof = False
+
+    def relay_peer(self):
+        return None
+
+    def get_buffer(self, sizehint):
+        if self.read_buffer is None:
+            self.read_buffer = buffer_pool.get()
+        return self.read_buffer
+
+    def buffer_updated(self, nbytes):
+        buffer = self.read_buffer
+        self.idle = False
+        if self.byte_count is not None:
+            self.byte_count.value += nbytes
+        if self.first_byte_event is not None:
+            self.trace.mark(self.first_byte_event)
+            self.first_byte_event = None
+        peer = self.relay_peer()
+        if peer is None or logs.dump_payloads:
+            self.data_received(bytes(buffer[:nbytes]))
+        else:
+            buffered = peer.get_write_buffer_size()
+            peer.write(memoryview(buffer)[:nbytes])
+            if peer.get_write_buffer_size() > buffered:
+                buffer_pool.dropped += 1
+                self.read_buffer = None
+                return
+        if self.read_buffer is buffer:
+            self.read_buffer = None
+            buffer_pool.put(buffer)
+
+
+# Event engine counterpart of relay(): one side of a relayed connection
+# that writes everything it reads to the peer transport and pauses the
+# peer while its own write buffer is above the high-water mark.  Nothing
+# is buffered for a connection that has no data in flight.
+class RelayProtocol(BufferedRelayProtocol):
+    transport = None
+
+    def __init__(self, peer=None):
+        self.peer = peer
+
+    def relay_peer(self):
+        return self.peer
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+
+    def data_received(self, data):
+        self.peer.write(data)
+
+    def pause_writing(self):
+        if self.peer:
+            self.peer.pause_reading()
+
+    def resume_writing(self):
+        if self.peer:
+            self.peer.resume_reading()
+
+    def eof_received(self):
+        return relay_eof(self, self.peer)
+
+    def connection_lost(self, exc):
+        if self.peer:
+            self.peer.close()
+
+
+# Passes an EOF read by `protocol` on to the transport it relays to, as a
+# half-close once the bytes before it were written.  Once the other
+# direction ended too, or the peer can not half-close, both are closed.
+# Returns what eof_received() should: true keeps the transport open for
+# the bytes still coming the other way.
+def relay_eof(protocol, peer_transport):
+    protocol.eof = True
+    if peer_transport is None or peer_transport.is_closing():
+        return False
+    if getattr(peer_transport.get_protocol(), 'eof', False) or not peer_transport.can_write_eof():
+        peer_transport.close()
+        return False
+    peer_transport.write_eof()
+    return True
+
+
+# Closes with a TCP reset instead of a FIN, so the other end sees a failure
+# rather than a clean end of stream.
+def reset_transport(transport):
+    sock = transport.get_extra_info('socket')
+    if sock is not None:
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        except OSError:
+            pass
+    transport.abort()
+
+
+# Ends a connection after its last reply.  It is half-closed first, so the
+# reply is not lost to a reset while the client is still sending, and
+# closed `linger` seconds later.  One that read EOF already, can not
+# half-close or is gone by now is closed at once, after the reply.
+def close_after_reply(transport, linger):
+    if getattr(transport.get_protocol(), 'eof', False) or not transport.can_write_eof():
+        transport.close()
+        return
+    try:
+        transport.write_eof()
+    except OSError:
+        transport.close()
+        return
+    wheel.call_later(linger, transport.close)
+
+
+# Every connection of the event engine is a file descriptor, lift the soft
+# limit to the hard one so tens of thousands of clients fit.
+def raise_nofile_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
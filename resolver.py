@@ -0,0 +1,321 @@
+import asyncio
+import os
+import random
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+QCLASS_IN = 1
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+DNS_HEADER = struct.Struct('>HHHHHH')
+DNS_RR = struct.Struct('>HHIH')
+
+HOSTS_PATH = '/etc/hosts'
+# seconds between checks whether the hosts file changed
+HOSTS_CHECK_INTERVAL = 5
+
+
+def read_nameservers(path='/etc/resolv.conf'):
+    nameservers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == 'nameserver':
+                    nameservers.append(fields[1])
+    except OSError:
+        pass
+    return nameservers
+
+
+def read_hosts(path=HOSTS_PATH):
+    hosts = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split('#', 1)[0].split()
+                for name in fields[1:]:
+                    hosts.setdefault(name.lower(), []).append(fields[0])
+    except OSError:
+        pass
+    return hosts
+
+
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def build_query(query_id, name, qtype):
+    query = bytearray(DNS_HEADER.pack(query_id, 0x0100, 1, 0, 0, 0))
+    for label in name.rstrip('.').split('.'):
+        label = label.encode('idna')
+        query.append(len(label))
+        query += label
+    query += b'\x00' + struct.pack('>HH', qtype, QCLASS_IN)
+    return bytes(query)
+
+
+def skip_name(data, pos):
+    while True:
+        length = data[pos]
+        if length & 0xc0 == 0xc0:
+            return pos + 2
+        pos += 1 + length
+        if length == 0:
+            return pos
+
+
+# Returns (rcode, truncated, [(address, ttl), ...]) for the A/AAAA records
+# of the answer section, following any CNAME chain the server included.
+def parse_response(data, query_id):
+    qid, flags, qdcount, ancount, _, _ = DNS_HEADER.unpack_from(data)
+    if qid != query_id or not flags & 0x8000:
+        raise ValueError('unexpected DNS response')
+    pos = DNS_HEADER.size
+    for i in range(qdcount):
+        pos = skip_name(data, pos) + 4
+    records = []
+    for i in range(ancount):
+        pos = skip_name(data, pos)
+        rtype, rclass, ttl, rdlength = DNS_RR.unpack_from(data, pos)
+        pos += DNS_RR.size
+        rdata = data[pos:pos + rdlength]
+        pos += rdlength
+        if rtype == QTYPE_A and rdlength == 4:
+            records.append((socket.inet_ntop(socket.AF_INET, rdata), ttl))
+        elif rtype == QTYPE_AAAA and rdlength == 16:
+            records.append((socket.inet_ntop(socket.AF_INET6, rdata), ttl))
+    return flags & 0x000f, bool(flags & 0x0200), records
+
+
+class DNSQueryProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, query, waiter):
+        self.query = query
+        self.waiter = waiter
+
+    def connection_made(self, transport):
+        transport.sendto(self.query)
+
+    def datagram_received(self, data, addr):
+        if not self.waiter.done():
+            self.waiter.set_result(data)
+
+    def error_received(self, exc):
+        if not self.waiter.done():
+            self.waiter.set_exception(exc)
+
+    def connection_lost(self, exc):
+        if not self.waiter.done():
+            self.waiter.set_exception(exc or ConnectionError('DNS socket closed'))
+
+
+# Stub resolver with a bounded LRU cache.
+#
+# Positive answers live as long as their smallest record TTL (clamped to
+# min_ttl/max_ttl), failures are remembered for negative_ttl.  Concurrent
+# lookups of one name share a single query, and with prefetch enabled a
+# hit within prefetch_window seconds of expiry refreshes the entry in the
+# background so busy names never go cold.  Whatever the nameservers can
+# not answer (no nameserver, truncated answer, timeout, NXDOMAIN, no
+# records) and names without a dot are left to getaddrinfo in the
+# executor, which knows the search domains and NSS; a name only fails
+# once that failed too.  The hosts file is read again when it changed.
+class Resolver:
+
+    def __init__(self, maxsize=1024, min_ttl=5, max_ttl=3600, negative_ttl=30,
+                 prefetch=False, prefetch_window=10, timeout=2.0,
+                 nameservers=None, hosts=None):
+        self.maxsize = maxsize
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.prefetch = prefetch
+        self.prefetch_window = prefetch_window
+        self.timeout = timeout
+        self.nameservers = read_nameservers() if nameservers is None else nameservers
+        # hosts given by the caller are kept as they are
+        self.hosts_file = hosts is None
+        self.hosts_mtime = None
+        self.hosts_checked = 0
+        self.hosts = self.read_hosts() if hosts is None else hosts
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+        self.prefetches = 0
+        self.fallbacks = 0
+
+    def stats(self):
+        return {
+            'size': len(self.cache),
+            'hits': self.hits,
+            'misses': self.misses,
+            'negative_hits': self.negative_hits,
+            'coalesced': self.coalesced,
+            'prefetches': self.prefetches,
+            'fallbacks': self.fallbacks,
+        }
+
+    async def resolve(self, host):
+        if isinstance(host, (bytes, bytearray)):
+            host = host.decode('ascii')
+        if is_ip_address(host):
+            return [host]
+        host = host.lower().rstrip('.')
+        if self.hosts_file:
+            self.check_hosts()
+        if host in self.hosts:
+            return self.hosts[host]
+
+        entry = self.cache.get(host)
+        if entry is not None:
+            expires, addresses = entry
+            now = time.monotonic()
+            if expires > now:
+                self.cache.move_to_end(host)
+                if addresses is None:
+                    self.negative_hits += 1
+                    raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+                self.hits += 1
+                if self.prefetch and expires - now < self.prefetch_window and host not in self.pending:
+                    self.prefetches += 1
+                    self.start_lookup(host)
+                return addresses
+            del self.cache[host]
+
+        task = self.pending.get(host)
+        if task is None:
+            self.misses += 1
+            task = self.start_lookup(host)
+        else:
+            self.coalesced += 1
+        addresses = await asyncio.shield(task)
+        if addresses is None:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return addresses
+
+    def read_hosts(self):
+        try:
+            self.hosts_mtime = os.stat(HOSTS_PATH).st_mtime
+        except OSError:
+            self.hosts_mtime = None
+        return read_hosts(HOSTS_PATH)
+
+    def check_hosts(self):
+        now = time.monotonic()
+        if now - self.hosts_checked < HOSTS_CHECK_INTERVAL:
+            return
+        self.hosts_checked = now
+        try:
+            mtime = os.stat(HOSTS_PATH).st_mtime
+        except OSError:
+            mtime = None
+        if mtime != self.hosts_mtime:
+            self.hosts = self.read_hosts()
+
+    def start_lookup(self, host):
+        task = asyncio.get_running_loop().create_task(self.lookup(host))
+        self.pending[host] = task
+        task.add_done_callback(lambda t: self.pending.pop(host, None))
+        return task
+
+    def store(self, host, addresses, ttl):
+        self.cache[host] = (time.monotonic() + ttl, addresses)
+        self.cache.move_to_end(host)
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    async def lookup(self, host):
+        addresses, ttl = [], self.negative_ttl
+        if '.' in host:
+            try:
+                addresses, ttl = await self.query(host)
+            except (OSError, ValueError, IndexError, struct.error, asyncio.TimeoutError):
+                pass
+        if not addresses:
+            self.fallbacks += 1
+            try:
+                addresses, ttl = await self.getaddrinfo(host), self.min_ttl
+            except OSError:
+                addresses = []
+        if not addresses:
+            self.store(host, None, self.negative_ttl)
+            return None
+        self.store(host, addresses, min(max(ttl, self.min_ttl), self.max_ttl))
+        return addresses
+
+    async def query(self, host):
+        if not self.nameservers:
+            raise OSError('no nameserver configured')
+        answers = await asyncio.gather(self.ask(host, QTYPE_A), self.ask(host, QTYPE_AAAA),
+                                       return_exceptions=True)
+        addresses = []
+        ttl = self.max_ttl
+        nxdomain = False
+        for answer in answers:
+            if isinstance(answer, BaseException):
+                continue
+            rcode, records = answer
+            nxdomain = nxdomain or rcode == RCODE_NXDOMAIN
+            for address, record_ttl in records:
+                addresses.append(address)
+                ttl = min(ttl, record_ttl)
+        if not addresses and not nxdomain:
+            # both queries failed or came back empty without a verdict
+            for answer in answers:
+                if isinstance(answer, BaseException):
+                    raise answer
+            return [], self.negative_ttl
+        return addresses, ttl if addresses else self.negative_ttl
+
+    async def ask(self, host, qtype):
+        loop = asyncio.get_running_loop()
+        last_exc = None
+        for nameserver in self.nameservers:
+            query_id = random.getrandbits(16)
+            waiter = loop.create_future()
+            try:
+                transport, _ = await loop.create_datagram_endpoint(
+                    lambda: DNSQueryProtocol(build_query(query_id, host, qtype), waiter),
+                    remote_addr=nameserver if isinstance(nameserver, tuple) else (nameserver, 53))
+            except OSError as e:
+                last_exc = e
+                continue
+            try:
+                data = await asyncio.wait_for(waiter, self.timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                last_exc = e
+                continue
+            finally:
+                transport.close()
+            rcode, truncated, records = parse_response(data, query_id)
+            if truncated:
+                raise OSError('truncated DNS answer')
+            if rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                last_exc = OSError('DNS server {} answered rcode {}'.format(nameserver, rcode))
+                continue
+            return rcode, records
+        raise last_exc
+
+    async def getaddrinfo(self, host):
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        addresses = []
+        for family, _, _, _, sockaddr in infos:
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+        return addresses
@@ -0,0 +1,190 @@
+import ipaddress
+import logging
+import signal
+
+ROUTE_TUNNEL = 'tunnel'
+ROUTE_DIRECT = 'direct'
+ROUTE_REJECT = 'reject'
+ROUTES = [ROUTE_TUNNEL, ROUTE_DIRECT, ROUTE_REJECT]
+
+routes_log = logging.getLogger('routes')
+
+
+class RouteError(ValueError):
+    pass
+
+
+class Rule:
+    __slots__ = ('action', 'target', 'hits')
+
+    def __init__(self, action, target):
+        self.action = action
+        self.target = target
+        self.hits = 0
+
+    def __repr__(self):
+        return '{} {}'.format(self.action, self.target)
+
+
+# Longest prefix match over the bits of an address, one trie per address
+# family.  A node is [zero child, one child, rule], so a lookup walks at
+# most 32 or 128 nodes whatever the number of rules.
+class CidrTree:
+
+    def __init__(self):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+
+    def insert(self, network, rule):
+        node = self.roots[network.version]
+        bits = network.max_prefixlen
+        value = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (value >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        node[2] = rule
+
+    def match(self, address):
+        node = self.roots[address.version]
+        bits = address.max_prefixlen
+        value = int(address)
+        rule = node[2]
+        for i in range(bits - 1, -1, -1):
+            node = node[(value >> i) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                rule = node[2]
+        return rule
+
+
+# Domains keyed by their labels from the top level down, so a rule for
+# example.com covers every name below it and the longest suffix wins.  The
+# rule of a node is kept under the key None.
+class DomainTrie:
+
+    def __init__(self):
+        self.root = {}
+
+    def insert(self, domain, rule):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node[None] = rule
+
+    def match(self, name):
+        node = self.root
+        rule = None
+        for label in reversed(name.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            rule = node.get(None, rule)
+        return rule
+
+
+# Rules compiled from lines like
+#
+#     direct 192.168.0.0/16
+#     direct corp.example
+#     reject ads.example.com
+#     default tunnel
+#
+# An address is matched against the CIDR rules, a name against the domain
+# rules; names are not resolved for it.  Whatever matches nothing takes
+# the default.
+class RouteTable:
+
+    def __init__(self, default=ROUTE_TUNNEL):
+        self.cidrs = CidrTree()
+        self.domains = DomainTrie()
+        self.default = Rule(default, 'default')
+        self.rules = []
+
+    def add(self, action, target):
+        if action not in ROUTES:
+            raise RouteError('unknown route {!r}'.format(action))
+        target = target.strip().lower().strip('.')
+        if target.startswith('*.'):
+            target = target[2:]
+        rule = Rule(action, target)
+        try:
+            network = ipaddress.ip_network(target, strict=False)
+        except ValueError:
+            if not target or ' ' in target or '/' in target:
+                raise RouteError('bad target {!r}'.format(target))
+            self.domains.insert(target, rule)
+        else:
+            self.cidrs.insert(network, rule)
+        self.rules.append(rule)
+
+    @classmethod
+    def parse(cls, text):
+        table = cls()
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            try:
+                if len(parts) != 2:
+                    raise RouteError('expected "ROUTE TARGET"')
+                if parts[0] == 'default':
+                    if parts[1] not in ROUTES:
+                        raise RouteError('unknown route {!r}'.format(parts[1]))
+                    table.default.action = parts[1]
+                else:
+                    table.add(parts[0], parts[1])
+            except RouteError as e:
+                raise RouteError('line {}: {}'.format(number, e))
+        return table
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.parse(f.read())
+
+    def match(self, host):
+        rule = None
+        # names never end in a digit, so most of them skip the address parse
+        if host[-1:].isdigit() or ':' in host:
+            try:
+                rule = self.cidrs.match(ipaddress.ip_address(host.strip('[]')))
+            except ValueError:
+                rule = self.domains.match(host.lower().rstrip('.'))
+        else:
+            rule = self.domains.match(host.lower().rstrip('.'))
+        if rule is None:
+            rule = self.default
+        rule.hits += 1
+        return rule.action
+
+    def hits(self):
+        return {(rule.action, rule.target): rule.hits for rule in self.rules + [self.default]}
+
+
+# The table in use, reloaded from its file on SIGHUP.  A file that does
+# not compile leaves the previous rules in place; hit counts start over.
+class Router:
+
+    def __init__(self, path=None):
+        self.path = path
+        self.table = RouteTable()
+
+    def load(self):
+        self.table = RouteTable.load(self.path)
+        routes_log.info('%d routes loaded from %s', len(self.table.rules), self.path)
+
+    def reload(self):
+        try:
+            self.load()
+        except (OSError, RouteError) as e:
+            routes_log.warning('reloading %s failed, routes unchanged: %s', self.path, e)
+
+    def reload_on_signal(self, loop):
+        if hasattr(signal, 'SIGHUP'):
+            loop.add_signal_handler(signal.SIGHUP, self.reload)
+
+    def route(self, host):
+        return self.table.match(host)
@@ -4,12 +4,20 @@
 # Usage: python s5.py 1080
 # Background Run: nohup python s5.py 1080 &
 
-import select
+import asyncio
 import socket
 import socketserver
 import struct
 import sys
 
+from dialer import happy_connect, happy_connect_sync
+from handshake import HandshakeParser, HandshakeError, GREETING, REQUEST, socks_address, \
+    socks_reply, connect_error_reply
+from relay import relay, relay_eof, default_backend, BACKENDS, RelayProtocol, raise_nofile_limit, \
+    WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW, EARLY_DATA_LIMIT
+from resolver import Resolver
+from timers import wheel, IdleWatch, IDLE_TIMEOUT, HANDSHAKE_TIMEOUT
+
 VER = 5
 
 
@@ -42,28 +50,27 @@ class REP:
     UNDEFINED = 9  # – NAME=FF # 未定义
 
 
+resolver = Resolver()
+
+
 class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     pass
 
 
 class Socks5Server(socketserver.StreamRequestHandler):
-    close = False
+    relay_backend = default_backend()
 
     def handle_tcp(self, sock, remote):
-        f_d_set = [sock, remote]
-        while not self.close:
-            r, w, e = select.select(f_d_set, [], [])
-            if sock in r:
-                if remote.send(sock.recv(4096)) <= 0:
-                    break
-            if remote in r:
-                if sock.send(remote.recv(4096)) <= 0:
-                    break
+        try:
+            relay(sock, remote, self.relay_backend, idle_timeout=IDLE_TIMEOUT)
+        finally:
+            remote.close()
 
     def handle(self):
         try:
             pass  # print 'from ', self.client_address nothing to do.
             sock = self.connection
+            sock.settimeout(HANDSHAKE_TIMEOUT)
             # 1. Version
             sock.recv(262)
             sock.send(b'\x05\x00')
@@ -74,18 +81,22 @@ class Socks5Server(socketserver.StreamRequestHandler):
             if atyp == ATYP.IPV4:  # IPv4
                 addr = socket.inet_ntoa(self.rfile.read(4))
             elif atyp == ATYP.DOMAIN:  # Domain name
-                addr = self.rfile.read(sock.recv(1)[0])
+                addr = self.rfile.read(self.rfile.read(1)[0]).decode('ascii', 'replace')
+            elif atyp == ATYP.IPV6:  # IPv6
+                addr = socket.inet_ntop(socket.AF_INET6, self.rfile.read(16))
             else:
                 # Addr type not supported
                 return sock.send(b'\x05\x08\x00\x01')
             port = struct.unpack('>H', self.rfile.read(2))
-            reply = b'\x05\x00\x00\x01'
+            reply = b'\x05\x00\x00'
             try:
                 if mode == CMD.CONNECT:  # 1. Tcp connect
-                    remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    remote.connect((addr, port[0]))
-                    local = remote.getsockname()
-                    reply += socket.inet_aton(local[0]) + struct.pack('>H', local[1])
+                    addresses = []
+                    for info in socket.getaddrinfo(addr, port[0], type=socket.SOCK_STREAM):
+                        if info[4][0] not in addresses:
+                            addresses.append(info[4][0])
+                    remote = happy_connect_sync(addresses, port[0])
+                    reply += socks_address(remote.getsockname())
                 else:
                     return sock.send(b'\x05\x07\x00\x01')  # Command not supported
             except socket.error:
@@ -102,14 +113,132 @@ class Socks5Server(socketserver.StreamRequestHandler):
             pass
 
 
+# Event engine: all clients are served by one thread on the asyncio
+# selector loop instead of a thread per connection.
+class Socks5Protocol(asyncio.Protocol):
+    transport = None
+    remote_transport = None
+    handshake_timer = None
+    idle_watch = None
+    idle = False
+    eof = False
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.parser = HandshakeParser()
+        self.early_data = b''
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(WRITE_BUFFER_HIGH, WRITE_BUFFER_LOW)
+        self.handshake_timer = wheel.call_later(HANDSHAKE_TIMEOUT, self.transport.abort)
+
+    def data_received(self, data):
+        self.idle = False
+        if self.remote_transport:
+            self.remote_transport.write(data)
+            return
+        if self.parser.done:
+            # still connecting, keep what the client pipelined
+            self.early_data += data
+            if len(self.early_data) > EARLY_DATA_LIMIT:
+                self.transport.pause_reading()
+            return
+        try:
+            events = self.parser.feed(data)
+        except HandshakeError:
+            self.transport.close()
+            return
+        for event in events:
+            if event == GREETING:
+                self.transport.write(b'\x05\x00')
+            elif event == REQUEST:
+                self.handshake_timer.cancel()
+                if self.parser.http:
+                    self.transport.close()
+                elif self.parser.cmd != CMD.CONNECT:
+                    self.transport.write(socks_reply(REP.COMMAND_NOT_SUPPORTED))
+                    self.transport.close()
+                else:
+                    self.early_data = self.parser.rest
+                    self.loop.create_task(self.connect(self.parser.addr, self.parser.port))
+
+    async def connect(self, addr, port):
+        try:
+            addresses = await resolver.resolve(addr)
+            sock = await happy_connect(self.loop, addresses, port)
+            transport, _ = await self.loop.create_connection(
+                lambda: RelayProtocol(self.transport), sock=sock)
+        except OSError as e:
+            if not self.transport.is_closing():
+                self.transport.write(connect_error_reply(e))
+                self.transport.close()
+            return
+        if self.transport.is_closing():
+            transport.close()
+            return
+        self.remote_transport = transport
+        # before the early data goes out, which may pause reading again
+        self.transport.resume_reading()
+        self.transport.write(b'\x05\x00\x00' + socks_address(sock.getsockname()))
+        if self.early_data:
+            transport.write(self.early_data)
+            self.early_data = b''
+        if self.eof:
+            transport.write_eof()
+        self.idle_watch = IdleWatch(IDLE_TIMEOUT, self.idle_expired, self, transport.get_protocol())
+
+    def idle_expired(self):
+        self.transport.abort()
+        self.remote_transport.abort()
+
+    def pause_writing(self):
+        if self.remote_transport:
+            self.remote_transport.pause_reading()
+
+    def resume_writing(self):
+        if self.remote_transport:
+            self.remote_transport.resume_reading()
+
+    # passed on to the remote, once connected if the client half-closed
+    # right after its request
+    def eof_received(self):
+        if self.remote_transport:
+            return relay_eof(self, self.remote_transport)
+        if self.parser.done:
+            self.eof = True
+            return True
+        return False
+
+    def connection_lost(self, exc):
+        self.handshake_timer.cancel()
+        if self.idle_watch:
+            self.idle_watch.cancel()
+        if self.remote_transport:
+            self.remote_transport.close()
+
+
+async def serve(port):
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(lambda: Socks5Protocol(loop), '', port, backlog=1024)
+    print('bind port: %d' % port + ' ok! relay: event')
+    async with server:
+        await server.serve_forever()
+
+
 def main():
     filename = sys.argv[0]
-    if len(sys.argv) < 2:
-        print('usage: ' + filename + ' port')
+    if len(sys.argv) < 2 or len(sys.argv) > 2 and sys.argv[2] not in ['event'] + list(BACKENDS):
+        print('usage: ' + filename + ' port [event|' + '|'.join(BACKENDS) + ']')
         sys.exit()
     socks_port = int(sys.argv[1])
+    raise_nofile_limit()
+    if len(sys.argv) < 3 or sys.argv[2] == 'event':
+        return asyncio.run(serve(socks_port))
+    # thread per connection with the given relay backend
+    Socks5Server.relay_backend = sys.argv[2]
     server = ThreadingTCPServer(('', socks_port), Socks5Server)
-    print('bind port: %d' % socks_port + ' ok!')
+    print('bind port: %d' % socks_port + ' ok! relay: ' + Socks5Server.relay_backend)
     server.serve_forever()
 
 
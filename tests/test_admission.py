@@ -0,0 +1,53 @@
+import unittest
+from unittest import mock
+
+from admission import Admission, SHED_STREAMS, SHED_CLIENT, SHED_RATE, SHED_HANDSHAKES
+
+
+class AdmissionTest(unittest.TestCase):
+
+    def test_limits(self):
+        admission = Admission(max_streams=2, max_per_client=1)
+        self.assertIsNone(admission.admit('a'))
+        self.assertEqual(admission.admit('a'), SHED_CLIENT)
+        self.assertIsNone(admission.admit('b'))
+        self.assertEqual(admission.admit('c'), SHED_STREAMS)
+        admission.release('a', handshaking=True)
+        self.assertIsNone(admission.admit('c'))
+        self.assertEqual(admission.stats()['shed'][SHED_CLIENT], 1)
+
+    def test_handshakes(self):
+        admission = Admission(max_handshakes=1)
+        self.assertIsNone(admission.admit('a'))
+        self.assertEqual(admission.admit('b'), SHED_HANDSHAKES)
+        admission.handshake_done()
+        self.assertIsNone(admission.admit('b'))
+        self.assertEqual(admission.handshakes, 1)
+
+    def test_accept_rate(self):
+        with mock.patch('time.monotonic', return_value=100.0) as clock:
+            admission = Admission(accept_rate=2)
+            self.assertIsNone(admission.admit('a'))
+            self.assertIsNone(admission.admit('a'))
+            self.assertEqual(admission.admit('a'), SHED_RATE)
+            clock.return_value = 100.5
+            self.assertIsNone(admission.admit('a'))
+            self.assertEqual(admission.admit('a'), SHED_RATE)
+
+    def test_fractional_accept_rate(self):
+        with mock.patch('time.monotonic', return_value=100.0) as clock:
+            admission = Admission(accept_rate=0.5)
+            self.assertIsNone(admission.admit('a'))
+            self.assertEqual(admission.admit('a'), SHED_RATE)
+            clock.return_value = 101.0
+            self.assertEqual(admission.admit('a'), SHED_RATE)
+            clock.return_value = 102.0
+            self.assertIsNone(admission.admit('a'))
+            # the burst stays at one client however long it was quiet
+            clock.return_value = 200.0
+            self.assertIsNone(admission.admit('a'))
+            self.assertEqual(admission.admit('a'), SHED_RATE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import unittest
+
+import compress
+from compress import Deflater, Inflater, CompressError, FRAME, FRAME_COMPRESSED, COMPRESS_MIN_SIZE, \
+    BYPASS_AFTER, RESAMPLE_BYTES
+
+TEXT = b'the quick brown fox jumps over the lazy dog ' * 200
+
+
+class CompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, compress, 'stats', compress.stats)
+        compress.stats = compress.CompressStats()
+
+    def test_round_trip(self):
+        deflater, inflater = Deflater(), Inflater()
+        writes = [TEXT, b'small', TEXT[:COMPRESS_MIN_SIZE], os.urandom(5000), b'', TEXT]
+        for data in writes:
+            self.assertEqual(inflater.feed(deflater.pack(data)), data)
+
+    def test_every_split_point(self):
+        deflater = Deflater()
+        writes = [TEXT[:300], b'hi', TEXT[:1000]]
+        stream = b''.join(deflater.pack(data) for data in writes)
+        for cut in range(len(stream) + 1):
+            inflater = Inflater()
+            out = inflater.feed(stream[:cut]) + inflater.feed(stream[cut:])
+            self.assertEqual(out, b''.join(writes), cut)
+
+    def test_small_writes_go_raw(self):
+        frame = Deflater().pack(b'x' * (COMPRESS_MIN_SIZE - 1))
+        self.assertEqual(FRAME.unpack_from(frame)[0], COMPRESS_MIN_SIZE - 1)
+        self.assertEqual(compress.stats.raw, COMPRESS_MIN_SIZE - 1)
+
+    def test_large_writes_are_deflated(self):
+        frame = Deflater().pack(TEXT)
+        self.assertTrue(FRAME.unpack_from(frame)[0] & FRAME_COMPRESSED)
+        self.assertLess(len(frame), len(TEXT) // 10)
+        self.assertEqual(compress.stats.input, len(TEXT))
+        self.assertEqual(compress.stats.output, len(frame) - FRAME.size)
+
+    def test_frames_never_look_like_control_messages(self):
+        deflater = Deflater()
+        for data in (b'\xff' * 10, b'\xff' * 1000, os.urandom(70000)):
+            self.assertNotEqual(deflater.pack(data)[0], 0xff)
+
+    def test_incompressible_stream_is_bypassed(self):
+        deflater, inflater = Deflater(), Inflater()
+        for _ in range(BYPASS_AFTER):
+            data = os.urandom(4096)
+            self.assertEqual(inflater.feed(deflater.pack(data)), data)
+        self.assertEqual(compress.stats.bypasses, 1)
+        frame = deflater.pack(TEXT)
+        self.assertFalse(FRAME.unpack_from(frame)[0] & FRAME_COMPRESSED)
+        self.assertEqual(inflater.feed(frame), TEXT)
+        # sampled again once enough raw bytes went by
+        for _ in range(RESAMPLE_BYTES // len(TEXT) + 1):
+            self.assertEqual(inflater.feed(deflater.pack(TEXT)), TEXT)
+        self.assertTrue(FRAME.unpack_from(deflater.pack(TEXT))[0] & FRAME_COMPRESSED)
+
+    def test_empty_feed(self):
+        inflater = Inflater()
+        self.assertEqual(inflater.feed(b''), b'')
+        self.assertEqual(inflater.feed(FRAME.pack(0)), b'')
+        self.assertEqual(inflater.feed(FRAME.pack(FRAME_COMPRESSED)), b'')
+
+    def test_oversized_frame_waits(self):
+        inflater = Inflater()
+        self.assertEqual(inflater.feed(FRAME.pack(FRAME_COMPRESSED | 0x7fffffff) + b'abc'), b'')
+        self.assertEqual(len(inflater.buffer), FRAME.size + 3)
+
+    def test_corrupt_payload(self):
+        payload = b'\xff\xff\xff\xff'
+        with self.assertRaises(CompressError):
+            Inflater().feed(FRAME.pack(FRAME_COMPRESSED | len(payload)) + payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+import socket
+import unittest
+
+from handshake import HandshakeParser, HandshakeError, GREETING, REQUEST, CONNECT_REQUEST, CONNECT_HTTP, \
+    CONNECT_FAST_OPEN, CONNECT_COMPRESS, ADD_RTYPE_IPV4, ADD_RTYPE_DOMAIN, ADD_RTYPE_IPV6, CMD_CONNECT, \
+    HTTP_HEADER_LIMIT, connect_request, split_reply, socks_reply
+
+GREETING_BYTES = b'\x05\x02\x00\x01'
+IPV4_REQUEST = b'\x05\x01\x00\x01' + socket.inet_aton('10.1.2.3') + b'\x01\xbb'
+DOMAIN_REQUEST = b'\x05\x01\x00\x03\x0bexample.com\x00\x50'
+IPV6_REQUEST = b'\x05\x01\x00\x04' + socket.inet_pton(socket.AF_INET6, '2001:db8::1') + b'\x1f\x90'
+HTTP_REQUEST = b'CONNECT example.com:443 HTTP/1.1\r\nHost: example.com:443\r\n\r\n'
+
+
+# Feeds the pieces like the agents do: whatever arrives after the request
+# is the stream's and joins `rest`.  Returns the parser and every event.
+def feed_pieces(pieces):
+    parser = HandshakeParser()
+    events = []
+    for piece in pieces:
+        if parser.done:
+            parser.rest += bytes(piece)
+        else:
+            events += parser.feed(piece)
+    return parser, events
+
+
+def split_at(data, *cuts):
+    bounds = [0] + list(cuts) + [len(data)]
+    return [data[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+class SocksTest(unittest.TestCase):
+
+    def test_ipv4_request(self):
+        parser, events = feed_pieces([GREETING_BYTES + IPV4_REQUEST])
+        self.assertEqual(events, [GREETING, REQUEST])
+        self.assertTrue(parser.done)
+        self.assertEqual(parser.methods, b'\x00\x01')
+        self.assertEqual((parser.cmd, parser.atyp, parser.addr, parser.port),
+                         (CMD_CONNECT, ADD_RTYPE_IPV4, '10.1.2.3', 443))
+        self.assertEqual(parser.rest, b'')
+        self.assertFalse(parser.http)
+
+    def test_domain_request(self):
+        parser, _ = feed_pieces([GREETING_BYTES, DOMAIN_REQUEST])
+        self.assertEqual((parser.atyp, parser.addr, parser.port), (ADD_RTYPE_DOMAIN, 'example.com', 80))
+
+    def test_ipv6_request(self):
+        parser, _ = feed_pieces([GREETING_BYTES, IPV6_REQUEST])
+        self.assertEqual((parser.atyp, parser.addr, parser.port), (ADD_RTYPE_IPV6, '2001:db8::1', 8080))
+
+    def test_pipelined_data_is_rest(self):
+        parser, events = feed_pieces([GREETING_BYTES + DOMAIN_REQUEST + b'GET / HTTP/1.0\r\n'])
+        self.assertEqual(events, [GREETING, REQUEST])
+        self.assertEqual(parser.rest, b'GET / HTTP/1.0\r\n')
+
+    def test_every_split_point(self):
+        data = GREETING_BYTES + DOMAIN_REQUEST + b'payload'
+        for cut in range(1, len(data)):
+            parser, events = feed_pieces(split_at(data, cut))
+            self.assertEqual(events, [GREETING, REQUEST], cut)
+            self.assertEqual((parser.addr, parser.port, parser.rest), ('example.com', 80, b'payload'), cut)
+
+    def test_byte_at_a_time(self):
+        data = GREETING_BYTES + IPV6_REQUEST + b'x'
+        events_by_byte = []
+        parser = HandshakeParser()
+        for i in range(len(data) - 1):
+            events_by_byte.append(parser.feed(data[i:i + 1]))
+        self.assertEqual([e for e in events_by_byte if e], [[GREETING], [REQUEST]])
+        self.assertEqual(events_by_byte[len(GREETING_BYTES) - 1], [GREETING])
+        self.assertEqual(events_by_byte[-1], [REQUEST])
+        self.assertEqual((parser.addr, parser.rest), ('2001:db8::1', b''))
+
+    def test_memoryview_input(self):
+        parser, events = feed_pieces([memoryview(GREETING_BYTES + IPV4_REQUEST)])
+        self.assertEqual(events, [GREETING, REQUEST])
+        self.assertEqual(parser.addr, '10.1.2.3')
+
+    def test_unknown_protocol(self):
+        with self.assertRaises(HandshakeError):
+            HandshakeParser().feed(b'\x04\x01')
+
+    def test_bad_request_version(self):
+        parser = HandshakeParser()
+        parser.feed(GREETING_BYTES)
+        with self.assertRaises(HandshakeError):
+            parser.feed(b'\x04' + IPV4_REQUEST[1:])
+
+    def test_unknown_address_type(self):
+        with self.assertRaises(HandshakeError):
+            HandshakeParser().feed(GREETING_BYTES + b'\x05\x01\x00\x02\x00\x00\x00\x00\x00\x00')
+
+    def test_feed_after_done(self):
+        parser, _ = feed_pieces([GREETING_BYTES + IPV4_REQUEST])
+        with self.assertRaises(HandshakeError):
+            parser.feed(b'more')
+
+
+class HttpConnectTest(unittest.TestCase):
+
+    def test_request(self):
+        parser, events = feed_pieces([HTTP_REQUEST + b'\x16\x03\x01'])
+        self.assertEqual(events, [REQUEST])
+        self.assertTrue(parser.http)
+        self.assertEqual((parser.cmd, parser.atyp, parser.addr, parser.port),
+                         (CMD_CONNECT, ADD_RTYPE_DOMAIN, 'example.com', 443))
+        self.assertEqual(parser.rest, b'\x16\x03\x01')
+
+    def test_every_split_point(self):
+        for cut in range(1, len(HTTP_REQUEST)):
+            parser, events = feed_pieces(split_at(HTTP_REQUEST, cut))
+            self.assertEqual(events, [REQUEST], cut)
+            self.assertEqual((parser.addr, parser.port), ('example.com', 443), cut)
+
+    def test_terminator_split_across_three_feeds(self):
+        end = len(HTTP_REQUEST)
+        parser, events = feed_pieces(split_at(HTTP_REQUEST, end - 3, end - 1))
+        self.assertEqual(events, [REQUEST])
+
+    def test_ipv6_target(self):
+        parser, _ = feed_pieces([b'CONNECT [2001:db8::1]:443 HTTP/1.1\r\n\r\n'])
+        self.assertEqual((parser.atyp, parser.addr, parser.port), (ADD_RTYPE_IPV6, '2001:db8::1', 443))
+
+    def test_ipv4_target(self):
+        parser, _ = feed_pieces([b'CONNECT 10.0.0.1:22 HTTP/1.1\r\n\r\n'])
+        self.assertEqual((parser.atyp, parser.addr), (ADD_RTYPE_IPV4, '10.0.0.1'))
+
+    def test_bad_target(self):
+        for line in (b'CONNECT example.com HTTP/1.1', b'CONNECT :443 HTTP/1.1', b'CONNECT a:b HTTP/1.1',
+                     b'CONNECTX example.com:443 HTTP/1.1', b'CONNECT example.com:443'):
+            with self.assertRaises(HandshakeError, msg=line):
+                HandshakeParser().feed(line + b'\r\n\r\n')
+
+    def test_header_too_long(self):
+        parser = HandshakeParser()
+        parser.feed(b'CONNECT example.com:443 HTTP/1.1\r\n')
+        with self.assertRaises(HandshakeError):
+            for _ in range(HTTP_HEADER_LIMIT // 16 + 2):
+                parser.feed(b'X-Padding: 12345\r\n'[:16])
+
+
+class ConnectRequestTest(unittest.TestCase):
+
+    def parse(self, data):
+        parser, events = feed_pieces([data])
+        self.assertEqual(events, [REQUEST])
+        return parser
+
+    def test_round_trip(self):
+        for request in (IPV4_REQUEST, DOMAIN_REQUEST, IPV6_REQUEST):
+            client, _ = feed_pieces([GREETING_BYTES, request])
+            parser = self.parse(connect_request(client))
+            self.assertEqual((parser.atyp, parser.addr, parser.port),
+                             (client.atyp, client.addr, client.port))
+            self.assertFalse(parser.http or parser.fast_open or parser.compress)
+
+    def test_flags(self):
+        client, _ = feed_pieces([HTTP_REQUEST])
+        request = connect_request(client)
+        self.assertEqual(request[:3], CONNECT_REQUEST + bytes((CONNECT_HTTP,)))
+        self.assertTrue(self.parse(request).http)
+        # a fast-open client was answered by the survivor already
+        request = connect_request(client, fast_open=True)
+        parser = self.parse(request)
+        self.assertTrue(parser.fast_open)
+        self.assertFalse(parser.http)
+        request = bytearray(request)
+        request[2] |= CONNECT_COMPRESS
+        self.assertTrue(self.parse(bytes(request)).compress)
+        self.assertEqual(CONNECT_FAST_OPEN & CONNECT_COMPRESS, 0)
+
+    def test_every_split_point(self):
+        client, _ = feed_pieces([GREETING_BYTES, DOMAIN_REQUEST])
+        data = connect_request(client) + b'rest'
+        for cut in range(1, len(data)):
+            parser, events = feed_pieces(split_at(data, cut))
+            self.assertEqual(events, [REQUEST], cut)
+            self.assertEqual((parser.addr, parser.rest), ('example.com', b'rest'), cut)
+
+    def test_bad_second_byte(self):
+        with self.assertRaises(HandshakeError):
+            HandshakeParser().feed(b'\xff\x50\x00\x01\x00\x00\x00\x00\x00\x00')
+
+    def test_long_host_name(self):
+        client, _ = feed_pieces([b'CONNECT ' + b'a' * 300 + b'.com:443 HTTP/1.1\r\n\r\n'])
+        with self.assertRaises(HandshakeError):
+            connect_request(client)
+
+
+class SplitReplyTest(unittest.TestCase):
+
+    def test_incomplete(self):
+        reply = socks_reply(0, ('10.0.0.1', 80))
+        for size in range(len(reply)):
+            self.assertIsNone(split_reply(reply[:size]), size)
+
+    def test_split(self):
+        self.assertEqual(split_reply(socks_reply(5) + b'data'), (5, b'data'))
+        self.assertEqual(split_reply(socks_reply(0, ('2001:db8::1', 443)) + b'x'), (0, b'x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
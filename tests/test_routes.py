@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+
+from routes import RouteTable, Router, RouteError, ROUTE_TUNNEL, ROUTE_DIRECT, ROUTE_REJECT
+
+RULES = """
+# local networks stay local
+direct 10.0.0.0/8
+reject 10.1.0.0/16
+direct 10.1.2.0/24
+direct 10.1.2.3
+direct fd00::/8
+reject fd00:1::/32
+direct corp.example
+reject ads.corp.example
+reject *.tracker.example
+"""
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = RouteTable.parse(RULES)
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(self.table.match('10.9.9.9'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('10.1.9.9'), ROUTE_REJECT)
+        self.assertEqual(self.table.match('10.1.2.9'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('10.1.2.3'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('11.0.0.1'), ROUTE_TUNNEL)
+
+    def test_prefix_edges(self):
+        self.assertEqual(self.table.match('10.255.255.255'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('9.255.255.255'), ROUTE_TUNNEL)
+        self.assertEqual(self.table.match('10.1.255.255'), ROUTE_REJECT)
+        self.assertEqual(self.table.match('10.2.0.0'), ROUTE_DIRECT)
+
+    def test_ipv6(self):
+        self.assertEqual(self.table.match('fd12::1'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('fd00:1:2::1'), ROUTE_REJECT)
+        self.assertEqual(self.table.match('[fd12::1]'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('2001:db8::1'), ROUTE_TUNNEL)
+
+    def test_families_are_separate(self):
+        table = RouteTable.parse('direct 0.0.0.0/0')
+        self.assertEqual(table.match('1.2.3.4'), ROUTE_DIRECT)
+        self.assertEqual(table.match('::1'), ROUTE_TUNNEL)
+
+    def test_domains(self):
+        self.assertEqual(self.table.match('corp.example'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('mail.corp.example'), ROUTE_DIRECT)
+        self.assertEqual(self.table.match('ads.corp.example'), ROUTE_REJECT)
+        self.assertEqual(self.table.match('x.ads.corp.example'), ROUTE_REJECT)
+        self.assertEqual(self.table.match('tracker.example'), ROUTE_REJECT)
+        self.assertEqual(self.table.match('a.b.tracker.example'), ROUTE_REJECT)
+
+    def test_domain_labels_not_suffixes(self):
+        self.assertEqual(self.table.match('notcorp.example'), ROUTE_TUNNEL)
+        self.assertEqual(self.table.match('example'), ROUTE_TUNNEL)
+
+    def test_domain_case_and_trailing_dot(self):
+        self.assertEqual(self.table.match('Mail.CORP.example.'), ROUTE_DIRECT)
+
+    def test_names_ending_in_digits(self):
+        table = RouteTable.parse('direct host1\nreject 10.0.0.0/8')
+        self.assertEqual(table.match('host1'), ROUTE_DIRECT)
+        self.assertEqual(table.match('10.0.0.1'), ROUTE_REJECT)
+
+    def test_default(self):
+        table = RouteTable.parse('default direct\nreject bad.example')
+        self.assertEqual(table.match('good.example'), ROUTE_DIRECT)
+        self.assertEqual(table.match('bad.example'), ROUTE_REJECT)
+        self.assertEqual(table.match('192.0.2.1'), ROUTE_DIRECT)
+
+    def test_empty_table(self):
+        table = RouteTable.parse('\n# nothing\n')
+        self.assertEqual(table.match('example.com'), ROUTE_TUNNEL)
+        self.assertEqual(table.match('127.0.0.1'), ROUTE_TUNNEL)
+
+    def test_hits(self):
+        self.table.match('mail.corp.example')
+        self.table.match('corp.example')
+        self.table.match('unknown.example')
+        hits = self.table.hits()
+        self.assertEqual(hits[ROUTE_DIRECT, 'corp.example'], 2)
+        self.assertEqual(hits[ROUTE_TUNNEL, 'default'], 1)
+        self.assertEqual(hits[ROUTE_REJECT, 'ads.corp.example'], 0)
+
+    def test_errors_name_the_line(self):
+        for text in ('direct', 'bounce 10.0.0.0/8', 'direct a b', 'default sideways', 'direct a/b'):
+            with self.assertRaises(RouteError, msg=text) as cm:
+                RouteTable.parse('direct corp.example\n' + text)
+            self.assertIn('line 2', str(cm.exception))
+
+
+class RouterTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def test_reload(self):
+        self.write('direct corp.example')
+        router = Router(self.path)
+        router.load()
+        self.assertEqual(router.route('corp.example'), ROUTE_DIRECT)
+        self.write('reject corp.example')
+        router.reload()
+        self.assertEqual(router.route('corp.example'), ROUTE_REJECT)
+
+    def test_bad_reload_keeps_the_rules(self):
+        self.write('direct corp.example')
+        router = Router(self.path)
+        router.load()
+        self.write('bounce corp.example')
+        with self.assertLogs('routes', 'WARNING'):
+            router.reload()
+        self.assertEqual(router.route('corp.example'), ROUTE_DIRECT)
+
+
+if __name__ == '__main__':
+    unittest.main()
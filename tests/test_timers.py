@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+
+from timers import TimerWheel
+
+
+# Drives the wheel by hand; tick() is what the loop would call every
+# resolution.
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.fired = []
+
+    def wheel(self, slots=8):
+        wheel = TimerWheel(resolution=1.0, slots=slots)
+        self.addCleanup(lambda: wheel.handle and wheel.handle.cancel())
+        return wheel
+
+    def run_ticks(self, wheel, count):
+        for _ in range(count):
+            wheel.tick()
+
+    def test_fires_after_delay_never_early(self):
+        wheel = self.wheel()
+        wheel.call_later(3, self.fired.append, 'a')
+        self.run_ticks(wheel, 3)
+        self.assertEqual(self.fired, [])
+        self.run_ticks(wheel, 1)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_fractional_delay_rounds_up(self):
+        wheel = self.wheel()
+        wheel.call_later(0.1, self.fired.append, 'a')
+        self.run_ticks(wheel, 1)
+        self.assertEqual(self.fired, [])
+        self.run_ticks(wheel, 1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_longer_than_the_wheel(self):
+        wheel = self.wheel(slots=8)
+        wheel.call_later(20, self.fired.append, 'a')
+        self.run_ticks(wheel, 20)
+        self.assertEqual(self.fired, [])
+        self.run_ticks(wheel, 1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_delay_of_exactly_the_wheel(self):
+        for delay in (7, 8, 9, 16):
+            wheel = self.wheel(slots=8)
+            wheel.call_later(delay, self.fired.append, delay)
+            self.run_ticks(wheel, delay)
+            self.assertEqual(self.fired, [], delay)
+            self.run_ticks(wheel, 1)
+            self.assertEqual(self.fired, [delay])
+            self.fired.clear()
+
+    def test_wrap_around(self):
+        wheel = self.wheel(slots=8)
+        self.run_ticks(wheel, 6)
+        wheel.call_later(5, self.fired.append, 'a')
+        self.run_ticks(wheel, 5)
+        self.assertEqual(self.fired, [])
+        self.run_ticks(wheel, 1)
+        self.assertEqual(self.fired, ['a'])
+
+    def test_cancel(self):
+        wheel = self.wheel()
+        timer = wheel.call_later(2, self.fired.append, 'a')
+        wheel.call_later(2, self.fired.append, 'b')
+        timer.cancel()
+        timer.cancel()
+        self.assertEqual(len(wheel), 1)
+        self.run_ticks(wheel, 3)
+        self.assertEqual(self.fired, ['b'])
+
+    def test_callback_may_schedule_and_fail(self):
+        wheel = self.wheel()
+
+        def again():
+            self.fired.append('first')
+            wheel.call_later(1, self.fired.append, 'second')
+            raise RuntimeError('ignored')
+
+        wheel.call_later(1, again)
+        with self.assertLogs('timers', 'ERROR'):
+            self.run_ticks(wheel, 2)
+        self.run_ticks(wheel, 2)
+        self.assertEqual(self.fired, ['first', 'second'])
+
+    def test_loop_handle_only_while_timers_exist(self):
+        wheel = self.wheel()
+        self.assertIsNone(wheel.handle)
+        wheel.call_later(1, self.fired.append, 'a')
+        self.assertIsNotNone(wheel.handle)
+        wheel.handle.cancel()
+        self.run_ticks(wheel, 2)
+        self.assertEqual(self.fired, ['a'])
+        self.assertIsNone(wheel.handle)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import math
+
+WHEEL_RESOLUTION = 1.0
+WHEEL_SLOTS = 512
+
+# streams that move no byte in either direction for this long are reaped,
+# clients that did not finish their handshake in time are dropped
+IDLE_TIMEOUT = 300
+HANDSHAKE_TIMEOUT = 10
+
+timers_log = logging.getLogger('timers')
+
+
+class WheelTimer:
+    __slots__ = ('wheel', 'slot', 'rounds', 'callback', 'args')
+
+    def __init__(self, wheel, callback, args):
+        self.wheel = wheel
+        self.slot = None
+        self.rounds = 0
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel.slots[self.slot].discard(self)
+            self.wheel.count -= 1
+            self.slot = None
+
+
+# Coarse timers for per-connection timeouts.  A timer goes into the slot the
+# wheel reaches after its delay, so scheduling and cancelling cost a set
+# operation and the loop runs one handle for all of them, and none while
+# the wheel is empty.  Timers fire up to one resolution late, never early.
+class TimerWheel:
+
+    def __init__(self, resolution=WHEEL_RESOLUTION, slots=WHEEL_SLOTS):
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.count = 0
+        self.loop = None
+        self.handle = None
+
+    def __len__(self):
+        return self.count
+
+    def call_later(self, delay, callback, *args):
+        # one tick more, the current one is partly over
+        ticks = max(math.ceil(delay / self.resolution), 0) + 1
+        timer = WheelTimer(self, callback, args)
+        timer.rounds = (ticks - 1) // len(self.slots)
+        timer.slot = (self.position + ticks) % len(self.slots)
+        self.slots[timer.slot].add(timer)
+        self.count += 1
+        if self.handle is None:
+            self.loop = asyncio.get_event_loop()
+            self.handle = self.loop.call_later(self.resolution, self.tick)
+        return timer
+
+    def tick(self):
+        self.handle = None
+        self.position = (self.position + 1) % len(self.slots)
+        slot = self.slots[self.position]
+        due = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+        for timer in due:
+            timer.cancel()
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                timers_log.exception('timer callback %r failed', timer.callback)
+        if self.count and self.handle is None:
+            self.handle = self.loop.call_later(self.resolution, self.tick)
+
+
+wheel = TimerWheel()
+
+
+# Calls on_idle() once none of `protocols` read anything for a whole
+# timeout.  The data paths only clear the protocol's `idle` flag, the check
+# on the wheel sets it again, so a stream is reaped after one to two
+# timeouts of silence.
+class IdleWatch:
+    __slots__ = ('timeout', 'on_idle', 'protocols', 'timer')
+
+    def __init__(self, timeout, on_idle, *protocols):
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.protocols = protocols
+        for protocol in protocols:
+            protocol.idle = True
+        self.timer = wheel.call_later(timeout, self.check)
+
+    def check(self):
+        if all(protocol.idle for protocol in self.protocols):
+            self.timer = None
+            self.on_idle()
+            return
+        for protocol in self.protocols:
+            protocol.idle = True
+        self.timer = wheel.call_later(self.timeout, self.check)
+
+    def cancel(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
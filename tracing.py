@@ -0,0 +1,92 @@
+import itertools
+import json
+import logging
+import os
+import signal
+import time
+from collections import deque
+
+TRACE_SIZE = 1024
+
+trace_log = logging.getLogger('trace')
+
+
+# Lifecycle timestamps of one stream, in seconds since it was accepted
+# (survivor) or taken from the pool (rescuer).  Each event is recorded once,
+# later marks of the same event are ignored.
+class StreamTrace:
+    __slots__ = ('id', 'role', 'started', 'start', 'events', 'info')
+
+    def __init__(self, id, role):
+        self.id = id
+        self.role = role
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.events = {}
+        self.info = {}
+
+    def mark(self, event):
+        if event not in self.events:
+            self.events[event] = round(time.monotonic() - self.start, 6)
+
+    def record(self):
+        return {'id': self.id, 'role': self.role, 'started': self.started,
+                'events': self.events, **self.info}
+
+
+# Keeps the last `size` finished traces plus the open ones.  A size of 0
+# turns tracing off: start() returns None and the protocols skip every mark.
+class TraceRecorder:
+
+    def __init__(self, size=TRACE_SIZE):
+        self.ids = itertools.count(1)
+        self.active = {}
+        self.resize(size)
+
+    def resize(self, size):
+        self.size = size
+        self.finished = deque(maxlen=max(size, 1))
+
+    def start(self, role):
+        if not self.size:
+            return None
+        trace = StreamTrace(next(self.ids), role)
+        self.active[trace.id] = trace
+        return trace
+
+    # for a connection that turned out not to be a stream
+    def discard(self, trace):
+        self.active.pop(trace.id, None)
+
+    def finish(self, trace):
+        trace.mark('close')
+        if self.active.pop(trace.id, None):
+            self.finished.append(trace)
+
+    def records(self):
+        for trace in self.finished:
+            yield trace.record()
+        for trace in list(self.active.values()):
+            yield dict(trace.record(), open=True)
+
+    def dumps(self):
+        return ''.join(json.dumps(record) + '\n' for record in self.records())
+
+    def dump(self, path):
+        try:
+            with open(path, 'w') as f:
+                f.write(self.dumps())
+        except OSError as e:
+            trace_log.warning('writing traces to %s failed: %s', path, e)
+            return
+        trace_log.info('%d traces written to %s', len(self.finished) + len(self.active), path)
+
+    # Writes the traces to `path` on every SIGUSR2; {pid} in the path is
+    # replaced so workers and shards do not overwrite each other.
+    def dump_on_signal(self, loop, path):
+        if not hasattr(signal, 'SIGUSR2'):
+            return
+        loop.add_signal_handler(signal.SIGUSR2, lambda: self.dump(path.format(pid=os.getpid())))
+
+
+recorder = TraceRecorder()
@@ -0,0 +1,211 @@
+import logging
+import mmap
+import os
+import signal
+import socket
+import struct
+import traceback
+
+try:
+    import ctypes
+    prctl = ctypes.CDLL(None, use_errno=True).prctl
+except (ImportError, OSError, AttributeError):
+    prctl = None
+
+PR_SET_PDEATHSIG = 1
+MSG_WANT = b'W'
+MSG_LINK = b'L'
+MSG_NONE = b'N'
+
+# idle links, waiting clients
+WORKER_SLOT = struct.Struct('ii')
+
+workers_log = logging.getLogger('workers')
+
+
+# Where the system has it (Linux), a worker gets `signum` once its parent
+# is gone, however the parent died.
+def set_parent_death_signal(signum, parent):
+    if prctl is None:
+        return
+    prctl(PR_SET_PDEATHSIG, signum)
+    # the parent may have died before the call
+    if os.getppid() != parent:
+        os.kill(os.getpid(), signum)
+
+
+# N forked worker processes serving the same port (SO_REUSEPORT).
+#
+# Every worker publishes its number of idle rescuer links and waiting
+# clients in a shared memory slot, and every pair of workers shares a
+# datagram socketpair.  A worker that has clients waiting asks the worker
+# with the most idle links to lend one; that worker detaches the link from
+# its loop and sends the socket over with SCM_RIGHTS.  A worker that gets a
+# new link while nobody waits locally offers it to the worker with the most
+# waiting clients.  So any worker can serve a client with any idle link.
+# Without the mesh the workers are just supervised processes.
+class WorkerGroup:
+
+    def __init__(self, count, mesh=True):
+        self.count = count
+        self.index = None
+        self.slots = mmap.mmap(-1, WORKER_SLOT.size * count)
+        self.channels = {}
+        for i in range(count if mesh else 0):
+            for j in range(i + 1, count):
+                self.channels[i, j] = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.peers = {}
+        self.pids = {}
+        self.forwarded = ()
+        self.loop = None
+        self.lend = None
+        self.adopt = None
+        self.wanted = None
+        self.requested = 0
+        self.offered = 0
+        self.lent = 0
+        self.borrowed = 0
+
+    # Forks the workers, each running target(), and waits for them.  A
+    # SIGTERM to the parent stops the workers first, so none is left bound
+    # to the port.
+    def run(self, target):
+        parent = os.getpid()
+        for index in range(self.count):
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    set_parent_death_signal(signal.SIGTERM, parent)
+                    self.worker_started(index)
+                    target()
+                except KeyboardInterrupt:
+                    pass
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    os._exit(code)
+            self.pids[pid] = index
+        for signum in (signal.SIGTERM,) + tuple(self.forwarded):
+            signal.signal(signum, self.forward_signal)
+        for pair in self.channels.values():
+            for sock in pair:
+                sock.close()
+        try:
+            while self.pids:
+                pid, status = os.wait()
+                workers_log.info('worker %d exited with status %d', self.pids.pop(pid), status)
+        except KeyboardInterrupt:
+            for pid in self.pids:
+                os.kill(pid, signal.SIGTERM)
+
+    # The parent passes these signals on to every worker instead of being
+    # stopped by them, so reloads and dumps work on the whole group.
+    def forward_signals(self, *signums):
+        self.forwarded = signums
+
+    def forward_signal(self, signum, frame):
+        for pid in self.pids:
+            os.kill(pid, signum)
+
+    def worker_started(self, index):
+        self.index = index
+        for (i, j), (a, b) in self.channels.items():
+            if i == index:
+                self.peers[j] = a
+                b.close()
+            elif j == index:
+                self.peers[i] = b
+                a.close()
+            else:
+                a.close()
+                b.close()
+        self.channels = {}
+
+    # lend() returns (fd, key) of an idle link or None, adopt(fd, key) takes
+    # one over, wanted() tells whether clients are still waiting.
+    def attach(self, loop, lend, adopt, wanted):
+        self.loop = loop
+        self.lend = lend
+        self.adopt = adopt
+        self.wanted = wanted
+        for peer, sock in self.peers.items():
+            sock.setblocking(False)
+            loop.add_reader(sock.fileno(), self.message_received, peer)
+
+    def slot(self, index):
+        return WORKER_SLOT.unpack_from(self.slots, WORKER_SLOT.size * index)
+
+    def publish(self, idle=None, waiting=None):
+        if self.index is None:
+            return
+        old_idle, old_waiting = self.slot(self.index)
+        WORKER_SLOT.pack_into(self.slots, WORKER_SLOT.size * self.index,
+                              old_idle if idle is None else idle,
+                              old_waiting if waiting is None else waiting)
+
+    def publish_idle(self, count):
+        self.publish(idle=count)
+
+    def publish_waiting(self, count):
+        self.publish(waiting=count)
+
+    # Asks the worker with the most idle links for one.  Returns False when
+    # no other worker has any.
+    def request_link(self, exclude=None):
+        donors = [(self.slot(peer)[0], peer) for peer in self.peers if peer != exclude]
+        idle, peer = max(donors, default=(0, None))
+        if idle <= 0:
+            return False
+        try:
+            self.peers[peer].send(MSG_WANT)
+        except OSError:
+            return False
+        self.requested += 1
+        return True
+
+    # Hands an idle link to the worker with the most waiting clients.
+    # Returns False when no other worker has clients waiting.
+    def offer_link(self):
+        waiters = [(self.slot(peer)[1], peer) for peer in self.peers]
+        waiting, peer = max(waiters, default=(0, None))
+        if waiting <= 0:
+            return False
+        link = self.lend()
+        if link is None:
+            return False
+        self.offered += 1
+        self.send_link(peer, *link)
+        return True
+
+    def send_link(self, peer, fd, key):
+        try:
+            socket.send_fds(self.peers[peer], [MSG_LINK + key.encode()], [fd])
+            self.lent += 1
+        except OSError as e:
+            workers_log.warning('send link to worker %d failed: %s', peer, e)
+        finally:
+            os.close(fd)
+
+    def message_received(self, peer):
+        sock = self.peers[peer]
+        try:
+            msg, fds, _, _ = socket.recv_fds(sock, 1024, 1)
+        except (BlockingIOError, InterruptedError):
+            return
+        if msg[:1] == MSG_WANT:
+            link = self.lend()
+            if link is None:
+                sock.send(MSG_NONE)
+                return
+            self.send_link(peer, *link)
+        elif msg[:1] == MSG_LINK and fds:
+            self.borrowed += 1
+            self.adopt(fds[0], msg[1:].decode())
+        elif msg[:1] == MSG_NONE:
+            # the donor's count was stale, try the next best one
+            if self.wanted():
+                self.request_link(exclude=peer)
+        for fd in fds[1:] if msg[:1] == MSG_LINK else fds:
+            os.close(fd)